@@ -0,0 +1,80 @@
+"""
+Benchmark de búsqueda en la galería: latencia por escaneo según la cantidad de identidades.
+
+Uso:
+    python -m benchmarks.bench_galeria
+    python -m benchmarks.bench_galeria --tamanos 10 1000 100000 --caras 3
+"""
+import argparse
+import time
+
+import numpy as np
+
+from galeria import Galeria, DIMENSION
+
+
+def galeria_sintetica(n, semilla=0):
+    """Encodings con escala parecida a los de dlib (norma ~1, distancias entre personas ~0.8-1.0)."""
+    rng = np.random.default_rng(semilla)
+    encodings = rng.normal(0, 1 / np.sqrt(DIMENSION), (n, DIMENSION)).astype(np.float32)
+    nombres = [f"persona_{i}" for i in range(n)]
+    return encodings, nombres
+
+
+def consultas_de(encodings, caras, semilla=1):
+    """Caras que corresponden a personas enroladas, con ruido de captura."""
+    rng = np.random.default_rng(semilla)
+    idx = rng.integers(0, len(encodings), caras)
+    return encodings[idx] + rng.normal(0, 0.02, (caras, DIMENSION)).astype(np.float32), idx
+
+
+def legacy(lista_encodings, consultas):
+    """compare_faces original: una llamada por cara, convirtiendo la lista en cada llamada."""
+    for q in consultas:
+        distancias = np.linalg.norm(np.array(lista_encodings) - q, axis=1)
+        list(distancias <= 0.6)
+
+
+def medir(funcion, repeticiones):
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        tiempos.append(time.perf_counter() - inicio)
+    return np.median(tiempos) * 1000
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--tamanos", type=int, nargs="+", default=[10, 100, 1000, 10000, 100000])
+    ap.add_argument("--caras", type=int, default=1, help="Caras detectadas por frame")
+    ap.add_argument("--repeticiones", type=int, default=20)
+    ap.add_argument("--sin-legacy", action="store_true", help="Omitir la medición del método original")
+    args = ap.parse_args()
+
+    print(f"{'identidades':>11} {'legacy ms':>10} {'exacto ms':>10} {'ann ms':>8} {'recall ann':>10} {'build ann s':>11}")
+    for n in args.tamanos:
+        encodings, nombres = galeria_sintetica(n)
+        consultas, esperados = consultas_de(encodings, args.caras)
+
+        exacta = Galeria(encodings, nombres, modo="exacto")
+        inicio = time.perf_counter()
+        aproximada = Galeria(encodings, nombres, modo="ann")
+        construccion = time.perf_counter() - inicio
+
+        t_legacy = float('nan')
+        if not args.sin_legacy:
+            lista = list(encodings)
+            t_legacy = medir(lambda: legacy(lista, consultas), max(1, args.repeticiones // 4))
+        t_exacto = medir(lambda: exacta.buscar(consultas), args.repeticiones)
+        t_ann = medir(lambda: aproximada.buscar(consultas), args.repeticiones)
+
+        # Recall@1 del modo aproximado sobre más consultas
+        muestras, esperados = consultas_de(encodings, 200, semilla=2)
+        aciertos = sum(r["nombre"] == nombres[e] for r, e in zip(aproximada.buscar(muestras), esperados))
+
+        print(f"{n:>11} {t_legacy:>10.3f} {t_exacto:>10.3f} {t_ann:>8.3f} {aciertos / len(esperados):>10.2%} {construccion:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
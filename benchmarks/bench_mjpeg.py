@@ -0,0 +1,123 @@
+"""
+Benchmark del separador MJPEG sobre streams grabados.
+
+Uso:
+    python -m benchmarks.bench_mjpeg captura1.mjpeg captura2.mjpeg
+    python -m benchmarks.bench_mjpeg                      (genera una captura sintética)
+    python -m benchmarks.bench_mjpeg --grabar URL --segundos 10 --salida esp32.mjpeg
+"""
+import argparse
+import os
+import time
+
+import cv2
+import numpy as np
+import requests
+
+from mjpeg import DemuxMJPEG
+
+
+def generar_captura(frames=200, ancho=640, alto=480, content_length=True, calidad=80):
+    """Stream multipart sintético con el mismo formato que envía el ESP32-CAM."""
+    rng = np.random.default_rng(0)
+    base = np.tile(np.linspace(0, 255, ancho, dtype=np.uint8), (alto, 1))
+    partes = []
+    for i in range(frames):
+        ruido = rng.integers(0, 40, (alto, ancho), dtype=np.uint8)
+        img = cv2.merge((base, np.roll(base, i * 4, axis=1), ruido))
+        ok, jpg = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, calidad])
+        jpg = jpg.tobytes()
+        cabecera = b'--frame\r\nContent-Type: image/jpeg\r\n'
+        if content_length:
+            cabecera += b'Content-Length: %d\r\n' % len(jpg)
+        partes.append(cabecera + b'\r\n' + jpg + b'\r\n')
+    return b''.join(partes)
+
+
+def grabar(url, segundos, salida):
+    """Guarda los bytes crudos del stream para reproducirlos luego."""
+    limite = time.time() + segundos
+    total = 0
+    with requests.get(url, stream=True, timeout=5) as res, open(salida, 'wb') as f:
+        for chunk in res.iter_content(chunk_size=4096):
+            f.write(chunk)
+            total += len(chunk)
+            if time.time() > limite:
+                break
+    print(f"Grabados {total / 1e6:.1f} MB en {salida}")
+
+
+def parser_legacy(chunks):
+    """Bucle original de generar_frames (bytes += chunk y re-escaneo desde 0)."""
+    frames = 0
+    bytes_buffer = b''
+    for chunk in chunks:
+        bytes_buffer += chunk
+        a = bytes_buffer.find(b'\xff\xd8')
+        if a == -1:
+            if len(bytes_buffer) > 100000: bytes_buffer = b''
+            continue
+        b = bytes_buffer.find(b'\xff\xd9', a)
+        if b != -1:
+            frames += 1
+            bytes_buffer = bytes_buffer[b+2:]
+            if len(bytes_buffer) > 65536:
+                bytes_buffer = b''
+    return frames
+
+
+def parser_demux(chunks):
+    demux = DemuxMJPEG()
+    frames = 0
+    for chunk in chunks:
+        frames += len(demux.alimentar(chunk))
+    return frames
+
+
+def medir(parser, datos, chunk, repeticiones):
+    chunks = [datos[i:i + chunk] for i in range(0, len(datos), chunk)]
+    mejor = float('inf')
+    frames = 0
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        frames = parser(chunks)
+        mejor = min(mejor, time.perf_counter() - inicio)
+    return {
+        "frames": frames,
+        "segundos": mejor,
+        "mb_s": len(datos) / mejor / 1e6,
+        "fps": frames / mejor,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("capturas", nargs="*", help="Archivos .mjpeg grabados del ESP32")
+    ap.add_argument("--chunk", type=int, default=4096, help="Tamaño de chunk simulado (como iter_content)")
+    ap.add_argument("--repeticiones", type=int, default=5)
+    ap.add_argument("--grabar", metavar="URL", help="Grabar un stream en vez de medir")
+    ap.add_argument("--segundos", type=float, default=10)
+    ap.add_argument("--salida", default="captura.mjpeg")
+    args = ap.parse_args()
+
+    if args.grabar:
+        grabar(args.grabar, args.segundos, args.salida)
+        return
+
+    capturas = []
+    for ruta in args.capturas:
+        with open(ruta, 'rb') as f:
+            capturas.append((os.path.basename(ruta), f.read()))
+    if not capturas:
+        capturas.append(("sintetica_content_length", generar_captura(content_length=True)))
+        capturas.append(("sintetica_marcadores", generar_captura(content_length=False)))
+
+    for nombre, datos in capturas:
+        print(f"{nombre}: {len(datos) / 1e6:.1f} MB, chunk={args.chunk}")
+        for etiqueta, parser in (("legacy", parser_legacy), ("demux", parser_demux)):
+            r = medir(parser, datos, args.chunk, args.repeticiones)
+            print(f"   {etiqueta:<7} {r['mb_s']:8.1f} MB/s {r['fps']:10.0f} frames/s ({r['frames']} frames)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,456 @@
+"""
+Suite de benchmarks offline de los caminos críticos: cámara, reconocimiento y mensajería.
+
+Corre sobre capturas MJPEG grabadas (ver bench_mjpeg --grabar) e imágenes de rostros
+de referencia; no necesita cámara ni broker. Los resultados se guardan en JSON para
+comparar versiones.
+
+Uso:
+    python -m benchmarks.suite
+    python -m benchmarks.suite --capturas esp32.mjpeg --imagenes rostros --json base.json
+    python -m benchmarks.suite --solo mqtt mjpeg --json nuevo.json --comparar base.json
+
+Secciones: mjpeg, reconocimiento, cargar_referencia, mqtt, historial.
+Métricas terminadas en _ms/_us: menor es mejor; en _por_s: mayor es mejor.
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+import cv2
+import numpy as np
+
+from benchmarks.bench_mjpeg import generar_captura, parser_demux, parser_legacy
+from galeria import Galeria, DIMENSION
+from mjpeg import DemuxMJPEG
+
+SECCIONES = ("mjpeg", "reconocimiento", "cargar_referencia", "mqtt", "historial")
+ANCHO_ESP32, ALTO_ESP32 = 640, 480  # Resolución VGA del ESP32-CAM
+
+
+# --- Utilidades ---
+
+def estadisticas(muestras_ms):
+    """Mediana, p95 y mínimo de una lista de tiempos en ms."""
+    m = np.asarray(muestras_ms, float)
+    return {"mediana_ms": round(float(np.median(m)), 4),
+            "p95_ms": round(float(np.percentile(m, 95)), 4),
+            "min_ms": round(float(m.min()), 4)}
+
+
+def cronometrar(funcion, repeticiones):
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    return tiempos
+
+
+def _face_recognition_disponible():
+    try:
+        import face_recognition  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def _a_esp32(imagen):
+    """Encaja una imagen en un frame VGA (como los que manda la cámara)."""
+    alto, ancho = imagen.shape[:2]
+    escala = min(ANCHO_ESP32 / ancho, ALTO_ESP32 / alto)
+    reducida = cv2.resize(imagen, (int(ancho * escala), int(alto * escala)), interpolation=cv2.INTER_AREA)
+    frame = np.zeros((ALTO_ESP32, ANCHO_ESP32, 3), np.uint8)
+    y = (ALTO_ESP32 - reducida.shape[0]) // 2
+    x = (ANCHO_ESP32 - reducida.shape[1]) // 2
+    frame[y:y + reducida.shape[0], x:x + reducida.shape[1]] = reducida
+    return frame
+
+
+def cargar_fixtures(capturas, carpeta_imagenes, max_frames):
+    """Capturas MJPEG crudas, frames JPEG de prueba e imágenes de referencia."""
+    crudas = []
+    for ruta in capturas:
+        with open(ruta, 'rb') as f:
+            crudas.append((os.path.basename(ruta), f.read()))
+
+    referencias = []
+    for ext in ('*.jpg', '*.jpeg', '*.png'):
+        for ruta in sorted(glob.glob(os.path.join(carpeta_imagenes, ext))):
+            imagen = cv2.imread(ruta)
+            if imagen is not None:
+                referencias.append((os.path.basename(ruta), imagen))
+
+    frames = []
+    for nombre, imagen in referencias:
+        ok, jpg = cv2.imencode('.jpg', _a_esp32(imagen), [cv2.IMWRITE_JPEG_QUALITY, 80])
+        frames.append((nombre, jpg.tobytes()))
+    for nombre, datos in crudas:
+        demux = DemuxMJPEG()
+        extraidos = demux.alimentar(datos)
+        paso = max(1, len(extraidos) // max(1, max_frames))
+        frames.extend((f"{nombre}#{i}", jpg) for i, jpg in enumerate(extraidos[::paso][:max_frames]))
+    return crudas, referencias, frames
+
+
+# --- Secciones ---
+
+def bench_mjpeg(crudas, args):
+    if not crudas:
+        crudas = [("sintetica_content_length", generar_captura(content_length=True)),
+                  ("sintetica_marcadores", generar_captura(content_length=False))]
+    filas = []
+    for nombre, datos in crudas:
+        chunks = [datos[i:i + args.chunk] for i in range(0, len(datos), args.chunk)]
+        for etiqueta, parser in (("legacy", parser_legacy), ("demux", parser_demux)):
+            frames = parser(chunks)
+            mejor_s = min(cronometrar(lambda: parser(chunks), args.repeticiones)) / 1000
+            filas.append({"caso": f"{nombre}/{etiqueta}", "frames": frames, "chunk": args.chunk,
+                          "mb_por_s": round(len(datos) / mejor_s / 1e6, 2),
+                          "frames_por_s": round(frames / mejor_s, 1)})
+    return filas
+
+
+def bench_reconocimiento(referencias, frames, args):
+    """Latencia de un escaneo (lo que hace verificar_identidad) separada por etapa."""
+    if not _face_recognition_disponible():
+        return {"omitido": "face_recognition no está instalado"}
+    if not frames:
+        return {"omitido": "no hay imágenes ni capturas de prueba"}
+
+    import face_recognition
+    from preprocesamiento import PipelinePreprocesado, calentar
+
+    encodings, nombres = [], []
+    for nombre, imagen in referencias:
+        rgb = cv2.cvtColor(imagen, cv2.COLOR_BGR2RGB)
+        encs = face_recognition.face_encodings(cv2.resize(rgb, (0, 0), fx=0.25, fy=0.25))
+        if encs:
+            encodings.append(encs[0])
+            nombres.append(os.path.splitext(nombre)[0])
+    galeria = Galeria(encodings, nombres)
+    calentar()
+
+    filas = []
+    for reduccion in args.reducciones:
+        pipeline = PipelinePreprocesado({"reduccion": reduccion})
+        por_etapa, totales, detectados = {}, [], 0
+        for _ in range(args.repeticiones):
+            for nombre, jpg in frames:
+                inicio = time.perf_counter()
+                ctx = pipeline.ejecutar(jpg)
+                if ctx["ubicaciones"]:
+                    t = time.perf_counter()
+                    galeria.buscar(ctx["encodings"])
+                    ctx["tiempos"]["buscar"] = (time.perf_counter() - t) * 1000
+                    detectados += 1
+                totales.append((time.perf_counter() - inicio) * 1000)
+                for etapa, ms in ctx["tiempos"].items():
+                    por_etapa.setdefault(etapa, []).append(ms)
+        filas.append({
+            "caso": f"reduccion_{reduccion}",
+            "frames": len(frames),
+            "tasa_deteccion": round(detectados / (len(frames) * args.repeticiones), 3),
+            "total": estadisticas(totales),
+            "etapas": {etapa: estadisticas(ms) for etapa, ms in por_etapa.items()},
+        })
+    return filas
+
+
+def _codificar_sintetico(ruta):
+    """Encoding determinista por archivo: mide el índice sin el costo de dlib."""
+    semilla = zlib.crc32(os.path.basename(ruta).encode())
+    return np.random.default_rng(semilla).normal(0, 1 / np.sqrt(DIMENSION), DIMENSION).astype(np.float32)
+
+
+def _poblar(carpeta, referencias, n):
+    """n imágenes distintas (hash distinto) a partir de las referencias."""
+    bases = []
+    for _, imagen in referencias:
+        escala = min(1.0, 800 / max(imagen.shape[:2]))  # codificar_imagen reduce a 800 px igual
+        bases.append(cv2.resize(imagen, (0, 0), fx=escala, fy=escala, interpolation=cv2.INTER_AREA))
+    if not bases:
+        bases = [np.full((480, 640, 3), 128, np.uint8)]
+    for i in range(n):
+        imagen = bases[i % len(bases)].copy()
+        imagen[0, 0] = (i & 0xFF, (i >> 8) & 0xFF, (i >> 16) & 0xFF)
+        cv2.imwrite(os.path.join(carpeta, f"persona_{i:06d}.jpg"), imagen)
+
+
+def bench_cargar_referencia(referencias, args):
+    """Lo que hace cargar_referencia (sincronizar índice + armar la galería) según el tamaño."""
+    try:
+        from indice_rostros import IndiceRostros
+        from reconocimiento import codificar_imagen
+    except ImportError as e:
+        return {"omitido": f"dependencia faltante: {e.name}"}
+
+    real = args.codificador == "real" or (args.codificador == "auto" and _face_recognition_disponible())
+    codificar = codificar_imagen if real else _codificar_sintetico
+    tamanos = args.tamanos_galeria or ([5, 20] if real else [100, 1000, 5000])
+
+    filas = []
+    for n in tamanos:
+        with tempfile.TemporaryDirectory() as carpeta:
+            _poblar(carpeta, referencias, n)
+
+            indice = IndiceRostros(carpeta, codificar=codificar)
+            t0 = time.perf_counter()
+            indice.sincronizar()
+            frio = (time.perf_counter() - t0) * 1000
+            identidades = len(indice.encodings)
+
+            t0 = time.perf_counter()
+            Galeria(indice.encodings, indice.nombres)
+            galeria_ms = (time.perf_counter() - t0) * 1000
+
+            sin_cambios = cronometrar(indice.sincronizar, 3)
+
+            # Reinicio del servidor: leer el índice persistido
+            def reinicio():
+                nuevo = IndiceRostros(carpeta, codificar=codificar)
+                nuevo.cargar()
+                nuevo.sincronizar()
+                Galeria(nuevo.encodings, nuevo.nombres)
+            arranque = cronometrar(reinicio, 3)
+
+            ruta_nueva = os.path.join(carpeta, "nuevo.jpg")
+            shutil.copy(os.path.join(carpeta, "persona_000000.jpg"), ruta_nueva)
+            with open(ruta_nueva, 'ab') as f:
+                f.write(b'\0')  # Contenido distinto: se codifica de nuevo
+            t0 = time.perf_counter()
+            indice.agregar(ruta_nueva)
+            agregar = (time.perf_counter() - t0) * 1000
+
+        filas.append({"caso": f"{n}_imagenes", "codificador": "real" if real else "sintetico",
+                      "identidades": identidades,
+                      "sincronizar_frio_ms": round(frio, 2),
+                      "galeria_ms": round(galeria_ms, 3),
+                      "sincronizar_sin_cambios_ms": round(min(sin_cambios), 3),
+                      "arranque_ms": round(min(arranque), 3),
+                      "agregar_uno_ms": round(agregar, 3)})
+    return filas
+
+
+class _Mensaje:
+    """Lo mínimo de paho.mqtt.client.MQTTMessage que usa alRecibirMensaje."""
+
+    def __init__(self, topic, payload, retain=0):
+        self.topic = topic
+        self.payload = payload
+        self.retain = retain
+
+
+def bench_mqtt(args):
+    """Costo de despachar mensajes MQTT a N clientes WebSocket."""
+    directorio = os.getcwd()
+    filas = []
+    with tempfile.TemporaryDirectory() as temporal:
+        os.chdir(temporal)  # ClienteMqtt escribe su archivo de estado en el directorio actual
+        try:
+            import mqtt_client as m
+
+            loop = asyncio.new_event_loop()
+            hilo = threading.Thread(target=loop.run_forever, daemon=True)
+            hilo.start()
+
+            topicos = [(m.TOPICO_ESTADO, b"ABIERTO"), (m.TOPICO_ESTADO, b"CERRADO"), (m.TOPICO_LOG, b"Apertura"),
+                       (m.TOPICO_ALERTA, b"Intento"), (f"{m.PREFIJO_TOPICO}/facial_status", b"DETECTADO")]
+            mensajes = [_Mensaje(*topicos[i % len(topicos)]) for i in range(args.mensajes)]
+
+            for n in args.clientes:
+                cliente = m.ClienteMqtt()
+                caja = cliente.agregar_caja("caja")  # Prefijo por defecto, archivos en el temporal
+                caja.difusion.iniciar(loop)
+                cliente.ingesta.iniciar()
+                entregas = [0, 0]  # mensajes, envíos (un lote cuenta como un envío)
+
+                async def enviar(carga):
+                    entregas[0] += len(carga["datos"]) if carga["tipo"] == "lote" else 1
+                    entregas[1] += 1
+
+                async def registrar():
+                    # Un cliente del hub por WebSocket, como en el endpoint /ws
+                    return [caja.registrar_cliente(enviar) for _ in range(n)]
+
+                asyncio.run_coroutine_threadsafe(registrar(), loop).result()
+
+                inicio = time.perf_counter()
+                for msg in mensajes:
+                    cliente.alRecibirMensaje(None, None, msg)
+                recibir = time.perf_counter() - inicio
+                cliente.ingesta.esperar()
+                asyncio.run_coroutine_threadsafe(caja.difusion.vaciar(), loop).result()
+                total = time.perf_counter() - inicio
+
+                inicio = time.perf_counter()
+                for i in range(args.mensajes):
+                    caja._notificar_clientes("log", "x")
+                notificar = time.perf_counter() - inicio
+                asyncio.run_coroutine_threadsafe(caja.difusion.vaciar(), loop).result()
+
+                cliente.ingesta.detener()
+                asyncio.run_coroutine_threadsafe(caja.difusion.detener(), loop).result()
+
+                filas.append({"caso": f"{n}_clientes", "mensajes": args.mensajes, "entregas": entregas[0],
+                              "envios": entregas[1],
+                              "recibir_us": round(recibir / args.mensajes * 1e6, 2),
+                              "entrega_total_us": round(total / args.mensajes * 1e6, 2),
+                              "notificar_us": round(notificar / args.mensajes * 1e6, 2),
+                              "entregas_por_s": round(entregas[0] / total, 1)})
+
+            loop.call_soon_threadsafe(loop.stop)
+            hilo.join(timeout=5)
+        finally:
+            os.chdir(directorio)
+    return filas
+
+
+def bench_historial(args):
+    """Agregar eventos al historial y paginarlo (/api/logs) según cuántos hay guardados."""
+    from historial import Historial
+
+    filas = []
+    for n in args.eventos:
+        with tempfile.TemporaryDirectory() as temporal:
+            historial = Historial(os.path.join(temporal, "historial.db"))
+            inicio = time.perf_counter()
+            for i in range(n):
+                historial.agregar("log" if i % 4 else "alerta", f"Evento {i}")
+            agregar = time.perf_counter() - inicio  # Cada evento ya queda en disco al volver
+
+            # Reinicio: el buffer se vuelve a llenar desde SQLite
+            t0 = time.perf_counter()
+            historial = Historial(os.path.join(temporal, "historial.db"))
+            arranque = (time.perf_counter() - t0) * 1000
+
+            recientes = cronometrar(lambda: historial.pagina(None, 100), args.repeticiones)
+            antiguos = cronometrar(lambda: historial.pagina(n // 2, 100), args.repeticiones)
+            reconexion = cronometrar(lambda: historial.para_reconexion(max(0, n - 20)), args.repeticiones)
+
+        filas.append({"caso": f"{n}_eventos",
+                      "agregar_us": round(agregar / n * 1e6, 2),
+                      "persistir_por_s": round(n / agregar, 1),
+                      "arranque_ms": round(arranque, 3),
+                      "pagina_recientes_ms": round(min(recientes), 3),
+                      "pagina_antigua_ms": round(min(antiguos), 3),
+                      "reconexion_ms": round(min(reconexion), 3)})
+    return filas
+
+
+# --- Comparación ---
+
+def _metricas(valor, prefijo=""):
+    """Aplana un resultado a {ruta: número} solo con las métricas comparables."""
+    planas = {}
+    if isinstance(valor, dict):
+        for clave, v in valor.items():
+            planas.update(_metricas(v, f"{prefijo}{clave}."))
+    elif isinstance(valor, list):
+        for fila in valor:
+            if isinstance(fila, dict) and "caso" in fila:
+                planas.update(_metricas({k: v for k, v in fila.items() if k != "caso"}, f"{prefijo}{fila['caso']}."))
+    elif isinstance(valor, (int, float)):
+        nombre = prefijo.rstrip(".")
+        if nombre.endswith(("_ms", "_us", "_por_s")):
+            planas[nombre] = valor
+    return planas
+
+
+def comparar(base, actual, umbral):
+    """Imprime las diferencias contra una corrida anterior. Devuelve las regresiones."""
+    previas = _metricas(base["resultados"])
+    nuevas = _metricas(actual["resultados"])
+    regresiones = []
+    print(f"\nComparación contra {base['meta'].get('commit') or base['meta'].get('fecha')} (umbral {umbral:.0%})")
+    for nombre in sorted(set(previas) & set(nuevas)):
+        antes, ahora = previas[nombre], nuevas[nombre]
+        if not antes:
+            continue
+        cambio = (ahora - antes) / antes
+        peor = cambio < -umbral if nombre.endswith("_por_s") else cambio > umbral
+        if peor:
+            regresiones.append(nombre)
+        if peor or abs(cambio) > umbral:
+            print(f"   {'REGRESION' if peor else 'mejora   '} {nombre}: {antes} -> {ahora} ({cambio:+.1%})")
+    if not regresiones:
+        print("   sin regresiones")
+    return regresiones
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--solo", nargs="+", choices=SECCIONES, default=list(SECCIONES))
+    ap.add_argument("--capturas", nargs="*", default=[], help="Archivos .mjpeg grabados del ESP32")
+    ap.add_argument("--imagenes", default="rostros", help="Carpeta con imágenes de rostros de prueba")
+    ap.add_argument("--max-frames", type=int, default=20, help="Frames de cada captura para el reconocimiento")
+    ap.add_argument("--chunk", type=int, default=4096)
+    ap.add_argument("--repeticiones", type=int, default=5)
+    ap.add_argument("--reducciones", type=int, nargs="+", default=[1, 2, 4])
+    ap.add_argument("--codificador", choices=("auto", "real", "sintetico"), default="auto",
+                    help="Encoder para cargar_referencia (sintetico mide solo el índice)")
+    ap.add_argument("--tamanos-galeria", type=int, nargs="+")
+    ap.add_argument("--clientes", type=int, nargs="+", default=[1, 10, 100, 500])
+    ap.add_argument("--mensajes", type=int, default=500)
+    ap.add_argument("--eventos", type=int, nargs="+", default=[1000, 100000])
+    ap.add_argument("--json", metavar="RUTA", help="Guardar los resultados")
+    ap.add_argument("--comparar", metavar="RUTA", help="Resultados previos para detectar regresiones")
+    ap.add_argument("--umbral", type=float, default=0.15, help="Cambio relativo tolerado al comparar")
+    args = ap.parse_args()
+
+    crudas, referencias, frames = cargar_fixtures(args.capturas, args.imagenes, args.max_frames)
+    resultados = {}
+    for seccion in args.solo:
+        inicio = time.perf_counter()
+        if seccion == "mjpeg":
+            resultados[seccion] = bench_mjpeg(crudas, args)
+        elif seccion == "reconocimiento":
+            resultados[seccion] = bench_reconocimiento(referencias, frames, args)
+        elif seccion == "cargar_referencia":
+            resultados[seccion] = bench_cargar_referencia(referencias, args)
+        elif seccion == "mqtt":
+            resultados[seccion] = bench_mqtt(args)
+        elif seccion == "historial":
+            resultados[seccion] = bench_historial(args)
+        print(f"[{seccion}] ({time.perf_counter() - inicio:.1f} s)")
+        print(json.dumps(resultados[seccion], indent=2, ensure_ascii=False))
+
+    salida = {
+        "meta": {"fecha": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": _commit(),
+                 "python": platform.python_version(), "plataforma": platform.platform(),
+                 "cpus": os.cpu_count(), "opencv": cv2.__version__,
+                 "capturas": [n for n, _ in crudas], "frames": len(frames)},
+        "resultados": resultados,
+    }
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(salida, f, indent=2, ensure_ascii=False)
+        print(f"Resultados guardados en {args.json}")
+
+    if args.comparar:
+        with open(args.comparar, 'r', encoding='utf-8') as f:
+            base = json.load(f)
+        if comparar(base, salida, args.umbral):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
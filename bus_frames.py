@@ -0,0 +1,401 @@
+"""
+Bus de frames en memoria compartida para correr uvicorn con varios workers.
+
+Un único proceso de ingesta mantiene la conexión a cada ESP32 y escribe los
+últimos JPEG en un anillo de multiprocessing.shared_memory por dispositivo,
+con un número de secuencia. Cada worker HTTP lee el anillo (IngestaCompartida)
+y reparte los frames a sus visores como si la ingesta fuera local. Los
+contadores de la cámara llegan a /metrics por un tablero compartido (TableroMetricas).
+
+El proceso de ingesta lo lanza el primer worker que encuentra libre el lock
+(INGESTA_LOCK); si ese proceso muere, otro worker lanza uno nuevo. También se
+puede correr aparte:
+
+    python -m bus_frames
+    INGESTA_COMPARTIDA=1 uvicorn main:app --workers 4
+"""
+import logging
+import multiprocessing
+import os
+import random
+import struct
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin lock entre procesos, la ingesta queda local a cada worker
+    fcntl = None
+
+from ingesta import FramesRecientes, RanuraFrame, imagen_espera
+from metricas import (CAMARA_FRAMES, CAMARA_BYTES, CAMARA_FPS, CAMARA_ULTIMO_FRAME, CAMARA_RECONEXIONES,
+                      CAMARA_RESINCRONIZACIONES, CAMARA_LARGOS_INVALIDOS)
+
+logger = logging.getLogger(__name__)
+
+# Configuración (ajustable por .env)
+INGESTA_COMPARTIDA = os.getenv("INGESTA_COMPARTIDA", "0") == "1"
+PREFIJO_MEMORIA = os.getenv("INGESTA_PREFIJO_MEMORIA", "enclave")   # Nombres de los segmentos en /dev/shm
+RUTA_LOCK = os.getenv("INGESTA_LOCK", os.path.join("datos", "ingesta.lock"))
+RANURAS = int(os.getenv("INGESTA_RANURAS", 4))
+TAMANO_RANURA = int(os.getenv("INGESTA_TAMANO_RANURA", 512 * 1024))  # Máximo de un JPEG
+SONDEO = float(os.getenv("INGESTA_SONDEO", 0.005))                  # Segundos entre lecturas de la secuencia
+REINTENTO = 2.0                                                      # Segundos entre intentos de tomar el lock
+
+_MAGIA = b"ENCLAVE1"
+# magia, ranuras, tamaño de ranura, instancia, secuencia, secuencia del último frame real
+_CABECERA = struct.Struct("<8sIIQQQ")
+_OFFSET_SECUENCIA = 24
+# secuencia, largo, real, marca (time.time())
+_RANURA = struct.Struct("<QIId")
+
+# Métricas de la cámara (ingesta.py) que cuenta el proceso de ingesta, en el orden del tablero
+_METRICAS_CAMARA = (
+    (CAMARA_FRAMES, ()), (CAMARA_BYTES, ()), (CAMARA_FPS, ()), (CAMARA_ULTIMO_FRAME, ()),
+    (CAMARA_RECONEXIONES, ("http",)), (CAMARA_RECONEXIONES, ("fin_stream",)),
+    (CAMARA_RECONEXIONES, ("timeout",)), (CAMARA_RECONEXIONES, ("error",)),
+    (CAMARA_RESINCRONIZACIONES, ()), (CAMARA_LARGOS_INVALIDOS, ()),
+)
+_MAGIA_METRICAS = b"ENCLAVEM"
+_TABLERO = struct.Struct(f"<8s{len(_METRICAS_CAMARA)}d")
+
+
+def nombre_anillo(id_dispositivo):
+    return f"{PREFIJO_MEMORIA}_{id_dispositivo}"
+
+
+def nombre_tablero():
+    # Con punto: no choca con el anillo de ningún dispositivo (ids alfanuméricos, - y _)
+    return f"{PREFIJO_MEMORIA}.metricas"
+
+
+def _abrir_memoria(nombre, crear=False, tamano=0):
+    memoria = shared_memory.SharedMemory(nombre, create=crear, size=tamano)
+    # El segmento vive más que cualquier proceso que lo use: que el resource_tracker
+    # no lo borre al terminar este proceso (bpo-39959)
+    try:
+        resource_tracker.unregister(memoria._name, "shared_memory")
+    except Exception:
+        pass
+    return memoria
+
+
+class AnilloFrames:
+    """
+    Anillo de RANURAS JPEG en memoria compartida. Un solo escritor; los lectores
+    copian el frame y verifican que la ranura no se haya reescrito mientras tanto
+    (seqlock), así nunca devuelven un JPEG mezclado.
+    """
+
+    def __init__(self, memoria):
+        self.memoria = memoria
+        magia, self.ranuras, self.tamano_ranura, self.instancia, _, _ = _CABECERA.unpack_from(memoria.buf, 0)
+        if magia != _MAGIA:
+            raise ValueError(f"{memoria.name} no es un anillo de frames")
+        self._paso = _RANURA.size + self.tamano_ranura
+
+    @classmethod
+    def crear(cls, nombre, ranuras=RANURAS, tamano_ranura=TAMANO_RANURA):
+        """Para el escritor: reutiliza el segmento si existe y es compatible (los lectores siguen mapeados)."""
+        tamano = _CABECERA.size + ranuras * (_RANURA.size + tamano_ranura)
+        try:
+            anillo = cls(_abrir_memoria(nombre))
+            if anillo.ranuras == ranuras and anillo.tamano_ranura == tamano_ranura:
+                return anillo
+            anillo.memoria.close()
+            shared_memory.SharedMemory(nombre).unlink()
+        except (FileNotFoundError, ValueError):
+            pass
+        memoria = _abrir_memoria(nombre, crear=True, tamano=tamano)
+        _CABECERA.pack_into(memoria.buf, 0, _MAGIA, ranuras, tamano_ranura, random.getrandbits(63), 0, 0)
+        return cls(memoria)
+
+    @classmethod
+    def abrir(cls, nombre):
+        """Para los lectores. FileNotFoundError si la ingesta todavía no lo creó."""
+        return cls(_abrir_memoria(nombre))
+
+    @property
+    def secuencia(self):
+        return struct.unpack_from("<Q", self.memoria.buf, _OFFSET_SECUENCIA)[0]
+
+    def _offset(self, secuencia):
+        return _CABECERA.size + (secuencia % self.ranuras) * self._paso
+
+    def publicar(self, jpg, real=True):
+        if len(jpg) > self.tamano_ranura:
+            logger.warning(f"Frame de {len(jpg)} bytes no entra en la ranura ({self.tamano_ranura}); subir INGESTA_TAMANO_RANURA")
+            return False
+        _, _, _, _, secuencia, secuencia_real = _CABECERA.unpack_from(self.memoria.buf, 0)
+        secuencia += 1
+        offset = self._offset(secuencia)
+        buf = self.memoria.buf
+        _RANURA.pack_into(buf, offset, 0, 0, 0, 0.0)  # Ranura en escritura: los lectores reintentan
+        inicio = offset + _RANURA.size
+        buf[inicio:inicio + len(jpg)] = jpg
+        _RANURA.pack_into(buf, offset, secuencia, len(jpg), int(real), time.time())
+        struct.pack_into("<QQ", buf, _OFFSET_SECUENCIA, secuencia, secuencia if real else secuencia_real)
+        return True
+
+    def _copiar(self, secuencia):
+        """JPEG de esa secuencia, (real, marca) o None si ya se reescribió."""
+        if not secuencia:
+            return None
+        offset = self._offset(secuencia)
+        buf = self.memoria.buf
+        sec, largo, real, marca = _RANURA.unpack_from(buf, offset)
+        if sec != secuencia:
+            return None
+        inicio = offset + _RANURA.size
+        jpg = bytes(buf[inicio:inicio + largo])
+        if _RANURA.unpack_from(buf, offset)[0] != secuencia:
+            return None
+        return jpg, bool(real), marca
+
+    def leer(self):
+        """(secuencia, jpg, real) del último frame publicado, o (0, None, False)."""
+        for _ in range(3):
+            secuencia = self.secuencia
+            copia = self._copiar(secuencia)
+            if copia is not None:
+                return secuencia, copia[0], copia[1]
+            if not secuencia:
+                break
+        return 0, None, False
+
+    def ultimo_real(self):
+        """(secuencia, jpg) del último frame real (no placeholder), si sigue en el anillo."""
+        secuencia_real = _CABECERA.unpack_from(self.memoria.buf, 0)[5]
+        copia = self._copiar(secuencia_real)
+        return (secuencia_real, copia[0]) if copia else (0, None)
+
+    def cerrar(self):
+        try:
+            self.memoria.close()
+        except BufferError:
+            pass  # Un memoryview todavía vivo; se libera con el proceso
+
+
+class TableroMetricas:
+    """
+    Métricas de la cámara en memoria compartida. Con la ingesta en su propio proceso
+    los contadores de ingesta.py suben allí, donde no hay /metrics: ese proceso los
+    copia al tablero cada segundo y cada worker los expone como si fueran propios.
+    """
+
+    def __init__(self, memoria):
+        self.memoria = memoria
+        if memoria.size < _TABLERO.size or bytes(memoria.buf[:len(_MAGIA_METRICAS)]) != _MAGIA_METRICAS:
+            raise ValueError(f"{memoria.name} no es un tablero de métricas")
+
+    @classmethod
+    def crear(cls, nombre):
+        """Para el proceso de ingesta: reutiliza el segmento si existe (los workers siguen mapeados)."""
+        try:
+            return cls(_abrir_memoria(nombre))
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            shared_memory.SharedMemory(nombre).unlink()
+        memoria = _abrir_memoria(nombre, crear=True, tamano=_TABLERO.size)
+        _TABLERO.pack_into(memoria.buf, 0, _MAGIA_METRICAS, *([0.0] * len(_METRICAS_CAMARA)))
+        return cls(memoria)
+
+    @classmethod
+    def abrir(cls, nombre):
+        """Para los workers. FileNotFoundError si la ingesta todavía no lo creó."""
+        return cls(_abrir_memoria(nombre))
+
+    def escribir(self):
+        valores = [familia.etiquetar(*etiquetas).valor() for familia, etiquetas in _METRICAS_CAMARA]
+        _TABLERO.pack_into(self.memoria.buf, 0, _MAGIA_METRICAS, *valores)
+
+    def leer(self):
+        return _TABLERO.unpack_from(self.memoria.buf, 0)[1:]
+
+
+class IngestaCompartida:
+    """
+    Misma interfaz que IngestaCamara (ranura, ultimo_frame, iniciar/detener),
+    pero los frames vienen del anillo que escribe el proceso de ingesta.
+    """
+
+    def __init__(self, id_dispositivo, coordinador=None):
+        self.nombre = nombre_anillo(id_dispositivo)
+        self.coordinador = coordinador
+        self.ranura = RanuraFrame()
+        self.ultimo_frame = (0, None)
+        self.recientes = FramesRecientes()
+        self.oyentes = []
+        self._anillo = None
+        self._detener = threading.Event()
+        self._hilo = None
+
+    @property
+    def ultimo_frame_bytes(self):
+        return self.ultimo_frame[1]
+
+    @property
+    def es_lider(self):
+        """True en el worker que lanzó la ingesta: ahí corre el reconocimiento continuo."""
+        return self.coordinador is not None and self.coordinador.es_lider
+
+    def iniciar(self):
+        if self._hilo and self._hilo.is_alive():
+            return
+        self._detener.clear()
+        self._hilo = threading.Thread(target=self._bucle, name=f"lector-{self.nombre}", daemon=True)
+        self._hilo.start()
+
+    def detener(self):
+        self._detener.set()
+
+    def _conectar(self):
+        try:
+            anillo = AnilloFrames.abrir(self.nombre)
+        except (FileNotFoundError, ValueError):
+            return False
+        if self._anillo is not None:
+            if anillo.instancia == self._anillo.instancia:
+                anillo.cerrar()
+                return False
+            self._anillo.cerrar()
+        self._anillo = anillo
+        return True
+
+    def _bucle(self):
+        ultima = 0
+        ultimo_cambio = time.monotonic()
+        while not self._detener.is_set():
+            if self._anillo is None and not self._conectar():
+                self.ranura.publicar(imagen_espera("ESPERANDO INGESTA..."))
+                self._detener.wait(REINTENTO)
+                continue
+
+            secuencia = self._anillo.secuencia
+            if secuencia != ultima:
+                secuencia, jpg, real = self._anillo.leer()
+                if jpg is not None:
+                    ultima = secuencia
+                    ultimo_cambio = time.monotonic()
+                    if real:
+                        self.ultimo_frame = (secuencia, jpg)
+                        self.recientes.agregar(secuencia, jpg)
+                        for oyente in self.oyentes:
+                            oyente(secuencia, jpg)
+                    self.ranura.publicar(jpg)
+            elif time.monotonic() - ultimo_cambio > 3 * REINTENTO:
+                # Sin novedades: ¿se recreó el segmento (otra instancia de la ingesta)?
+                ultimo_cambio = time.monotonic()
+                if self._conectar():
+                    ultima = 0
+            self._detener.wait(SONDEO)
+
+
+class CoordinadorIngesta:
+    """
+    Decide qué worker lanza el proceso de ingesta: el lock lo toma el propio proceso
+    de ingesta, cada worker revisa periódicamente si está libre y, si lo está, lanza uno.
+    """
+
+    def __init__(self, configuraciones, ruta_lock=RUTA_LOCK):
+        self.configuraciones = [dict(c) for c in configuraciones]
+        self.ruta_lock = ruta_lock
+        self.proceso = None
+        self._tablero = None
+        self._detener = threading.Event()
+        self._hilo = None
+
+    @property
+    def es_lider(self):
+        return self.proceso is not None and self.proceso.is_alive()
+
+    def _metrica_camara(self, i):
+        if self._tablero is None:
+            try:
+                self._tablero = TableroMetricas.abrir(nombre_tablero())
+            except (FileNotFoundError, ValueError):
+                return 0
+        return self._tablero.leer()[i]
+
+    def iniciar(self):
+        # La cámara se lee en el proceso de ingesta: su /metrics sale del tablero compartido
+        for i, (familia, etiquetas) in enumerate(_METRICAS_CAMARA):
+            familia.etiquetar(*etiquetas).calcular_con(lambda i=i: self._metrica_camara(i))
+        if self._hilo is None:
+            self._hilo = threading.Thread(target=self._bucle, name="coordinador-ingesta", daemon=True)
+            self._hilo.start()
+
+    def detener(self):
+        self._detener.set()
+        if self.proceso is not None:
+            self.proceso.terminate()
+            self.proceso.join(timeout=5)
+
+    def _lock_libre(self):
+        with open(self.ruta_lock, 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return False
+            fcntl.flock(f, fcntl.LOCK_UN)
+            return True
+
+    def _bucle(self):
+        os.makedirs(os.path.dirname(self.ruta_lock) or ".", exist_ok=True)
+        # Desfase aleatorio: con varios workers arrancando a la vez, que no lancen todos su proceso
+        self._detener.wait(random.uniform(0, 0.5))
+        while not self._detener.is_set():
+            if not self.es_lider and self._lock_libre():
+                contexto = multiprocessing.get_context("spawn")
+                self.proceso = contexto.Process(target=_proceso_ingesta, name="ingesta-camaras",
+                                                args=(self.configuraciones, self.ruta_lock, os.getpid()),
+                                                daemon=True)
+                self.proceso.start()
+                logger.info(f"Proceso de ingesta lanzado (pid {self.proceso.pid})")
+            self._detener.wait(REINTENTO)
+
+
+def _proceso_ingesta(configuraciones, ruta_lock, pid_padre=None):
+    """Cuerpo del proceso de ingesta: una IngestaCamara por dispositivo escribiendo en su anillo."""
+    from ingesta import IngestaCamara
+
+    logging.basicConfig(level=logging.INFO)
+    f = open(ruta_lock, 'a')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return  # Otro worker ganó la carrera
+    f.truncate(0)
+    f.write(str(os.getpid()))
+    f.flush()
+
+    tablero = TableroMetricas.crear(nombre_tablero())
+    ingestas = []
+    for config in configuraciones:
+        ingesta = IngestaCamara(config["stream"], anillo=AnilloFrames.crear(nombre_anillo(config["id"])))
+        ingesta.iniciar()
+        ingestas.append(ingesta)
+    logger.info(f"Ingesta compartida activa para {len(ingestas)} cámara(s)")
+
+    # Sin el worker que la lanzó, terminar: otro worker lanzará una nueva
+    while pid_padre is None or os.getppid() == pid_padre:
+        tablero.escribir()
+        time.sleep(1)
+    for ingesta in ingestas:
+        ingesta.detener()
+
+
+def main():
+    from dispositivos import leer_registro
+
+    if fcntl is None:
+        raise SystemExit("La ingesta compartida necesita fcntl (Linux/macOS)")
+    os.makedirs(os.path.dirname(RUTA_LOCK) or ".", exist_ok=True)
+    _proceso_ingesta(leer_registro(), RUTA_LOCK)
+    raise SystemExit("Ya hay un proceso de ingesta corriendo")
+
+
+if __name__ == "__main__":
+    main()
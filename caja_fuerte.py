@@ -1,151 +1,251 @@
-import cv2
-import requests
-import face_recognition
-import numpy as np
+"""
+Agente de borde de la caja fuerte: corre junto a la cámara, sin servidor web ni ventana.
+
+Uso:
+    python caja_fuerte.py                       # rostros/ y CAMERA_STREAM_URL del .env, abre por MQTT
+    python caja_fuerte.py --apertura http       # GET /abrir al ESP32 por una sesión persistente
+    python caja_fuerte.py --rostros rostros/caja1 --prefijo enclave/caja1
+
+Tres hilos que no se esperan entre sí:
+  - captura: IngestaCamara, una sola conexión al stream que siempre tiene el frame más nuevo
+  - reconocimiento: toma el último frame cuando termina con el anterior (los intermedios se descartan)
+  - apertura: manda la orden sin tocar la conexión del video
+
+La galería es el índice de la carpeta de rostros (IndiceRostros), el mismo del
+servidor: acepta varias identidades y muestras, y se recarga sola si cambia.
+
+Por defecto la orden va por MQTT (ABRIR en <prefijo>/comando, como la manda el
+servidor). Con --apertura http el firmware tiene que atender /abrir mientras
+sirve el stream (p.ej. en otro puerto: --url-abrir http://<esp32>/abrir).
+"""
+import argparse
+import logging
+import os
+import queue
+import random
+import signal
+import threading
 import time
 
-import os
+import certifi
+import paho.mqtt.client as mqtt
+import requests
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from camera_facial import CompuertaDeteccion, PROCESAR, ESPERA_APERTURA
+from galeria import Galeria
+from indice_rostros import IndiceRostros
+from ingesta import IngestaCamara
+from mqtt_client import BROKER, PUERTO, USUARIO, CONTRASEÑA, MQTT_TLS, MQTT_PROTOCOLO, PREFIJO_TOPICO
+from reconocimiento import reconocer_jpg
+
+logger = logging.getLogger("caja_fuerte")
 
 # --- CONFIGURACIÓN ---
 load_dotenv()
-CAMERA_STREAM_URL = os.getenv("CAMERA_STREAM_URL")
-
-if not CAMERA_STREAM_URL:
-    print("ERROR: CAMERA_STREAM_URL no está definido en el archivo .env")
-    exit()
-
-URL_VIDEO = CAMERA_STREAM_URL
-# Asumimos que la URL del stream termina en /stream y la del servo es /abrir
-# Si la URL es la raíz, ajustamos según sea necesario.
-# Estrategia: Reemplazar '/stream' por '/abrir' directo.
-URL_ABRIR = CAMERA_STREAM_URL.replace("/stream", "/abrir")
-
-print(f"Configuración cargada:")
-print(f" - Stream: {URL_VIDEO}")
-print(f" - Abrir:  {URL_ABRIR}")
-
-# --- CARGAR FOTO (VERSIÓN ROBUSTA) ---
-print("Cargando referencia facial...")
-mi_imagen = face_recognition.load_image_file("yo.jpg")
-
-# 1. Redimensionar si es muy grande (evita crash)
-h, w = mi_imagen.shape[:2]
-if w > 600 or h > 600:
-    print(f"La imagen es muy grande ({w}x{h}). Redimensionando a 600px...")
-    scale = 600 / max(w, h)
-    mi_imagen = cv2.resize(mi_imagen, (0, 0), fx=scale, fy=scale)
-
-# 2. Buscar cara en 4 rotaciones (evita error de foto movida)
-print("Buscando cara en diferentes rotaciones...")
-encodings = []
-for i in range(4):
-    try:
-        encodings = face_recognition.face_encodings(mi_imagen)
-    except Exception:
-        pass
-    
-    if encodings:
-        print(f"¡Cara encontrada tras rotar {i * 90} grados!")
-        break
-    
-    mi_imagen = np.rot90(mi_imagen)
-    mi_imagen = np.ascontiguousarray(mi_imagen) # Fix memoria para C++
-
-if not encodings:
-    print("ERROR: No se detectó ninguna cara en 'yo.jpg' (ni rotándola).")
-    print("Usa una foto más clara y de frente.")
-    exit()
-
-mi_encoding = encodings[0]
-
-known_face_encodings = [mi_encoding]
-known_face_names = ["PROPIETARIO"]
-
-print(f"Probando conexión a {URL_VIDEO}...")
-try:
-    # Test rápido de conexión antes de usar OpenCV (para no esperar 30s)
-    # Aumentamos a 10s porque a veces el ESP32 tarda en empezar a mandar datos
-    requests.get(URL_VIDEO, stream=True, timeout=10)
-    print("Conexión exitosa. Iniciando captura de video...")
-except Exception as e:
-    print(f"ERROR: No se pudo conectar a {URL_VIDEO}")
-    print("Verifica que el ESP32 esté encendido y en la misma red.")
-    print(f"Detalle: {e}")
-    exit()
-
-cap = cv2.VideoCapture(URL_VIDEO)
-# Buffer pequeño para reducir lag (solo 1 frame en cola)
-cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
-
-ultimo_intento = 0
-
-while True:
-    ret, frame = cap.read()
-    
-    # Si falla el video, intentamos reconectar
-    if not ret:
-        print("Perdida de señal. Reintentando...")
-        time.sleep(2)
+CAMERA_STREAM_URL = os.getenv("CAMERA_STREAM_URL", "")
+CARPETA_ROSTROS = os.getenv("AGENTE_ROSTROS", "rostros")
+APERTURA = os.getenv("AGENTE_APERTURA", "mqtt")            # "mqtt" o "http"
+FPS = float(os.getenv("AGENTE_FPS", 4))                    # Tope de frames analizados por segundo
+TIMEOUT_APERTURA = float(os.getenv("AGENTE_TIMEOUT_APERTURA", 2))
+VIGILAR_SEGUNDOS = float(os.getenv("ROSTROS_VIGILAR_SEGUNDOS", 5))
+REPORTE_SEGUNDOS = 30
+
+
+class AbridorHttp:
+    """GET a /abrir por una sesión con keep-alive y reintentos: no se abre una conexión por orden."""
+
+    def __init__(self, url, timeout=TIMEOUT_APERTURA):
+        self.url = url
+        self.timeout = timeout
+        self.sesion = requests.Session()
+        reintentos = Retry(total=2, backoff_factor=0.2, allowed_methods=["GET"])
+        adaptador = HTTPAdapter(pool_connections=1, pool_maxsize=2, max_retries=reintentos)
+        self.sesion.mount("http://", adaptador)
+        self.sesion.mount("https://", adaptador)
+
+    def abrir(self):
+        self.sesion.get(self.url, timeout=self.timeout).raise_for_status()
+
+    def cerrar(self):
+        self.sesion.close()
+
+
+class AbridorMqtt:
+    """ABRIR en <prefijo>/comando por una conexión MQTT que queda abierta (paho reconecta solo)."""
+
+    def __init__(self, prefijo=PREFIJO_TOPICO, timeout=TIMEOUT_APERTURA):
+        self.topico_comando = f"{prefijo}/comando"
+        self.topico_facial_status = f"{prefijo}/facial_status"
+        self.timeout = timeout
+        protocolo = mqtt.MQTTv311 if MQTT_PROTOCOLO == "3.1.1" else mqtt.MQTTv5
+        self.cliente = mqtt.Client(client_id=f"Enclave_Agente_{random.randint(1000, 9999)}", protocol=protocolo)
+        if MQTT_TLS:
+            self.cliente.tls_set(ca_certs=certifi.where())
+        if USUARIO:
+            self.cliente.username_pw_set(USUARIO, CONTRASEÑA)
+        self.cliente.connect_async(BROKER, PUERTO, 60)
+        self.cliente.loop_start()
+
+    def abrir(self):
+        info = self.cliente.publish(self.topico_comando, "ABRIR", qos=1)
+        info.wait_for_publish(self.timeout)
+        if not info.is_published():
+            raise TimeoutError("El broker no confirmó la orden")
+        self.cliente.publish(self.topico_facial_status, "RECONOCIDO")
+
+    def cerrar(self):
+        self.cliente.loop_stop()
+        self.cliente.disconnect()
+
+
+class AgenteCaja:
+    """Captura, reconocimiento y apertura en hilos separados, unidos por el último frame y una cola."""
+
+    def __init__(self, url_stream, carpeta_rostros, abridor, fps=FPS, espera_apertura=ESPERA_APERTURA):
+        self.abridor = abridor
+        self.intervalo = 1.0 / fps if fps > 0 else 0
+        self.espera_apertura = espera_apertura
+
+        self.ingesta = IngestaCamara(url_stream)
+        self.compuerta = CompuertaDeteccion()
+        self.indice = IndiceRostros(carpeta_rostros)
+        self.galeria = Galeria([], [])
+
+        # Una sola orden pendiente: si la apertura está ocupada, las siguientes sobran
+        self._ordenes = queue.Queue(maxsize=1)
+        self._ultima_apertura = 0
+        self._detener = threading.Event()
+        self._hilos = []
+
+        # Contadores
+        self.analizados = 0
+        self.reconocidos = 0
+        self.aperturas = 0
+
+    def _publicar_galeria(self):
+        self.galeria = Galeria(self.indice.encodings, self.indice.nombres)
+        logger.info(f"Galería: {len(set(self.indice.nombres))} identidades, {len(self.galeria)} muestras")
+
+    def cargar_galeria(self):
+        """Como SistemaFacial: índice persistente, solo se codifica lo nuevo, y después vigilancia de la carpeta."""
+        os.makedirs(self.indice.carpeta, exist_ok=True)
+        self.indice.cargar()
+        self.indice.sincronizar()
+        self._publicar_galeria()
+        if not len(self.galeria):
+            logger.warning(f"No hay rostros en {self.indice.carpeta}/. Nadie podrá abrir la caja.")
+        if VIGILAR_SEGUNDOS > 0:
+            self.indice.vigilar(VIGILAR_SEGUNDOS, self._publicar_galeria)
+
+    def iniciar(self):
+        self.ingesta.iniciar()
+        for nombre, objetivo in (("reconocimiento", self._reconocer), ("apertura", self._abrir),
+                                 ("reporte", self._reportar)):
+            hilo = threading.Thread(target=objetivo, name=nombre, daemon=True)
+            hilo.start()
+            self._hilos.append(hilo)
+
+    def detener(self):
+        self._detener.set()
+        self.ingesta.detener()
+        self.indice.detener()
+        for hilo in self._hilos:
+            hilo.join(timeout=5)
+        self.abridor.cerrar()
+
+    def _reconocer(self):
+        ultima_secuencia = 0
+        while not self._detener.is_set():
+            inicio = time.monotonic()
+            secuencia, jpg = self.ingesta.ultimo_frame
+            if jpg is None or secuencia == ultima_secuencia:
+                self._detener.wait(0.02)
+                continue
+            ultima_secuencia = secuencia
+            try:
+                self._analizar(jpg)
+            except Exception as e:
+                logger.error(f"Error en el reconocimiento: {e}")
+            self._detener.wait(max(0.0, self.intervalo - (time.monotonic() - inicio)))
+
+    def _analizar(self, jpg):
+        # Escena quieta o sin candidatos a rostro: no se corre HOG
+        if self.compuerta.evaluar(jpg) != PROCESAR:
+            return
+        self.analizados += 1
+        resultado = reconocer_jpg(jpg, self.galeria)
+        if resultado["status"] != "RECONOCIDO":
+            return
+        self.reconocidos += 1
+        ahora = time.monotonic()
+        if ahora - self._ultima_apertura < self.espera_apertura:
+            return
+        logger.info(f"¡Rostro reconocido! ({resultado['nombre']}, d={resultado['distancia']})")
         try:
-             # Verificar si sigue viva la conexión
-             requests.get(URL_VIDEO, stream=True, timeout=2)
-             cap = cv2.VideoCapture(URL_VIDEO)
-             cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
-        except:
-             pass
-        continue
-
-    # Reducimos imagen para que el reconocimiento sea RAPIDÍSIMO
-    # Usamos 0.25 (1/4 del tamaño original)
-    small_frame = cv2.resize(frame, (0, 0), fx=0.25, fy=0.25)
-    rgb_small_frame = cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB)
-
-    # Buscamos caras
-    face_locations = face_recognition.face_locations(rgb_small_frame)
-    if face_locations: # Solo si hay caras procesamos lo demás
-        face_encodings = face_recognition.face_encodings(rgb_small_frame, face_locations)
-
-        for face_encoding, face_location in zip(face_encodings, face_locations):
-            matches = face_recognition.compare_faces(known_face_encodings, face_encoding)
-            name = "Desconocido"
-            color = (0, 0, 255)
-
-            if True in matches:
-                name = "ABRIENDO..."
-                color = (0, 255, 0)
-                
-                # --- LA SOLUCIÓN AL BLOQUEO ---
-                if time.time() - ultimo_intento > 8:
-                    print("¡Rostro reconocido! Enviando orden...")
-                    
-                    # 1. SOLTAMOS LA CÁMARA para liberar al ESP32
-                    cap.release() 
-                    
-                    try:
-                        # 2. Enviamos la orden (ahora el ESP32 sí escuchará)
-                        requests.get(URL_ABRIR, timeout=2)
-                        print(">> ORDEN ENVIADA CON ÉXITO <<")
-                    except Exception as e:
-                        print(f"Error enviando orden: {e}")
-                    
-                    # 3. Guardamos tiempo y RECONECTAMOS el video
-                    ultimo_intento = time.time()
-                    cap = cv2.VideoCapture(URL_VIDEO) 
-                    # Saltamos al siguiente ciclo para que cargue la cámara
-                    continue 
-
-            # Dibujar recuadro (Visualización)
-            top, right, bottom, left = face_location
-            top *= 4; right *= 4; bottom *= 4; left *= 4
-            cv2.rectangle(frame, (left, top), (right, bottom), color, 2)
-            cv2.putText(frame, name, (left, bottom - 6), cv2.FONT_HERSHEY_DUPLEX, 0.7, (255, 255, 255), 1)
-
-    # Mostrar video
-    cv2.imshow('Caja Fuerte AI', frame)
-
-    if cv2.waitKey(1) & 0xFF == ord('q'):
-        break
-
-cap.release()
-cv2.destroyAllWindows()
\ No newline at end of file
+            self._ordenes.put_nowait(resultado["nombre"])
+            self._ultima_apertura = ahora
+        except queue.Full:
+            pass
+
+    def _abrir(self):
+        while not self._detener.is_set():
+            try:
+                nombre = self._ordenes.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            inicio = time.monotonic()
+            try:
+                self.abridor.abrir()
+                self.aperturas += 1
+                logger.info(f">> ORDEN ENVIADA ({nombre}) en {(time.monotonic() - inicio) * 1000:.0f} ms <<")
+            except Exception as e:
+                logger.error(f"Error enviando la orden de apertura: {e}")
+
+    def _reportar(self):
+        frames_antes = 0
+        while not self._detener.wait(REPORTE_SEGUNDOS):
+            frames = self.ingesta.ultimo_frame[0]
+            logger.info(f"Cámara {(frames - frames_antes) / REPORTE_SEGUNDOS:.1f} fps | analizados {self.analizados} "
+                        f"| reconocidos {self.reconocidos} | aperturas {self.aperturas} "
+                        f"| compuerta {self.compuerta.estadisticas()}")
+            frames_antes = frames
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--stream", default=CAMERA_STREAM_URL, help="URL del stream MJPEG del ESP32")
+    ap.add_argument("--rostros", default=CARPETA_ROSTROS, help="Carpeta de rostros (una imagen o subcarpeta por persona)")
+    ap.add_argument("--apertura", choices=("mqtt", "http"), default=APERTURA)
+    ap.add_argument("--prefijo", default=PREFIJO_TOPICO, help="Prefijo MQTT de la caja")
+    ap.add_argument("--url-abrir", help="URL de apertura HTTP (por defecto el stream con /stream -> /abrir)")
+    ap.add_argument("--fps", type=float, default=FPS, help="Tope de frames analizados por segundo (0 = sin tope)")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    if not args.stream:
+        ap.error("CAMERA_STREAM_URL no está definido (en el .env o con --stream)")
+
+    if args.apertura == "http":
+        abridor = AbridorHttp(args.url_abrir or args.stream.replace("/stream", "/abrir"))
+    else:
+        abridor = AbridorMqtt(args.prefijo)
+    logger.info(f"Stream: {args.stream} | Apertura: {args.apertura} | Rostros: {args.rostros}/")
+
+    agente = AgenteCaja(args.stream, args.rostros, abridor, args.fps)
+    agente.cargar_galeria()
+    agente.iniciar()
+
+    # Ctrl+C y SIGTERM (systemd, docker stop) cierran igual: hilos, stream y conexión de apertura
+    detener = threading.Event()
+    for senal in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(senal, lambda *_: detener.set())
+    detener.wait()
+    logger.info("Deteniendo agente...")
+    agente.detener()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,236 @@
+import asyncio
 import cv2
-import face_recognition
 import numpy as np
-import requests
 import time
 import os
 import logging
+import shutil
+import threading
+import uuid
 
 # Configurar logger
 logger = logging.getLogger(__name__)
 
-# Se debe importar AQUÍ para evitar ciclos, o mejor, importar dentro del método si es estricto.
-# Pero dado que systems.py importa mqtt, si mqtt importa systema... 
-# mqtt_client NO importa camera_facial. main importa ambos.
-# Así que es seguro importar mqtt_client aquí.
-from mqtt_client import manejadorMqtt, TOPICO_COMANDO, PREFIJO_TOPICO
+from ingesta import IngestaCamara
+from motor_reconocimiento import MotorReconocimiento, MotorOcupado
+from reconocimiento import reconocer_jpg
+from indice_rostros import IndiceRostros
+from importacion import ImportacionRostros, codificar_en_paralelo, limpiar_nombre
+from galeria import Galeria
+from seguimiento import SeguidorRostros
+from clips import GrabadorClips
+from variantes import VariantesVideo, frames
+from metricas import (VIDEO_VISORES, VIDEO_FRAMES, VIDEO_BYTES, RECONOCIMIENTO_ESCANEOS, RECONOCIMIENTO_DURACION,
+                      RECONOCIMIENTO_ETAPA, GALERIA_CARGA)
+
+VIGILAR_ROSTROS_SEGUNDOS = float(os.getenv("ROSTROS_VIGILAR_SEGUNDOS", 5))
+IMPORTACIONES_RECORDADAS = 10  # Estados de importaciones terminadas que se pueden consultar
+
+# Reconocimiento continuo (opcional): analiza el stream sin esperar a /api/scan-face
+RECONOCIMIENTO_CONTINUO = os.getenv("RECONOCIMIENTO_CONTINUO", "0") == "1"
+RECONOCIMIENTO_CONTINUO_FPS = float(os.getenv("RECONOCIMIENTO_CONTINUO_FPS", 2))
+APERTURA_AUTOMATICA = os.getenv("RECONOCIMIENTO_CONTINUO_ABRIR", "0") == "1"
+ESPERA_APERTURA = 8    # Segundos mínimos entre aperturas automáticas
+DURACION_CAJA = 2      # Segundos que se muestra el recuadro de un rostro
+
+# Escaneo en ráfaga: decidir entre los frames más nítidos de los últimos instantes
+RAFAGA = os.getenv("RECONOCIMIENTO_RAFAGA", "0") == "1"           # Modo por defecto de /api/scan-face
+RAFAGA_MEJORES = int(os.getenv("RAFAGA_MEJORES", 3))              # Frames que se reconocen
+RAFAGA_EDAD_MAXIMA = float(os.getenv("RAFAGA_EDAD_MAXIMA", 1.5))  # Segundos hacia atrás
+
+# Compuerta previa al detector HOG
+COMPUERTA_MOVIMIENTO = float(os.getenv("COMPUERTA_MOVIMIENTO", 0.01))  # Fracción mínima de píxeles que cambian
+COMPUERTA_CASCADE = os.getenv("COMPUERTA_CASCADE", "1") == "1"
+COMPUERTA_MAX_ESPERA = float(os.getenv("COMPUERTA_MAX_ESPERA", 2))     # Segundos máximos sin correr HOG
+
+PROCESAR = "procesar"
+SIN_MOVIMIENTO = "sin_movimiento"
+SIN_CANDIDATO = "sin_candidato"
+
+
+class CompuertaDeteccion:
+    """
+    Filtro barato antes del detector HOG. Trabaja sobre una miniatura en grises
+    (decodificada directamente a 1/2 de resolución): si la escena no cambió desde
+    el último frame procesado, o el cascade de Haar no ve ningún candidato a rostro,
+    el frame se salta. Cada COMPUERTA_MAX_ESPERA segundos se deja pasar uno igual,
+    para no depender de los falsos negativos del cascade.
+    """
+
+    ANCHO_MOVIMIENTO = 160
+    UMBRAL_PIXEL = 25
+
+    def __init__(self, umbral_movimiento=COMPUERTA_MOVIMIENTO, usar_cascade=COMPUERTA_CASCADE,
+                 max_espera=COMPUERTA_MAX_ESPERA):
+        self.umbral_movimiento = umbral_movimiento
+        self.max_espera = max_espera
+        self._referencia = None   # Miniatura del último frame procesado
+        self._ultimo_proceso = 0
+
+        self._cascade = None
+        if usar_cascade:
+            datos = getattr(cv2, "data", None)
+            ruta = os.path.join(datos.haarcascades, "haarcascade_frontalface_default.xml") if datos else ""
+            cascade = cv2.CascadeClassifier(ruta) if os.path.exists(ruta) else None
+            if cascade is None or cascade.empty():
+                logger.warning("Cascade de rostros no disponible; la compuerta solo usará movimiento")
+            else:
+                self._cascade = cascade
+
+        # Contadores
+        self.evaluados = 0
+        self.procesados = 0
+        self.sin_movimiento = 0
+        self.sin_candidato = 0
+
+    def _miniaturas(self, jpg):
+        gris = cv2.imdecode(np.frombuffer(jpg, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_2)
+        if gris is None:
+            return None, None
+        escala = self.ANCHO_MOVIMIENTO / gris.shape[1]
+        pequena = cv2.resize(gris, (0, 0), fx=escala, fy=escala, interpolation=cv2.INTER_AREA) if escala < 1 else gris
+        return gris, cv2.GaussianBlur(pequena, (5, 5), 0)
+
+    def _hay_movimiento(self, pequena):
+        if self._referencia is None or self._referencia.shape != pequena.shape:
+            return True
+        cambio = cv2.absdiff(pequena, self._referencia)
+        return np.count_nonzero(cambio > self.UMBRAL_PIXEL) >= self.umbral_movimiento * cambio.size
+
+    def _hay_candidato(self, gris):
+        caras = self._cascade.detectMultiScale(gris, scaleFactor=1.15, minNeighbors=3, minSize=(20, 20))
+        return len(caras) > 0
+
+    def evaluar(self, jpg, ahora=None):
+        """PROCESAR, SIN_MOVIMIENTO o SIN_CANDIDATO."""
+        ahora = ahora if ahora is not None else time.time()
+        self.evaluados += 1
+
+        gris, pequena = self._miniaturas(jpg)
+        if gris is not None and ahora - self._ultimo_proceso < self.max_espera:
+            if not self._hay_movimiento(pequena):
+                self.sin_movimiento += 1
+                return SIN_MOVIMIENTO
+            if self._cascade is not None and not self._hay_candidato(gris):
+                self.sin_candidato += 1
+                return SIN_CANDIDATO
+
+        self._referencia = pequena
+        self._ultimo_proceso = ahora
+        self.procesados += 1
+        return PROCESAR
+
+    def registrar(self, jpg, ahora=None):
+        """Toma el frame como referencia sin evaluarlo (fue procesado por otra vía)."""
+        self._referencia = self._miniaturas(jpg)[1]
+        self._ultimo_proceso = ahora if ahora is not None else time.time()
+
+    def estadisticas(self):
+        return {
+            "evaluados": self.evaluados,
+            "procesados": self.procesados,
+            "sin_movimiento": self.sin_movimiento,
+            "sin_candidato": self.sin_candidato,
+        }
+
+
+class PipelineReconocimiento:
+    """
+    Etapa de reconocimiento continuo. Toma el frame más nuevo de la ingesta a una
+    tasa fija, detecta rostros y los sigue entre frames (SeguidorRostros); solo los
+    rostros nuevos o que se movieron mucho pasan por el encoding de dlib.
+    """
+
+    def __init__(self, sistema, fps=RECONOCIMIENTO_CONTINUO_FPS):
+        self.sistema = sistema
+        self.intervalo = 1.0 / fps
+        self.seguidor = SeguidorRostros()
+        self.compuerta = CompuertaDeteccion()
+
+        # Contadores
+        self.frames_procesados = 0
+        self.codificaciones = 0
+
+        self._detener = threading.Event()
+        self._hilo = None
+
+    def iniciar(self):
+        if self._hilo and self._hilo.is_alive():
+            return
+        self._detener.clear()
+        self._hilo = threading.Thread(target=self._bucle, name=f"reconocimiento-{self.sistema.id}", daemon=True)
+        self._hilo.start()
+        logger.info(f"[{self.sistema.id}] Reconocimiento continuo activo a {1 / self.intervalo:.1f} fps")
+
+    def detener(self):
+        self._detener.set()
+
+    def estadisticas(self):
+        return {
+            "frames_procesados": self.frames_procesados,
+            "codificaciones": self.codificaciones,
+            "compuerta": self.compuerta.estadisticas(),
+        }
+
+    def _bucle(self):
+        ultima_secuencia = 0
+        proximo = time.monotonic()
+        while not self._detener.is_set():
+            proximo += self.intervalo
+            secuencia, jpg = self.sistema.ingesta.ultimo_frame
+            # Con varios workers solo analiza el que es dueño de la ingesta (una apertura, no N)
+            if jpg is not None and secuencia != ultima_secuencia and self.sistema.ingesta.es_lider:
+                ultima_secuencia = secuencia
+                try:
+                    self.procesar(jpg)
+                except MotorOcupado:
+                    pass  # El pool está lleno de escaneos: este frame se salta
+                except Exception as e:
+                    logger.error(f"Error en reconocimiento continuo: {e}")
+            # Si el procesamiento se atrasó, no acumular ciclos pendientes
+            proximo = max(proximo, time.monotonic())
+            self._detener.wait(proximo - time.monotonic())
+
+    def procesar(self, jpg):
+        ahora = time.time()
+        # Escena quieta o sin candidatos: las pistas actuales siguen valiendo, no se corre HOG
+        if self.compuerta.evaluar(jpg, ahora) != PROCESAR:
+            return
+
+        with RECONOCIMIENTO_DURACION.etiquetar("detectar").cronometrar():
+            cajas = self.sistema.motor.detectar(self.sistema.id, jpg)
+        pendientes = self.seguidor.actualizar(cajas, ahora)
+
+        if pendientes:
+            with RECONOCIMIENTO_DURACION.etiquetar("identificar").cronometrar():
+                coincidencias = self.sistema.motor.identificar(self.sistema.id, jpg, [p.caja for p in pendientes])
+            for pista, coincidencia in zip(pendientes, coincidencias):
+                self.seguidor.asignar(pista, coincidencia, ahora)
+            self.codificaciones += len(pendientes)
+
+        self.frames_procesados += 1
+        self.sistema._actualizar_rostros(self.seguidor.visibles(), ahora)
 
-TOPICO_FACIAL_STATUS = f"{PREFIJO_TOPICO}/facial_status"
 
 class SistemaFacial:
-    def __init__(self):
-        # Cargar variables de entorno
-        from dotenv import load_dotenv
-        load_dotenv()
+    """
+    Cámara y reconocimiento de un dispositivo: su stream, su galería (carpeta de
+    rostros) y su caja por MQTT. El pool de procesos (motor) se comparte entre dispositivos.
+    """
+
+    def __init__(self, id_dispositivo, caja, url_stream, carpeta_rostros="rostros", motor=None, ingesta=None,
+                 carpeta_clips="clips"):
+        self.id = id_dispositivo
+        self.caja = caja  # CajaMqtt de este dispositivo
 
-        self.url_stream = os.getenv("CAMERA_STREAM_URL")
+        self.url_stream = url_stream
         if not self.url_stream:
-             logger.error("CAMERA_STREAM_URL no definido en .env")
+             logger.error(f"[{self.id}] Sin URL de stream (CAMERA_STREAM_URL o registro de dispositivos)")
              self.url_stream = "" 
         
         self.url_abrir = self.url_stream.replace("/stream", "/abrir") if self.url_stream else ""
 
-        logger.info(f"Configuración Facial: Stream={self.url_stream}")
+        logger.info(f"Configuración Facial [{self.id}]: Stream={self.url_stream}")
         
         self.known_face_encodings = []
         self.known_face_names = []
@@ -43,57 +243,83 @@ class SistemaFacial:
         self.last_face_locations = []
         self.last_face_status = None # "AUTHORIZED" | "UNAUTHORIZED"
         self.mostrar_caja_hasta = 0
+        self._rostros_anotados = []     # (caja, nombre) a dibujar en ?overlay=1 hasta mostrar_caja_hasta
+        self.rostros_visibles = []      # Pistas del reconocimiento continuo
+        self._estado_facial = None      # Último estado publicado en el tópico facial_status
         
-        self.ultimo_frame_bytes = None # Cache para evitar doble request
+        # Resoluciones/calidades pedidas por los visores, transcodificadas una vez por frame
+        self.variantes = VariantesVideo()
+
+        # Única conexión al ESP32, compartida por todos los visores
+        # (o el lector del bus de frames si la ingesta corre en otro proceso)
+        self.ingesta = ingesta if ingesta is not None else IngestaCamara(self.url_stream)
 
-        # Cargar referencia al iniciar
-        self.cargar_referencia()
+        # Clips de incidentes: los últimos segundos de video quedan en memoria por si hay un evento
+        self.clips = GrabadorClips(self.id, carpeta_clips)
+        self.ingesta.oyentes.append(self.clips.agregar_frame)
+
+        # Pool de procesos para reconocer sin bloquear el event loop (compartido entre dispositivos)
+        self.motor = motor if motor is not None else MotorReconocimiento()
+        self.pipeline = PipelineReconocimiento(self)
+        # Compuerta de los escaneos manuales: solo por movimiento (el usuario pidió escanear)
+        self.compuerta_escaneo = CompuertaDeteccion(usar_cascade=False)
+        self._ultimo_escaneo = None
+
+        # Índice persistente de encodings: arrancar leyéndolo es casi instantáneo.
+        # La sincronización con la carpeta (puede codificar imágenes con dlib) corre
+        # en segundo plano después del arranque: ver iniciar()
+        self.indice = IndiceRostros(carpeta_rostros)
+        self.indice.cargar()
+        self._publicar_galeria(avisar=False)
+        self.progreso_galeria = {"estado": "pendiente", "revisados": 0, "total": 0}
+        self._calentamiento = None
+        self.importaciones = {}         # id -> ImportacionRostros (alta masiva desde .zip/.tar)
+
+    @property
+    def ultimo_frame_bytes(self):
+        # Cache del último frame real para evitar doble request
+        return self.ingesta.ultimo_frame_bytes
 
     def cargar_referencia(self):
-        # Reiniciar listas
-        self.known_face_encodings = []
-        self.known_face_names = []
-        
-        carpeta = "rostros"
+        """Sincroniza el índice de rostros: solo se codifican las imágenes nuevas o modificadas."""
+        carpeta = self.indice.carpeta
         if not os.path.exists(carpeta):
             os.makedirs(carpeta)
             logger.info(f"Carpeta '{carpeta}' creada.")
 
-        tipos = ('*.jpg', '*.jpeg', '*.png')
-        archivos = []
-        import glob
-        for ext in tipos:
-            archivos.extend(glob.glob(os.path.join(carpeta, ext)))
-        
-        if not archivos:
-            logger.warning(f"No hay imágenes en {carpeta}/. El reconocimiento no funcionará.")
-            return
+        with GALERIA_CARGA.cronometrar():
+            self.indice.sincronizar(al_progresar=self._al_progresar)
+            self._publicar_galeria()
 
-        logger.info(f"Cargando {len(archivos)} rostros de referencia...")
-        
-        for ruta in archivos:
-            try:
-                nombre = os.path.splitext(os.path.basename(ruta))[0]
-                imagen = face_recognition.load_image_file(ruta)
-                
-                # Redimensionar para velocidad
-                h, w = imagen.shape[:2]
-                if w > 800 or h > 800: # Permitir un poco más de calidad que antes
-                    scale = 800 / max(w, h)
-                    imagen = cv2.resize(imagen, (0, 0), fx=scale, fy=scale)
-                
-                # Buscar cara
-                encodings = face_recognition.face_encodings(imagen)
-                
-                if encodings:
-                    self.known_face_encodings.append(encodings[0])
-                    self.known_face_names.append(nombre)
-                    logger.info(f"Rostro cargado: {nombre}")
-                else:
-                    logger.warning(f"No se detectó rostro en {nombre}")
-                    
-            except Exception as e:
-                logger.error(f"Error cargando {ruta}: {e}")
+    def _al_progresar(self, revisados, total):
+        self.progreso_galeria = {"estado": "cargando", "revisados": revisados, "total": total}
+
+    def _calentar(self):
+        """Carga inicial de la galería en segundo plano; después, vigilancia de la carpeta."""
+        inicio = time.monotonic()
+        self.progreso_galeria = {"estado": "cargando", "revisados": 0, "total": 0}
+        try:
+            self.cargar_referencia()
+            self.progreso_galeria = dict(self.progreso_galeria, estado="listo",
+                                         segundos=round(time.monotonic() - inicio, 2))
+        except Exception as e:
+            logger.error(f"[{self.id}] Error cargando la galería: {e}")
+            self.progreso_galeria = dict(self.progreso_galeria, estado="error", error=str(e))
+        # Aplicar imágenes copiadas a mano en rostros/ sin reiniciar el servidor
+        if VIGILAR_ROSTROS_SEGUNDOS > 0:
+            self.indice.vigilar(VIGILAR_ROSTROS_SEGUNDOS, self._publicar_galeria)
+
+    def _publicar_galeria(self, avisar=True):
+        # Matriz contigua + nombres para comparar todas las caras en una sola operación
+        self.galeria = Galeria(self.indice.encodings, self.indice.nombres)
+        self.known_face_encodings = self.galeria.encodings
+        self.known_face_names = self.indice.nombres
+
+        if avisar and not self.known_face_names:
+            logger.warning(f"No hay rostros en {self.indice.carpeta}/. El reconocimiento no funcionará.")
+
+        # Los procesos del motor mapean los mismos archivos del índice (sin copiar la matriz)
+        self.motor.actualizar_galeria(self.id, self.galeria, self.indice.archivos_galeria)
 
     def registrar_usuario(self, nombre, imagen_b64=None):
         """
@@ -117,170 +343,233 @@ class SistemaFacial:
                 return {"status": "ERROR", "mensaje": "No hay video para capturar"}
             datos_imagen = self.ultimo_frame_bytes
         
-        # Sanietizar nombre
-        nombre_clean = "".join([c for c in nombre if c.isalnum() or c in (' ', '_')]).strip()
+        # Cada registro suma una muestra a la identidad (rostros/<nombre>/), no la reemplaza
+        resultado = self.agregar_muestras(nombre, [datos_imagen])
+        if resultado["status"] != "OK":
+            return resultado
+        return {"status": "OK", "mensaje": f"Usuario {resultado['nombre']} registrado"}
+
+    def agregar_muestras(self, nombre, imagenes):
+        """
+        Agrega una o varias muestras (bytes de imagen) a una identidad, en rostros/<nombre>/.
+        Las que no tienen rostro se descartan; el índice se guarda una sola vez.
+        """
+        nombre_clean = limpiar_nombre(nombre)
         if not nombre_clean:
             return {"status": "ERROR", "mensaje": "Nombre inválido"}
+        if not imagenes:
+            return {"status": "ERROR", "mensaje": "No se recibió ninguna imagen"}
 
-        ruta_destino = os.path.join("rostros", f"{nombre_clean}.jpg")
-        
+        # Se codifican fuera de rostros/ y entran a la carpeta ya indexadas (la vigilancia no las recodifica)
+        carpeta = os.path.join(self.indice.carpeta, nombre_clean)
+        entrantes = self.indice.carpeta_entrantes()
+        marca = time.strftime("%Y%m%d-%H%M%S")
+        destinos = {}
         try:
-            with open(ruta_destino, "wb") as f:
-                f.write(datos_imagen)
-            
-            # Recargar referencias para incluir al nuevo
-            self.cargar_referencia()
-            return {"status": "OK", "mensaje": f"Usuario {nombre_clean} registrado"}
+            for datos in imagenes:
+                # uuid: dos altas de la misma persona en el mismo segundo no se pisan
+                archivo = f"{marca}-{uuid.uuid4().hex[:12]}.jpg"
+                ruta = os.path.join(entrantes, archivo)
+                with open(ruta, "wb") as f:
+                    f.write(datos)
+                destinos[ruta] = os.path.join(carpeta, archivo)
+
+            vectores = codificar_en_paralelo(list(destinos))
+            validas = [r for r in destinos if vectores[r] is not None]
+            if validas:
+                self.indice.agregar_varios([destinos[r] for r in validas], {destinos[r]: vectores[r] for r in validas},
+                                           origenes={destinos[r]: r for r in validas})
+                self._publicar_galeria()
         except Exception as e:
             return {"status": "ERROR", "mensaje": f"Error guardando archivo: {e}"}
+        finally:
+            shutil.rmtree(entrantes, ignore_errors=True)
+
+        if not validas:
+            return {"status": "ERROR", "mensaje": "No se detectó ningún rostro en las imágenes"}
+        muestras = sum(1 for n in self.indice.nombres if n == nombre_clean)
+        return {"status": "OK", "nombre": nombre_clean, "recibidas": len(destinos),
+                "con_rostro": len(validas), "muestras": muestras}
 
-    def generar_frames(self):
+    def importar(self, archivo):
+        """Arranca la importación masiva de un .zip/.tar ya recibido. None si ya hay una en curso."""
+        if any(i.en_curso for i in self.importaciones.values()):
+            return None
+        importacion = ImportacionRostros(self, archivo)
+        self.importaciones[importacion.id] = importacion
+        for id_viejo in list(self.importaciones)[:-IMPORTACIONES_RECORDADAS]:
+            del self.importaciones[id_viejo]
+        importacion.iniciar()
+        return importacion
+
+    def eliminar_usuario(self, nombre):
+        """Quita una identidad de rostros/ y de la galería."""
+        if not self.indice.eliminar(nombre):
+            return {"status": "ERROR", "mensaje": f"Usuario {nombre} no encontrado"}
+        self._publicar_galeria()
+        return {"status": "OK", "mensaje": f"Usuario {nombre} eliminado"}
+
+    async def generar_frames(self, ancho=None, fps=None, calidad=None, automatico=False, overlay=False):
         """
-        Generador robusto que lee el stream HTTP byte a byte (PROXY).
-        Evita problemas de OpenCV/FFmpeg con streams remotos.
+        Suscriptor de la ingesta compartida para un visor de /video_feed.
+        Solo entrega el frame más nuevo; si el cliente es lento se saltan frames.
+        Ancho y calidad eligen una variante compartida con los demás visores (ver variantes.py);
+        con overlay se dibujan los rostros reconocidos.
         """
-        while True:
-            try:
-                if not self.url_stream:
-                    yield self._imagen_espera("URL NO DEFINIDA")
-                    time.sleep(2)
-                    continue
-
-                res = requests.get(self.url_stream, stream=True, timeout=5)
-
-                if res.status_code != 200:
-                    yield self._imagen_espera(f"ERROR {res.status_code}")
-                    time.sleep(2)
-                    continue
-
-                bytes_buffer = b''
-                for chunk in res.iter_content(chunk_size=4096):
-                    if not chunk: break
-                    bytes_buffer += chunk
-                    
-                    # Buscar inicio (0xFF 0xD8)
-                    a = bytes_buffer.find(b'\xff\xd8')
-                    if a == -1:
-                        # Limpieza si no encontramos inicio tras leer mucho
-                        if len(bytes_buffer) > 100000: bytes_buffer = b''
-                        continue
-                        
-                    # Buscar fin (0xFF 0xD9) SIEMPRE DESPUES DEL INICIO
-                    b = bytes_buffer.find(b'\xff\xd9', a)
-                    
-                    if b != -1:
-                        jpg = bytes_buffer[a:b+2]
-                        
-                        # GUARDAR CACHE para uso de verificar_identidad
-                        self.ultimo_frame_bytes = jpg
-                        
-                        # MANTENER SINCRONIZACIÓN:
-                        bytes_buffer = bytes_buffer[b+2:]
-                        
-                        # PREVENIR LAG:
-                        if len(bytes_buffer) > 65536: # 64KB safety limit
-                            bytes_buffer = b''
-                        
-                        yield (b'--frame\r\n'
-                               b'Content-Type: image/jpeg\r\n\r\n' + jpg + b'\r\n')
-                else:
-                     # Si leemos y leemos y no encontramos fin de frame, quizás estamos desincronizados
-                     if len(bytes_buffer) > 100000:
-                         bytes_buffer = b''
-                         yield self._imagen_espera("RESINCRONIZANDO...")
-            
-            except requests.exceptions.ReadTimeout:
-                logger.warning("Stream pausado (Posiblemente ESP32 ocupado)...")
-                yield self._imagen_espera("ESPERANDO... (TIMEOUT)")
-                time.sleep(1)
-            except Exception as e:
-                logger.error(f"Error stream: {e}")
-                yield self._imagen_espera("INTENTANDO RECONECTAR...")
-                time.sleep(2)
-            finally:
-                try:
-                    res.close()
-                except: pass
+        self.ingesta.iniciar()
+        fuente = frames(self.ingesta.ranura, self.variantes, ancho, fps, calidad, automatico,
+                        self.anotaciones if overlay else None)
+        VIDEO_VISORES.inc()
+        try:
+            async for jpg in fuente:
+                VIDEO_FRAMES.inc()
+                VIDEO_BYTES.inc(len(jpg))
+                yield (b'--frame\r\n'
+                       b'Content-Type: image/jpeg\r\n\r\n' + jpg + b'\r\n')
+        finally:
+            VIDEO_VISORES.dec()
+            await fuente.aclose()  # Libera la variante ya, no cuando lo recolecte el GC
 
     def verificar_identidad(self):
         """
         Verifica identidad usando el ÚLTIMO FRAME del stream activo.
         NO abre una nueva conexión para evitar bloquear al ESP32.
+        Versión síncrona (bloquea el hilo que la llama); la API usa verificar_identidad_async.
         """
         if not self.ultimo_frame_bytes:
              return {"status": "ERROR", "mensaje": "No hay video. Espere..."}
 
         try:
-            jpg_capturado = self.ultimo_frame_bytes
-
-            # 2. Procesar con IA
-            frame_bgr = cv2.imdecode(np.frombuffer(jpg_capturado, np.uint8), cv2.IMREAD_COLOR)
-            if frame_bgr is None:
-                return {"status": "ERROR", "mensaje": "Imagen corrupta"}
-
-            # --- MEJORA DE IMAGEN (CLAHE) ---
-            # Para corregir imagenes "opacas" o con mala luz
-            lab = cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2LAB)
-            l, a, b = cv2.split(lab)
-            clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8,8))
-            cl = clahe.apply(l)
-            limg = cv2.merge((cl,a,b))
-            frame_enhanced = cv2.cvtColor(limg, cv2.COLOR_LAB2BGR)
-            # --------------------------------
-
-            # Reducir y Convertir (Usamos la imagen mejorada)
-            small = cv2.resize(frame_enhanced, (0, 0), fx=0.5, fy=0.5) 
-            rgb = cv2.cvtColor(small, cv2.COLOR_BGR2RGB)
-            
-            face_locs = face_recognition.face_locations(rgb)
-            
-            if not face_locs:
-                # Intentar una vez mas con la imagen original sin filtro (backup)
-                small_raw = cv2.resize(frame_bgr, (0, 0), fx=0.5, fy=0.5)
-                rgb_raw = cv2.cvtColor(small_raw, cv2.COLOR_BGR2RGB)
-                face_locs = face_recognition.face_locations(rgb_raw)
-
-            if not face_locs:
-                 return {"status": "NO_DETECTADO", "mensaje": "No se distingue un rostro claro. Acerquece a la cámara."}
-
-            # Identificar
-            face_encs = face_recognition.face_encodings(rgb, face_locs)
-            es_propietario = False
-            
-            for face_encoding in face_encs:
-                matches = face_recognition.compare_faces(self.known_face_encodings, face_encoding)
-                if True in matches:
-                    es_propietario = True
-                    break
-            
-            if es_propietario:
-                logger.info("¡ROSTRO RECONOCIDO EN ESCANEO MANUAL!")
-                try:
-                    manejadorMqtt.publicar(TOPICO_COMANDO, "ABRIR")
-                    manejadorMqtt.publicar(TOPICO_FACIAL_STATUS, "RECONOCIDO")
-                except: pass
-                return {"status": "RECONOCIDO", "mensaje": "Identidad Verificada. Abriendo..."}
-            else:
-                try:
-                    manejadorMqtt.publicar(TOPICO_FACIAL_STATUS, "DETECTADO")
-                except: pass
-                return {"status": "NO_AUTORIZADO", "mensaje": "Rostro no autorizado"}
-
+            resultado = reconocer_jpg(self.ultimo_frame_bytes, self.galeria)
         except Exception as e:
             logger.error(f"Error en verificación manual: {e}")
             return {"status": "ERROR", "mensaje": str(e)}
+        self._aplicar_resultado(resultado)
+        return resultado
+
+    async def verificar_identidad_async(self, rafaga=None):
+        """
+        Igual que verificar_identidad, pero el cálculo corre en el pool de procesos.
+        Con `rafaga` decide entre los frames más nítidos de los últimos instantes
+        (ver reconocimiento.reconocer_rafaga) en vez de jugarse a un solo frame.
+        """
+        if not self.ultimo_frame_bytes:
+             RECONOCIMIENTO_ESCANEOS.etiquetar("SIN_VIDEO").inc()
+             return {"status": "ERROR", "mensaje": "No hay video. Espere..."}
+
+        jpg = self.ultimo_frame_bytes
+
+        # Si el último escaneo no encontró rostro y la escena no cambió, no repetir HOG (dos pasadas)
+        anterior = self._ultimo_escaneo
+        if anterior and anterior["status"] == "NO_DETECTADO":
+            if self.compuerta_escaneo.evaluar(jpg) == SIN_MOVIMIENTO:
+                RECONOCIMIENTO_ESCANEOS.etiquetar("REPETIDO").inc()
+                return anterior
+        else:
+            self.compuerta_escaneo.registrar(jpg)
+
+        rafaga = RAFAGA if rafaga is None else rafaga
+        with RECONOCIMIENTO_DURACION.etiquetar("rafaga" if rafaga else "escaneo").cronometrar():
+            if rafaga:
+                # Elegir los más nítidos decodifica en gris reducido cada frame una vez: fuera del loop
+                mejores = await asyncio.to_thread(self.ingesta.recientes.mas_nitidos, RAFAGA_MEJORES,
+                                                  RAFAGA_EDAD_MAXIMA)
+                jpgs = [jpg for _, jpg, _ in mejores] or [jpg]
+                resultado = await self.motor.verificar_rafaga(self.id, jpgs, al_resultado=self._aplicar_resultado)
+            else:
+                resultado = await self.motor.verificar(self.id, jpg, al_resultado=self._aplicar_resultado)
+        RECONOCIMIENTO_ESCANEOS.etiquetar(resultado["status"]).inc()
+        return resultado
+
+    def _aplicar_resultado(self, resultado):
+        """Publica por MQTT las consecuencias de un escaneo."""
+        self._ultimo_escaneo = resultado
+        self.clips.evento(resultado["status"], {"nombre": resultado.get("nombre"),
+                                                "distancia": resultado.get("distancia")})
+        for etapa, ms in resultado.get("tiempos_ms", {}).items():
+            RECONOCIMIENTO_ETAPA.etiquetar(etapa).observar(ms / 1000)
+        if resultado.get("rostros"):
+            self._mostrar_rostros([(r["caja"], r["nombre"]) for r in resultado["rostros"]], time.time())
+        if resultado["status"] == "RECONOCIDO":
+            logger.info(f"¡ROSTRO RECONOCIDO EN ESCANEO MANUAL! ({resultado['nombre']}, d={resultado['distancia']})")
+            try:
+                self.caja.publicar(self.caja.topico_comando, "ABRIR")
+                self.caja.publicar(self.caja.topico_facial_status, "RECONOCIDO")
+            except: pass
+        elif resultado["status"] == "NO_AUTORIZADO":
+            try:
+                self.caja.publicar(self.caja.topico_facial_status, "DETECTADO")
+            except: pass
+
+    def _actualizar_rostros(self, pistas, ahora):
+        """Aplica el resultado del reconocimiento continuo: feedback visual, MQTT y WebSocket."""
+        if any(p.nombre for p in pistas):
+            estado = "RECONOCIDO"
+        elif pistas:
+            estado = "DETECTADO"
+        else:
+            estado = "NO_DETECTADO"
 
-    def _imagen_espera(self, mensaje):
-        # Fondo Gris Azulado para distinguir de "OFF"
-        blank = np.full((480, 640, 3), (50, 50, 50), np.uint8) 
-        cv2.putText(blank, "SISTEMA DE VIDEO", (180, 200), cv2.FONT_HERSHEY_DUPLEX, 0.8, (200, 200, 200), 1)
-        # Centrar texto aprox
-        cv2.putText(blank, mensaje, (50, 250), cv2.FONT_HERSHEY_DUPLEX, 0.8, (100, 100, 255), 2)
-        ret, buf = cv2.imencode('.jpg', blank)
-        return (b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + buf.tobytes() + b'\r\n')
+        rostros = [p.a_dict() for p in pistas]
+        cambio_rostros = rostros != self.rostros_visibles
+
+        self.ultimo_reconocimiento = ahora
+        self.rostros_visibles = rostros
+        if pistas:
+            self._mostrar_rostros([(p.caja, p.nombre) for p in pistas], ahora)
+
+        # Solo se publican las transiciones, no cada frame analizado
+        if estado != self._estado_facial:
+            self._estado_facial = estado
+            try:
+                self.caja.publicar(self.caja.topico_facial_status, estado)
+            except: pass
+
+        if estado == "RECONOCIDO" and APERTURA_AUTOMATICA and ahora - self.ultimo_apertura > ESPERA_APERTURA:
+            logger.info(f"¡ROSTRO RECONOCIDO EN VIGILANCIA CONTINUA! ({', '.join(p.nombre for p in pistas if p.nombre)})")
+            self.ultimo_apertura = ahora
+            try:
+                self.caja.publicar(self.caja.topico_comando, "ABRIR")
+            except: pass
+
+        if cambio_rostros:
+            self.caja._notificar_clientes("rostros", rostros)
+
+    def _mostrar_rostros(self, rostros, ahora):
+        """Feedback visual: cajas y nombres que se dibujan durante DURACION_CAJA segundos."""
+        self.last_face_locations = [caja for caja, _ in rostros]
+        self.last_face_status = "AUTHORIZED" if any(nombre for _, nombre in rostros) else "UNAUTHORIZED"
+        self._rostros_anotados = rostros
+        self.mostrar_caja_hasta = ahora + DURACION_CAJA
+
+    def anotaciones(self):
+        """(caja, nombre) vigentes para el overlay; vacío si ya pasó su tiempo."""
+        if time.time() > self.mostrar_caja_hasta:
+            return []
+        return self._rostros_anotados
+
+    def estadisticas(self):
+        """Contadores de frames analizados frente a frames saltados por la compuerta."""
+        return {
+            "continuo": self.pipeline.estadisticas() if RECONOCIMIENTO_CONTINUO else None,
+            "escaneo": self.compuerta_escaneo.estadisticas(),
+        }
+
+    def iniciar(self):
+        # El motor compartido lo arranca y detiene el registro de dispositivos
+        self.ingesta.iniciar()
+        if RECONOCIMIENTO_CONTINUO:
+            self.pipeline.iniciar()
+        if self._calentamiento is None:
+            self._calentamiento = threading.Thread(target=self._calentar, name=f"galeria-{self.id}", daemon=True)
+            self._calentamiento.start()
+
+    def detener(self):
+        self.ingesta.detener()
+        self.pipeline.detener()
+        self.indice.detener()
+        self.clips.detener()
 
     # Métodos legacy
     def iniciar_escaneo(self, duracion=20): pass
     def detener_escaneo(self, duracion=20): pass
-
-sistema_facial = SistemaFacial()
@@ -0,0 +1,349 @@
+"""
+Clips de incidentes: ante un evento (escaneo NO_AUTORIZADO, alerta por MQTT...)
+se guardan los segundos previos y posteriores del video, sin decodificar ni
+recodificar nada: los mismos bytes JPEG que mandó la cámara.
+
+En disco, cada clip es una carpeta:
+
+    clips/20260101-120000-NO_AUTORIZADO/
+        clip.json       metadata (evento, inicio, fin, frames, bytes, segmentos)
+        000.mjpeg       JPEGs concatenados tal cual (ffmpeg -f mjpeg los lee)
+        001.mjpeg       ... un segmento nuevo cada SEGMENTO_BYTES
+        indice.bin      un registro INDICE por frame: marca, segmento, offset, largo
+
+El índice permite ir a cualquier instante sin recorrer los segmentos, y los
+segmentos se sirven con Range (ver /api/clips en main.py).
+"""
+import asyncio
+import collections
+import contextlib
+import json
+import logging
+import os
+import queue
+import re
+import shutil
+import struct
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Configuración (ajustable por .env)
+EVENTOS = [e.strip() for e in os.getenv("CLIPS_EVENTOS", "NO_AUTORIZADO,alerta").split(",") if e.strip()]
+PRE_ROLL = float(os.getenv("CLIPS_PRE_SEGUNDOS", 5))
+POST_ROLL = float(os.getenv("CLIPS_POST_SEGUNDOS", 10))
+DURACION_MAXIMA = float(os.getenv("CLIPS_DURACION_MAXIMA", 120))   # Eventos seguidos extienden el clip hasta acá
+MAX_BYTES = int(os.getenv("CLIPS_MAX_BYTES", 500 * 1024 * 1024))    # Retención por dispositivo
+SEGMENTO_BYTES = int(os.getenv("CLIPS_SEGMENTO_BYTES", 8 * 1024 * 1024))
+BUFFER_MAX_BYTES = int(os.getenv("CLIPS_BUFFER_MAX_BYTES", 32 * 1024 * 1024))
+
+# marca (epoch, float64), segmento (uint16), offset y largo (uint32): 18 bytes por frame
+INDICE = struct.Struct("<dHII")
+_DTYPE_INDICE = np.dtype([("marca", "<f8"), ("segmento", "<u2"), ("offset", "<u4"), ("largo", "<u4")])
+_ID_VALIDO = re.compile(r"^[\w\-]+$")
+
+
+class BufferFrames:
+    """Anillo en memoria de los últimos segundos de frames (marca, jpg), acotado también en bytes."""
+
+    def __init__(self, segundos=PRE_ROLL, max_bytes=BUFFER_MAX_BYTES):
+        self.segundos = segundos
+        self.max_bytes = max_bytes
+        self._frames = collections.deque()
+        self.bytes = 0
+
+    def agregar(self, marca, jpg):
+        self._frames.append((marca, jpg))
+        self.bytes += len(jpg)
+        while self._frames and (marca - self._frames[0][0] > self.segundos or self.bytes > self.max_bytes):
+            self.bytes -= len(self._frames.popleft()[1])
+
+    def desde(self, marca):
+        return [f for f in self._frames if f[0] >= marca]
+
+    def __len__(self):
+        return len(self._frames)
+
+
+class _ClipEnCurso:
+    def __init__(self, id_clip, carpeta, evento, detalle, marca, inicio, fin):
+        self.id = id_clip
+        self.carpeta = carpeta
+        self.inicio = inicio    # Primer frame del pre-roll
+        self.fin = fin
+        self.eventos = [{"evento": evento, "detalle": detalle, "marca": marca}]
+
+
+class GrabadorClips:
+    """
+    Graba clips de un dispositivo. `agregar_frame` es un oyente de la ingesta (se
+    llama con cada frame real, en el hilo de la ingesta: solo encola). La escritura
+    a disco y la retención corren en un hilo propio.
+    """
+
+    def __init__(self, id_dispositivo, carpeta, eventos=EVENTOS, pre=PRE_ROLL, post=POST_ROLL,
+                 max_bytes=MAX_BYTES, segmento_bytes=SEGMENTO_BYTES):
+        self.id = id_dispositivo
+        self.carpeta = carpeta
+        self.eventos = set(eventos)
+        self.pre = pre
+        self.post = post
+        self.max_bytes = max_bytes
+        self.segmento_bytes = segmento_bytes
+
+        self.buffer = BufferFrames(pre)
+        self._lock = threading.Lock()
+        self._activo = None
+        self._cola = queue.Queue()
+        self._hilo = None
+
+    def agregar_frame(self, secuencia, jpg):
+        marca = time.time()
+        with self._lock:
+            self.buffer.agregar(marca, jpg)
+            if self._activo is not None:
+                if marca <= self._activo.fin:
+                    self._cola.put(("frame", self._activo, marca, jpg))
+                else:
+                    self._cerrar_activo()
+
+    def evento(self, tipo, detalle=None):
+        """Dispara (o extiende) un clip si el tipo de evento está configurado. Devuelve el id del clip o None."""
+        if tipo not in self.eventos:
+            return None
+        ahora = time.time()
+        with self._lock:
+            clip = self._activo
+            if clip is not None and ahora <= clip.fin:
+                # Otro evento durante la grabación: mismo clip, un poco más largo
+                clip.fin = min(ahora + self.post, clip.inicio + DURACION_MAXIMA)
+                clip.eventos.append({"evento": tipo, "detalle": detalle, "marca": ahora})
+                return clip.id
+            if clip is not None:
+                # Vencido pero todavía sin cerrar (no llegó otro frame): se cierra antes de reemplazarlo
+                self._cerrar_activo()
+
+            previos = self.buffer.desde(ahora - self.pre)
+            inicio = previos[0][0] if previos else ahora
+            clip = self._activo = _ClipEnCurso(self._nuevo_id(tipo, ahora), self.carpeta, tipo, detalle,
+                                               ahora, inicio, ahora + self.post)
+            self._cola.put(("abrir", clip))
+            for marca, jpg in previos:
+                self._cola.put(("frame", clip, marca, jpg))
+        self.iniciar()
+        logger.info(f"[{self.id}] Grabando clip {clip.id} ({tipo})")
+        return clip.id
+
+    def _cerrar_activo(self):
+        # Con self._lock tomado
+        self._cola.put(("cerrar", self._activo))
+        self._activo = None
+
+    def _nuevo_id(self, tipo, marca):
+        base = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(marca))}-{re.sub(r'[^A-Za-z0-9_]', '', tipo)}"
+        id_clip, n = base, 1
+        while os.path.exists(os.path.join(self.carpeta, id_clip)):
+            n += 1
+            id_clip = f"{base}-{n}"
+        return id_clip
+
+    def iniciar(self):
+        if self._hilo is None or not self._hilo.is_alive():
+            self._hilo = threading.Thread(target=self._escribir, name=f"clips-{self.id}", daemon=True)
+            self._hilo.start()
+
+    def detener(self):
+        with self._lock:
+            if self._activo is not None:
+                self._cerrar_activo()
+        self._cola.put(None)
+
+    # --- Hilo de escritura ---
+
+    def _escribir(self):
+        escrituras = {}  # id -> _EscrituraClip
+        while True:
+            try:
+                tarea = self._cola.get(timeout=1)
+            except queue.Empty:
+                # Sin frames (cámara caída): el clip igual termina a su hora
+                with self._lock:
+                    if self._activo is not None and time.time() > self._activo.fin:
+                        self._cerrar_activo()
+                continue
+            if tarea is None:
+                break
+            try:
+                accion, clip = tarea[0], tarea[1]
+                if accion == "abrir":
+                    escrituras[clip.id] = _EscrituraClip(clip, self.id, self.segmento_bytes)
+                elif accion == "frame" and clip.id in escrituras:
+                    escrituras[clip.id].agregar(tarea[2], tarea[3])
+                elif accion == "cerrar" and clip.id in escrituras:
+                    escrituras.pop(clip.id).cerrar()
+                    self._aplicar_retencion(clip.id)
+            except Exception as e:
+                logger.error(f"[{self.id}] Error escribiendo clip: {e}")
+        for escritura in escrituras.values():
+            escritura.cerrar()
+
+    def _aplicar_retencion(self, actual=None):
+        """Borra los clips más viejos mientras el total supere max_bytes (nunca el recién cerrado)."""
+        clips = listar(self.carpeta)
+        total = sum(c.get("bytes", 0) for c in clips)
+        for clip in reversed(clips):  # Del más viejo al más nuevo
+            if total <= self.max_bytes:
+                break
+            activo = self._activo
+            if clip["id"] == actual or (activo is not None and clip["id"] == activo.id):
+                continue
+            shutil.rmtree(os.path.join(self.carpeta, clip["id"]), ignore_errors=True)
+            total -= clip.get("bytes", 0)
+            logger.info(f"[{self.id}] Clip {clip['id']} borrado por retención")
+
+
+class _EscrituraClip:
+    """Archivos de un clip mientras se graba. Los frames se ven en el índice apenas se escriben."""
+
+    def __init__(self, clip, id_dispositivo, segmento_bytes):
+        self.clip = clip
+        self.dispositivo = id_dispositivo
+        self.segmento_bytes = segmento_bytes
+        self.ruta = os.path.join(clip.carpeta, clip.id)
+        os.makedirs(self.ruta, exist_ok=True)
+        self.indice = open(os.path.join(self.ruta, "indice.bin"), "ab")
+        self.segmento = -1
+        self.archivo = None
+        self.offset = 0
+        self.frames = 0
+        self.bytes = 0
+        self.ultima_marca = clip.inicio
+        self._nuevo_segmento()
+        self._guardar_meta(en_curso=True)
+
+    def _nuevo_segmento(self):
+        if self.archivo is not None:
+            self.archivo.close()
+        self.segmento += 1
+        self.archivo = open(os.path.join(self.ruta, f"{self.segmento:03d}.mjpeg"), "ab")
+        self.offset = 0
+
+    def agregar(self, marca, jpg):
+        if self.offset and self.offset + len(jpg) > self.segmento_bytes:
+            self._nuevo_segmento()
+        self.archivo.write(jpg)
+        self.archivo.flush()
+        self.indice.write(INDICE.pack(marca, self.segmento, self.offset, len(jpg)))
+        self.indice.flush()
+        self.offset += len(jpg)
+        self.frames += 1
+        self.bytes += len(jpg)
+        self.ultima_marca = marca
+
+    def cerrar(self):
+        self.archivo.close()
+        self.indice.close()
+        self._guardar_meta(en_curso=False)
+        logger.info(f"[{self.dispositivo}] Clip {self.clip.id}: {self.frames} frames, "
+                    f"{self.bytes / 1024:.0f} KB, {self.ultima_marca - self.clip.inicio:.1f} s")
+
+    def _guardar_meta(self, en_curso):
+        meta = {"id": self.clip.id, "dispositivo": self.dispositivo, "eventos": self.clip.eventos,
+                "inicio": self.clip.inicio, "fin": self.ultima_marca,
+                "duracion": round(self.ultima_marca - self.clip.inicio, 3),
+                "frames": self.frames, "bytes": self.bytes, "segmentos": self.segmento + 1, "en_curso": en_curso}
+        temporal = os.path.join(self.ruta, "clip.json.tmp")
+        with open(temporal, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(temporal, os.path.join(self.ruta, "clip.json"))
+
+
+# --- Lectura (API) ---
+
+def listar(carpeta):
+    """Metadata de los clips de una carpeta, del más nuevo al más viejo."""
+    clips = []
+    try:
+        nombres = os.listdir(carpeta)
+    except FileNotFoundError:
+        return []
+    for nombre in nombres:
+        try:
+            with open(os.path.join(carpeta, nombre, "clip.json"), encoding="utf-8") as f:
+                clips.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    clips.sort(key=lambda c: c.get("inicio", 0), reverse=True)
+    return clips
+
+
+class Clip:
+    """Un clip en disco: metadata, índice (array numpy de INDICE) y lectura de frames sueltos."""
+
+    def __init__(self, carpeta, id_clip):
+        if not _ID_VALIDO.match(id_clip):
+            raise KeyError(id_clip)
+        self.ruta = os.path.join(carpeta, id_clip)
+        try:
+            with open(os.path.join(self.ruta, "clip.json"), encoding="utf-8") as f:
+                self.meta = json.load(f)
+            with open(os.path.join(self.ruta, "indice.bin"), "rb") as f:
+                datos = f.read()
+        except (OSError, ValueError):
+            raise KeyError(id_clip)
+        # Un registro a medio escribir (clip en curso) no cuenta
+        self.indice = np.frombuffer(datos[:len(datos) - len(datos) % INDICE.size], dtype=_DTYPE_INDICE)
+
+    def __len__(self):
+        return len(self.indice)
+
+    def ruta_segmento(self, segmento):
+        ruta = os.path.join(self.ruta, f"{int(segmento):03d}.mjpeg")
+        if not os.path.exists(ruta):
+            raise KeyError(segmento)
+        return ruta
+
+    def posicion(self, segundos):
+        """Índice del frame en `segundos` desde el inicio del clip (el último que no lo supera)."""
+        marca = self.indice["marca"][0] + segundos if len(self) else 0
+        return max(0, int(np.searchsorted(self.indice["marca"], marca, side="right")) - 1)
+
+    def frame(self, i):
+        registro = self.indice[i]
+        with open(self.ruta_segmento(registro["segmento"]), "rb") as f:
+            f.seek(int(registro["offset"]))
+            return f.read(int(registro["largo"]))
+
+    def resumen(self):
+        """Metadata más, por segmento, su rango de tiempo: alcanza para pedir Range de un segmento."""
+        segmentos = []
+        if len(self):
+            inicio = self.indice["marca"][0]
+            for n in np.unique(self.indice["segmento"]):
+                filas = self.indice[self.indice["segmento"] == n]
+                segmentos.append({"segmento": int(n), "desde": round(float(filas["marca"][0] - inicio), 3),
+                                  "hasta": round(float(filas["marca"][-1] - inicio), 3), "frames": len(filas),
+                                  "bytes": int(filas["offset"][-1] + filas["largo"][-1])})
+        return dict(self.meta, frames=len(self), segmentos=segmentos)
+
+    async def reproducir(self, desde=0.0, velocidad=1.0):
+        """JPEGs desde el segundo `desde`, respetando los tiempos originales (divididos por `velocidad`)."""
+        reloj = time.monotonic()
+        i = self.posicion(desde)
+        if i >= len(self):
+            return
+        origen = float(self.indice["marca"][i])
+        with contextlib.ExitStack() as pila:
+            archivos = {}
+            for registro in self.indice[i:]:
+                espera = (float(registro["marca"]) - origen) / velocidad - (time.monotonic() - reloj)
+                if espera > 0:
+                    await asyncio.sleep(espera)
+                segmento = int(registro["segmento"])
+                if segmento not in archivos:
+                    archivos[segmento] = pila.enter_context(open(self.ruta_segmento(segmento), "rb"))
+                archivos[segmento].seek(int(registro["offset"]))
+                yield archivos[segmento].read(int(registro["largo"]))
@@ -0,0 +1,175 @@
+import asyncio
+import collections
+import logging
+import os
+
+from metricas import WS_MENSAJES, WS_DESCARTADOS, WS_LOTES
+
+logger = logging.getLogger(__name__)
+
+# Configuración (ajustable por .env)
+COLA_MAXIMA = int(os.getenv("WS_COLA_MAXIMA", 100))      # Mensajes pendientes por cliente
+POLITICA = os.getenv("WS_POLITICA", "descartar")          # "descartar" (los más viejos) o "desconectar"
+LOTE_MAXIMO = int(os.getenv("WS_LOTE_MAXIMO", 50))        # 1 = sin lotes
+
+# Tipos donde solo importa el último valor: uno nuevo reemplaza al pendiente
+COALESCIBLES = {"estado", "facial_status", "rostros"}
+
+
+class ClienteDifusion:
+    """
+    Un WebSocket suscripto: cola acotada propia y una única tarea que envía.
+    Si el navegador se atrasa, los mensajes pendientes salen juntos en un lote.
+    """
+
+    def __init__(self, hub, enviar, cerrar=None):
+        self.hub = hub
+        self.enviar = enviar    # async enviar(dict)
+        self.cerrar = cerrar    # async cerrar(), para la política "desconectar"
+        self.cola = collections.deque()
+        self.activo = True
+        self.enviando = False
+        self.descartados = 0
+        self._hay_datos = asyncio.Event()
+        self._tarea = asyncio.get_running_loop().create_task(self._bucle())
+
+    def encolar(self, tipo, datos, id_evento=None):
+        """Agrega un mensaje aplicando la política de desborde. Corre en el loop."""
+        if not self.activo:
+            return
+        if tipo in COALESCIBLES:
+            for i, mensaje in enumerate(self.cola):
+                if mensaje["tipo"] == tipo:
+                    del self.cola[i]
+                    WS_DESCARTADOS.etiquetar("reemplazado").inc()
+                    break
+        elif len(self.cola) >= self.hub.cola_maxima:
+            if self.hub.politica == "desconectar":
+                WS_DESCARTADOS.etiquetar("desconectado").inc(len(self.cola))
+                self.desconectar()
+                return
+            self._descartar_mas_viejo()
+
+        mensaje = {"tipo": tipo, "datos": datos}
+        if id_evento is not None:
+            mensaje["id"] = id_evento  # Eventos del historial: el navegador recuerda el último visto
+        self.cola.append(mensaje)
+        self._hay_datos.set()
+
+    def _descartar_mas_viejo(self):
+        # Primero un mensaje descartable; los coalescibles (el último estado) se conservan
+        for i, mensaje in enumerate(self.cola):
+            if mensaje["tipo"] not in COALESCIBLES:
+                del self.cola[i]
+                break
+        else:
+            self.cola.popleft()
+        self.descartados += 1
+        WS_DESCARTADOS.etiquetar("desborde").inc()
+
+    async def _bucle(self):
+        try:
+            while True:
+                await self._hay_datos.wait()
+                if not self.cola:
+                    self._hay_datos.clear()
+                    continue
+
+                if len(self.cola) == 1 or self.hub.lote_maximo <= 1:
+                    mensajes = [self.cola.popleft()]
+                    carga = mensajes[0]
+                else:
+                    # El cliente se atrasó: todo lo pendiente en un solo frame
+                    mensajes = [self.cola.popleft() for _ in range(min(len(self.cola), self.hub.lote_maximo))]
+                    carga = {"tipo": "lote", "datos": mensajes}
+                    WS_LOTES.inc()
+                if not self.cola:
+                    self._hay_datos.clear()
+
+                self.enviando = True
+                try:
+                    await self.enviar(carga)
+                finally:
+                    self.enviando = False
+                for mensaje in mensajes:
+                    WS_MENSAJES.etiquetar(mensaje["tipo"]).inc()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.debug(f"Cliente WebSocket sin respuesta, se quita: {e}")
+            self.activo = False
+            self.hub.quitar(self)
+
+    def desconectar(self):
+        self.activo = False
+        self.cola.clear()
+        self.hub.quitar(self)
+        self._tarea.cancel()
+        if self.cerrar is not None:
+            asyncio.get_running_loop().create_task(self._cerrar())
+
+    async def _cerrar(self):
+        try:
+            await self.cerrar()
+        except Exception:
+            pass
+
+
+class HubDifusion:
+    """
+    Difusión a los WebSockets desde el event loop. Quien publica (el hilo de paho,
+    el reconocimiento continuo) hace un único call_soon_threadsafe por mensaje;
+    el reparto a las colas de cada cliente ocurre dentro del loop.
+    """
+
+    def __init__(self, cola_maxima=COLA_MAXIMA, politica=POLITICA, lote_maximo=LOTE_MAXIMO):
+        self.cola_maxima = cola_maxima
+        self.politica = politica
+        self.lote_maximo = lote_maximo
+        self.clientes = set()
+        self.loop = None
+
+    def iniciar(self, loop):
+        self.loop = loop
+
+    def registrar(self, enviar, cerrar=None):
+        """Suscribe un WebSocket. Debe llamarse desde el loop."""
+        cliente = ClienteDifusion(self, enviar, cerrar)
+        self.clientes.add(cliente)
+        return cliente
+
+    def quitar(self, cliente):
+        if cliente in self.clientes:
+            self.clientes.discard(cliente)
+            if cliente.activo:
+                cliente.activo = False
+                cliente._tarea.cancel()
+
+    def pendientes(self):
+        """Mensajes en las colas de todos los clientes."""
+        return sum(len(c.cola) for c in list(self.clientes))
+
+    def publicar(self, tipo, datos, id_evento=None):
+        """Seguro desde cualquier hilo."""
+        if self.loop is None or not self.clientes:
+            return
+        try:
+            self.loop.call_soon_threadsafe(self._distribuir, tipo, datos, id_evento)
+        except RuntimeError:
+            pass  # El loop ya se cerró
+
+    def _distribuir(self, tipo, datos, id_evento=None):
+        for cliente in list(self.clientes):
+            cliente.encolar(tipo, datos, id_evento)
+
+    async def detener(self):
+        """Quita a todos los clientes y espera a que terminen sus tareas de envío."""
+        clientes = list(self.clientes)
+        for cliente in clientes:
+            self.quitar(cliente)
+        await asyncio.gather(*(c._tarea for c in clientes), return_exceptions=True)
+
+    async def vaciar(self, intervalo=0.001):
+        """Espera a que se envíe todo lo pendiente (útil en benchmarks y apagado)."""
+        while any(c.cola or c.enviando for c in list(self.clientes)):
+            await asyncio.sleep(intervalo)
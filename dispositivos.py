@@ -0,0 +1,130 @@
+import json
+import logging
+import os
+
+from dotenv import load_dotenv
+
+import bus_frames
+from bus_frames import CoordinadorIngesta, IngestaCompartida
+from camera_facial import SistemaFacial
+from motor_reconocimiento import MotorReconocimiento
+from mqtt_client import manejadorMqtt, PREFIJO_TOPICO
+from metricas import RECONOCIMIENTO_COLA, GALERIA_ENCODINGS
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Registro de dispositivos (JSON). Sin archivo, una sola caja configurada por .env como siempre.
+ARCHIVO = os.getenv("DISPOSITIVOS_ARCHIVO", "dispositivos.json")
+ID_POR_DEFECTO = "caja"
+
+
+def leer_registro(ruta=ARCHIVO):
+    """
+    Lista de configuraciones {"id", "prefijo", "stream", "rostros", "datos"}.
+
+    El archivo es una lista de objetos; solo "id" y "stream" son obligatorios:
+        [{"id": "sucursal1", "stream": "http://10.0.0.5:81/stream"},
+         {"id": "sucursal2", "stream": "http://10.0.0.6:81/stream", "prefijo": "enclave/s2"}]
+    Por defecto prefijo = enclave/<id>, rostros = rostros/<id> y datos = datos/<id>.
+    """
+    if not os.path.exists(ruta):
+        return [{"id": ID_POR_DEFECTO, "prefijo": PREFIJO_TOPICO, "stream": os.getenv("CAMERA_STREAM_URL", ""),
+                 "rostros": "rostros", "datos": "."}]
+
+    with open(ruta, 'r', encoding='utf-8') as f:
+        entradas = json.load(f)
+
+    configuraciones, ids, prefijos = [], set(), set()
+    for entrada in entradas:
+        id_dispositivo = str(entrada["id"])
+        if not id_dispositivo.replace("_", "").replace("-", "").isalnum():
+            raise ValueError(f"Id de dispositivo inválido: {id_dispositivo!r}")
+        config = {
+            "id": id_dispositivo,
+            "prefijo": entrada.get("prefijo", f"enclave/{id_dispositivo}").rstrip("/"),
+            "stream": entrada.get("stream", ""),
+            "rostros": entrada.get("rostros", os.path.join("rostros", id_dispositivo)),
+            "datos": entrada.get("datos", os.path.join("datos", id_dispositivo)),
+        }
+        if config["id"] in ids or config["prefijo"] in prefijos:
+            raise ValueError(f"Dispositivo o prefijo repetido en {ruta}: {config['id']} ({config['prefijo']})")
+        ids.add(config["id"])
+        prefijos.add(config["prefijo"])
+        configuraciones.append(config)
+    if not configuraciones:
+        raise ValueError(f"{ruta} no define ningún dispositivo")
+    return configuraciones
+
+
+class Dispositivo:
+    """Una caja fuerte con su cámara: la parte MQTT (CajaMqtt) y la de video/reconocimiento (SistemaFacial)."""
+
+    def __init__(self, config, motor, ingesta=None):
+        self.id = config["id"]
+        self.config = config
+        self.caja = manejadorMqtt.agregar_caja(self.id, config["prefijo"], config["datos"])
+        self.facial = SistemaFacial(self.id, self.caja, config["stream"], config["rostros"], motor, ingesta,
+                                    os.path.join(config["datos"], "clips"))
+        self.caja.oyentes.append(self._al_evento_caja)
+
+    def _al_evento_caja(self, tipo, mensaje):
+        # Con varios workers cada uno recibe las alertas por MQTT: graba solo el dueño de la cámara
+        if self.facial.ingesta.es_lider:
+            self.facial.clips.evento(tipo, mensaje)
+
+    def resumen(self):
+        return {"id": self.id, "prefijo": self.config["prefijo"], "estado": self.caja.estadoActual,
+                "identidades": len(set(self.facial.known_face_names)), "video": self.facial.ultimo_frame_bytes is not None}
+
+
+class RegistroDispositivos:
+    """Todos los dispositivos del proceso, con un único pool de reconocimiento compartido."""
+
+    def __init__(self, configuraciones=None, compartida=bus_frames.INGESTA_COMPARTIDA):
+        configuraciones = configuraciones if configuraciones is not None else leer_registro()
+        self.motor = MotorReconocimiento()
+
+        # Varios workers de uvicorn: la cámara se lee en un solo proceso (bus_frames)
+        self.coordinador = None
+        if compartida and bus_frames.fcntl is None:
+            logger.warning("INGESTA_COMPARTIDA requiere fcntl; cada proceso leerá la cámara por su cuenta")
+        elif compartida:
+            self.coordinador = CoordinadorIngesta(configuraciones)
+
+        self.dispositivos = {}
+        for config in configuraciones:
+            ingesta = IngestaCompartida(config["id"], self.coordinador) if self.coordinador else None
+            self.dispositivos[config["id"]] = Dispositivo(config, self.motor, ingesta)
+        self.por_defecto = next(iter(self.dispositivos.values()))
+        logger.info(f"{len(self.dispositivos)} dispositivo(s): {', '.join(self.dispositivos)}")
+
+        RECONOCIMIENTO_COLA.calcular_con(lambda: self.motor._esperando)
+        GALERIA_ENCODINGS.calcular_con(lambda: sum(len(d.facial.galeria) for d in self.dispositivos.values()))
+
+    def obtener(self, id_dispositivo=None):
+        """El dispositivo pedido (o el por defecto si es None). KeyError si no existe."""
+        if id_dispositivo is None:
+            return self.por_defecto
+        return self.dispositivos[id_dispositivo]
+
+    def __iter__(self):
+        return iter(self.dispositivos.values())
+
+    def iniciar(self):
+        if self.coordinador is not None:
+            self.coordinador.iniciar()
+        self.motor.iniciar()
+        for dispositivo in self:
+            dispositivo.facial.iniciar()
+
+    def detener(self):
+        for dispositivo in self:
+            dispositivo.facial.detener()
+        if self.coordinador is not None:
+            self.coordinador.detener()
+        self.motor.detener()
+
+
+registro_dispositivos = RegistroDispositivos()
@@ -0,0 +1,105 @@
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Configuración (ajustable por .env)
+RUTA = os.getenv("ESTADO_ARCHIVO", "state.json")
+COALESCER = float(os.getenv("ESTADO_COALESCER", 0.05))  # Segundos para agrupar ráfagas de cambios
+
+
+def leer(ruta=RUTA):
+    """
+    Último estado guardado ({"estado", "marca", "origen"}) o None.
+    Para otros procesos: el archivo se reemplaza con un rename, nunca se ve a medias.
+    """
+    try:
+        with open(ruta, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class EstadoPersistente:
+    """
+    Estado de la caja (ABIERTO/CERRADO) con persistencia en segundo plano.
+
+    `actualizar` solo toca memoria y devuelve si hubo una transición real;
+    un hilo escritor guarda la última transición con escritura atómica
+    (temporal + os.replace). Una ráfaga de cambios termina en una sola escritura.
+    """
+
+    def __init__(self, ruta=RUTA, inicial="CERRADO", coalescer=COALESCER):
+        self.ruta = ruta
+        self.coalescer = coalescer
+        self.estado = inicial
+        self.marca = time.time()
+        self.origen = "inicio"
+        self.escrituras = 0
+        self._version = 1   # El estado inicial también se guarda
+        self._guardada = 0
+        self._lock = threading.Lock()
+        self._hay_cambios = threading.Event()
+        self._activo = False
+        self._escritor = None
+
+    def actualizar(self, estado, origen):
+        """Registra el estado recibido. True si cambió (solo entonces se persiste)."""
+        with self._lock:
+            if estado == self.estado:
+                return False
+            self.estado = estado
+            self.marca = time.time()
+            self.origen = origen
+            self._version += 1
+        self._hay_cambios.set()
+        return True
+
+    def instantanea(self):
+        with self._lock:
+            return {"estado": self.estado, "marca": self.marca, "origen": self.origen}
+
+    def iniciar(self):
+        if self._escritor is None:
+            self._activo = True
+            self._hay_cambios.set()
+            self._escritor = threading.Thread(target=self._bucle, name="estado", daemon=True)
+            self._escritor.start()
+
+    def detener(self):
+        """Termina el escritor guardando lo pendiente."""
+        if self._escritor is not None:
+            self._activo = False
+            self._hay_cambios.set()
+            self._escritor.join(timeout=5)
+            self._escritor = None
+
+    def _bucle(self):
+        while self._activo:
+            self._hay_cambios.wait()
+            if self._activo and self.coalescer:
+                time.sleep(self.coalescer)  # Los cambios que lleguen mientras tanto salen en la misma escritura
+            self._hay_cambios.clear()
+            self._guardar()
+        self._guardar()
+
+    def _guardar(self):
+        with self._lock:
+            if self._version == self._guardada:
+                return
+            version = self._version
+            datos = {"estado": self.estado, "marca": self.marca, "origen": self.origen}
+        temporal = f"{self.ruta}.tmp"
+        try:
+            with open(temporal, 'w', encoding='utf-8') as f:
+                json.dump(datos, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporal, self.ruta)
+            self._guardada = version
+            self.escrituras += 1
+        except OSError as e:
+            logger.error(f"Error guardando estado: {e}")
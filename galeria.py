@@ -0,0 +1,128 @@
+import os
+
+import numpy as np
+
+DIMENSION = 128
+TOLERANCIA = float(os.getenv("RECONOCIMIENTO_TOLERANCIA", 0.6))  # Igual que compare_faces
+TOP_K = int(os.getenv("RECONOCIMIENTO_TOP_K", 3))
+# "exacto" (por defecto) o "ann" (búsqueda aproximada por listas invertidas)
+MODO = os.getenv("GALERIA_MODO", "exacto")
+ANN_MINIMO = int(os.getenv("GALERIA_ANN_MINIMO", 5000))  # Por debajo de esto el exacto ya es instantáneo
+ANN_SONDEOS = int(os.getenv("GALERIA_ANN_SONDEOS", 8))
+MUESTRAS_POR_CANDIDATO = 4  # Filas que se miran por candidato pedido
+
+
+class Galeria:
+    """
+    Encodings conocidos como una única matriz float32 contigua más un arreglo de nombres.
+    Todas las caras de un frame se comparan contra toda la galería en una sola operación
+    matricial (|q|² + |g|² - 2·q·g), en lugar de un compare_faces por cara.
+    Una identidad puede tener varias filas (muestras): cuenta la más cercana.
+    """
+
+    def __init__(self, encodings, nombres, modo=MODO):
+        self.encodings = np.ascontiguousarray(np.asarray(encodings, np.float32).reshape(-1, DIMENSION))
+        self.nombres = np.asarray(nombres, dtype=object)
+        self._normas2 = np.einsum('ij,ij->i', self.encodings, self.encodings)
+
+        self._ivf = None
+        if modo == "ann" and len(self.encodings) >= ANN_MINIMO:
+            self._ivf = _IndiceIVF(self.encodings)
+
+    def __len__(self):
+        return len(self.encodings)
+
+    def distancias(self, consultas, filas=None):
+        """Matriz (caras x galería) de distancias euclídeas."""
+        q = np.asarray(consultas, np.float32).reshape(-1, DIMENSION)
+        g = self.encodings if filas is None else self.encodings[filas]
+        n2 = self._normas2 if filas is None else self._normas2[filas]
+        d2 = np.einsum('ij,ij->i', q, q)[:, None] + n2[None, :] - 2.0 * (q @ g.T)
+        np.maximum(d2, 0, out=d2)
+        return np.sqrt(d2, out=d2)
+
+    def buscar(self, consultas, k=TOP_K, tolerancia=TOLERANCIA):
+        """
+        Para cada cara: mejor nombre (None si supera la tolerancia), su distancia
+        y las k identidades más cercanas.
+        """
+        filas_k = k * MUESTRAS_POR_CANDIDATO  # Con varias muestras por identidad, k filas pueden ser 1 sola
+        consultas = np.asarray(consultas, np.float32).reshape(-1, DIMENSION)
+        if not len(self) or not len(consultas):
+            return [{"nombre": None, "distancia": None, "candidatos": []} for _ in consultas]
+
+        if self._ivf is not None:
+            resultados = []
+            for q, filas in zip(consultas, self._ivf.candidatos(consultas, ANN_SONDEOS)):
+                if not len(filas):
+                    filas = np.arange(len(self))
+                resultados.append(self._resultado(*self._top_k(self.distancias(q, filas)[0], filas_k, filas),
+                                                  k, tolerancia))
+            return resultados
+
+        return [self._resultado(*self._top_k(fila, filas_k), k, tolerancia) for fila in self.distancias(consultas)]
+
+    @staticmethod
+    def _top_k(distancias, k, filas=None):
+        k = min(k, len(distancias))
+        idx = np.argpartition(distancias, k - 1)[:k] if k < len(distancias) else np.arange(len(distancias))
+        idx = idx[np.argsort(distancias[idx])]
+        return (idx if filas is None else filas[idx]), distancias[idx]
+
+    def _resultado(self, idx, distancias, k, tolerancia):
+        candidatos, vistos = [], set()
+        for i, d in zip(idx, distancias):
+            if self.nombres[i] in vistos:
+                continue  # Otra muestra, más lejana, de una identidad ya listada
+            vistos.add(self.nombres[i])
+            candidatos.append({"nombre": self.nombres[i], "distancia": round(float(d), 4)})
+            if len(candidatos) == k:
+                break
+        mejor = candidatos[0]
+        return {
+            "nombre": mejor["nombre"] if mejor["distancia"] <= tolerancia else None,
+            "distancia": mejor["distancia"],
+            "candidatos": candidatos,
+        }
+
+
+class _IndiceIVF:
+    """
+    Búsqueda aproximada: k-means agrupa la galería en ~√N listas y cada consulta
+    solo se compara contra las listas de los centroides más cercanos.
+    """
+
+    def __init__(self, encodings, iteraciones=8, muestra=20000, semilla=0):
+        rng = np.random.default_rng(semilla)
+        n = len(encodings)
+        k = max(1, int(np.sqrt(n)))
+
+        entrenamiento = encodings[rng.choice(n, min(n, muestra), replace=False)]
+        centroides = entrenamiento[rng.choice(len(entrenamiento), k, replace=False)].copy()
+        for _ in range(iteraciones):
+            asignacion = self._asignar(entrenamiento, centroides)
+            for c in range(k):
+                miembros = entrenamiento[asignacion == c]
+                if len(miembros):
+                    centroides[c] = miembros.mean(axis=0)
+
+        self.centroides = centroides
+        asignacion = self._asignar(encodings, centroides)
+        orden = np.argsort(asignacion, kind='stable')
+        limites = np.searchsorted(asignacion[orden], np.arange(k + 1))
+        self.listas = [orden[limites[c]:limites[c + 1]] for c in range(k)]
+
+    @staticmethod
+    def _asignar(x, centroides, bloque=65536):
+        c2 = np.einsum('ij,ij->i', centroides, centroides)
+        asignacion = np.empty(len(x), np.int64)
+        for i in range(0, len(x), bloque):
+            parte = x[i:i + bloque]
+            asignacion[i:i + bloque] = np.argmin(c2[None, :] - 2.0 * (parte @ centroides.T), axis=1)
+        return asignacion
+
+    def candidatos(self, consultas, sondeos):
+        sondeos = min(sondeos, len(self.centroides))
+        d = np.einsum('ij,ij->i', self.centroides, self.centroides)[None, :] - 2.0 * (consultas @ self.centroides.T)
+        cercanos = np.argpartition(d, sondeos - 1, axis=1)[:, :sondeos]
+        return [np.concatenate([self.listas[c] for c in fila]) for fila in cercanos]
@@ -0,0 +1,163 @@
+import collections
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Configuración (ajustable por .env)
+RUTA = os.getenv("HISTORIAL_DB", "historial.db")
+CAPACIDAD = int(os.getenv("HISTORIAL_MEMORIA", 500))          # Eventos recientes en RAM
+RETENCION_DIAS = float(os.getenv("HISTORIAL_RETENCION_DIAS", 30))  # 0 = conservar todo
+REPETIR = int(os.getenv("HISTORIAL_REPETIR", 50))             # Máximo a reenviar a un WebSocket que reconecta
+LIMITE_MAXIMO = 1000                                          # Tope de una página de /api/logs
+
+VENTANA_WORKERS = 2.0                                          # Segundos para reconocer el mismo evento de otro worker
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS eventos (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    tipo TEXT NOT NULL,
+    datos TEXT NOT NULL
+)
+"""
+# Búsqueda del mismo evento guardado por otro worker (_insertar)
+_INDICE_CONTENIDO = "CREATE INDEX IF NOT EXISTS eventos_contenido ON eventos (tipo, datos, ts)"
+
+
+class Historial:
+    """
+    Historial de eventos (logs y alertas de la caja).
+
+    Los últimos eventos viven en un buffer circular en memoria; todos se
+    agregan además a una tabla SQLite en modo WAL, que asigna el id: creciente
+    en el orden de llegada, así un cliente puede pedir "todo lo posterior a N".
+
+    Con varios workers de uvicorn cada uno recibe los mismos mensajes MQTT y
+    escribe en el mismo archivo: el worker que llega segundo a un evento toma
+    la fila que ya guardó el primero (mismo tipo y datos, hace menos de
+    VENTANA_WORKERS segundos). Cada evento queda una sola vez y con el mismo
+    id en todos los workers.
+    """
+
+    def __init__(self, ruta=RUTA, capacidad=CAPACIDAD, retencion_dias=RETENCION_DIAS):
+        self.ruta = ruta
+        self.recientes = collections.deque(maxlen=capacidad)
+        self.ultimo_id = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()  # Una conexión por hilo
+
+        conexion = self._conexion()
+        conexion.execute(_ESQUEMA)
+        conexion.execute(_INDICE_CONTENIDO)
+        if retencion_dias:
+            conexion.execute("DELETE FROM eventos WHERE ts < ?", (time.time() - retencion_dias * 86400,))
+        conexion.commit()
+        filas = conexion.execute("SELECT id, ts, tipo, datos FROM eventos ORDER BY id DESC LIMIT ?",
+                                 (capacidad,)).fetchall()
+        self.recientes.extend(self._evento(f) for f in reversed(filas))
+        self.ultimo_id = filas[0][0] if filas else 0
+
+    def _conexion(self):
+        conexion = getattr(self._local, "conexion", None)
+        if conexion is None:
+            # Transacciones explícitas (BEGIN IMMEDIATE en _insertar)
+            conexion = sqlite3.connect(self.ruta, timeout=5, isolation_level=None)
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute("PRAGMA synchronous=NORMAL")
+            self._local.conexion = conexion
+        return conexion
+
+    @staticmethod
+    def _evento(fila):
+        id_evento, ts, tipo, datos = fila
+        return {"id": id_evento, "ts": ts, "tipo": tipo, "datos": json.loads(datos)}
+
+    def agregar(self, tipo, datos):
+        """
+        Registra un evento y lo devuelve con su id. Seguro desde cualquier hilo.
+        La inserción es un commit en WAL sin fsync (decenas de microsegundos).
+        """
+        texto = json.dumps(datos, ensure_ascii=False)
+        with self._lock:
+            try:
+                id_evento, ts = self._insertar(time.time(), tipo, texto)
+            except sqlite3.Error as e:
+                logger.error(f"No se pudo guardar el historial: {e}")
+                return {"id": None, "ts": time.time(), "tipo": tipo, "datos": datos}
+            evento = {"id": id_evento, "ts": ts, "tipo": tipo, "datos": datos}
+            self.recientes.append(evento)
+            self.ultimo_id = max(self.ultimo_id, id_evento)
+        return evento
+
+    def _insertar(self, ts, tipo, texto):
+        """(id, ts) de la fila del evento: la que guardó otro worker para el mismo evento, o una nueva."""
+        conexion = self._conexion()
+        conexion.execute("BEGIN IMMEDIATE")  # Lock de escritura entre workers durante la búsqueda
+        try:
+            candidatas = conexion.execute(
+                "SELECT id, ts FROM eventos WHERE ts > ? AND tipo = ? AND datos = ? ORDER BY id",
+                (ts - VENTANA_WORKERS, tipo, texto)).fetchall()
+            if candidatas:
+                # Las que ya son de este worker son repeticiones reales del mensaje, no copias
+                propias = {e["id"] for e in self.recientes if e["ts"] > ts - 2 * VENTANA_WORKERS}
+                for id_evento, ts_evento in candidatas:
+                    if id_evento not in propias:
+                        conexion.execute("COMMIT")
+                        return id_evento, ts_evento
+            cursor = conexion.execute("INSERT INTO eventos (ts, tipo, datos) VALUES (?, ?, ?)", (ts, tipo, texto))
+            conexion.execute("COMMIT")
+            return cursor.lastrowid, ts
+        except BaseException:
+            conexion.execute("ROLLBACK")
+            raise
+
+    def desde(self, id_desde=0, limite=100):
+        """Eventos con id > id_desde, en orden, hasta `limite`."""
+        limite = max(1, min(limite, LIMITE_MAXIMO))
+        with self._lock:
+            recientes = list(self.recientes)
+        primero = recientes[0]["id"] if recientes else self.ultimo_id + 1
+
+        eventos = []
+        if id_desde + 1 < primero:
+            # Lo anterior al buffer ya está en disco
+            filas = self._conexion().execute(
+                "SELECT id, ts, tipo, datos FROM eventos WHERE id > ? AND id < ? ORDER BY id LIMIT ?",
+                (id_desde, primero, limite)).fetchall()
+            eventos = [self._evento(f) for f in filas]
+        if len(eventos) < limite:
+            # Los ids no son consecutivos (los asigna SQLite): se filtra, no se indexa
+            eventos.extend([e for e in recientes if e["id"] > id_desde][:limite - len(eventos)])
+        return eventos
+
+    def ultimos(self, limite=100):
+        """Los `limite` eventos más recientes, en orden."""
+        limite = max(1, min(limite, LIMITE_MAXIMO))
+        with self._lock:
+            recientes = list(self.recientes)
+        if len(recientes) >= limite:
+            return recientes[-limite:]
+        filas = self._conexion().execute("SELECT id, ts, tipo, datos FROM eventos ORDER BY id DESC LIMIT ?",
+                                         (limite,)).fetchall()
+        return [self._evento(f) for f in reversed(filas)]
+
+    def pagina(self, id_desde=None, limite=100):
+        """Respuesta de /api/logs: sin `id_desde` devuelve los más recientes."""
+        eventos = self.ultimos(limite) if id_desde is None else self.desde(id_desde, limite)
+        siguiente = eventos[-1]["id"] if eventos else (id_desde or self.ultimo_id)
+        return {"eventos": eventos, "siguiente": siguiente, "ultimo": self.ultimo_id,
+                "hay_mas": siguiente < self.ultimo_id}
+
+    def para_reconexion(self, id_desde=None):
+        """
+        Lo que se perdió un WebSocket desde su último id visto (como mucho REPETIR eventos).
+        Sin id, o con uno mayor al último (historial borrado), devuelve los más recientes.
+        """
+        if id_desde is None or id_desde > self.ultimo_id:
+            return self.ultimos(REPETIR)
+        return [e for e in self.ultimos(REPETIR) if e["id"] > id_desde]
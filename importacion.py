@@ -0,0 +1,177 @@
+"""
+Alta de rostros en cantidad: varias muestras por identidad e importación masiva
+de un .zip o .tar con una carpeta (o una imagen) por persona:
+
+    personal.zip
+        Ana Perez/frente.jpg
+        Ana Perez/perfil.jpg
+        Luis.jpg
+
+Las imágenes se extraen fuera de rostros/, se codifican en paralelo en un pool
+de procesos propio (no el del reconocimiento en vivo) y entran a la carpeta
+junto con la única escritura del índice, al final.
+"""
+import itertools
+import logging
+import multiprocessing
+import os
+import shutil
+import tarfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from reconocimiento import codificar_imagen
+
+logger = logging.getLogger(__name__)
+
+# Configuración (ajustable por .env)
+PROCESOS = int(os.getenv("IMPORTACION_PROCESOS", os.cpu_count() or 1))
+MINIMO_PARALELO = int(os.getenv("IMPORTACION_MINIMO_PARALELO", 8))   # Menos imágenes: en el hilo actual
+MAX_IMAGEN = int(os.getenv("IMPORTACION_MAX_IMAGEN", 10 * 1024 * 1024))
+MAX_ARCHIVO = int(os.getenv("IMPORTACION_MAX_ARCHIVO", 2 * 1024 ** 3))     # .zip/.tar completo
+EXTENSIONES = ('.jpg', '.jpeg', '.png')
+
+_ids = itertools.count(1)
+
+
+def limpiar_nombre(nombre):
+    """Nombre de identidad apto para carpeta/archivo: letras, números, espacios y _."""
+    return "".join(c for c in nombre if c.isalnum() or c in (' ', '_')).strip()
+
+
+def codificar_en_paralelo(rutas, al_progresar=None, procesos=PROCESOS):
+    """{ruta: encoding o None}. Con pocas imágenes no vale la pena arrancar procesos (cada uno carga dlib)."""
+    vectores = {}
+    if len(rutas) < MINIMO_PARALELO or procesos <= 1:
+        for hechas, ruta in enumerate(rutas, 1):
+            vectores[ruta] = _codificar(ruta)
+            if al_progresar:
+                al_progresar(hechas, len(rutas))
+        return vectores
+
+    # "spawn" como el motor: no heredar hilos de paho/ingesta
+    with ProcessPoolExecutor(max_workers=min(procesos, len(rutas)),
+                             mp_context=multiprocessing.get_context("spawn")) as pool:
+        futuros = {pool.submit(codificar_imagen, ruta): ruta for ruta in rutas}
+        for hechas, futuro in enumerate(as_completed(futuros), 1):
+            ruta = futuros[futuro]
+            try:
+                vectores[ruta] = futuro.result()
+            except Exception as e:
+                logger.error(f"Error codificando {ruta}: {e}")
+                vectores[ruta] = None
+            if al_progresar:
+                al_progresar(hechas, len(rutas))
+    return vectores
+
+
+def _codificar(ruta):
+    try:
+        return codificar_imagen(ruta)
+    except Exception as e:
+        logger.error(f"Error codificando {ruta}: {e}")
+        return None
+
+
+def _miembros(ruta):
+    """(ruta interna, función que lee sus bytes, tamaño) de cada archivo del .zip o .tar(.gz)."""
+    if zipfile.is_zipfile(ruta):
+        with zipfile.ZipFile(ruta) as z:
+            for info in z.infolist():
+                if not info.is_dir():
+                    yield info.filename, lambda info=info: z.read(info), info.file_size
+    else:
+        with tarfile.open(ruta, 'r:*') as t:
+            for info in t:
+                if info.isfile():
+                    yield info.name, lambda info=info: t.extractfile(info).read(), info.size
+
+
+class ImportacionRostros:
+    """Una importación masiva en segundo plano; `estado` es lo que consulta la API."""
+
+    def __init__(self, facial, archivo):
+        self.facial = facial
+        self.archivo = archivo          # Temporal con el .zip/.tar recibido (se borra al terminar)
+        self.id = str(next(_ids))
+        self.estado = {"id": self.id, "estado": "pendiente", "identidades": 0, "imagenes": 0,
+                       "codificadas": 0, "sin_rostro": 0, "omitidas": 0, "segundos": 0}
+        self._inicio = time.monotonic()
+        self._ultimo_aviso = 0
+        self._hilo = None
+
+    @property
+    def en_curso(self):
+        return self.estado["estado"] in ("pendiente", "extrayendo", "codificando")
+
+    def iniciar(self):
+        self._hilo = threading.Thread(target=self._ejecutar, name=f"importacion-{self.id}", daemon=True)
+        self._hilo.start()
+
+    def _actualizar(self, avisar=False, **cambios):
+        self.estado = dict(self.estado, segundos=round(time.monotonic() - self._inicio, 1), **cambios)
+        # Progreso por WebSocket, como mucho uno por segundo
+        ahora = time.monotonic()
+        if avisar or ahora - self._ultimo_aviso >= 1:
+            self._ultimo_aviso = ahora
+            self.facial.caja._notificar_clientes("importacion", self.estado)
+
+    def _ejecutar(self):
+        indice = self.facial.indice
+        entrantes = indice.carpeta_entrantes()
+        try:
+            self._actualizar(estado="extrayendo")
+            destinos = self._extraer(entrantes)
+            rutas = list(destinos)
+            self._actualizar(estado="codificando", imagenes=len(rutas))
+            vectores = codificar_en_paralelo(rutas, lambda hechas, total: self._actualizar(codificadas=hechas))
+
+            # Las muestras sin rostro no se guardan; las demás entran a rostros/ ya indexadas
+            validas = [r for r in rutas if vectores.get(r) is not None]
+            if validas:
+                indice.agregar_varios([destinos[r] for r in validas], {destinos[r]: vectores[r] for r in validas},
+                                      origenes={destinos[r]: r for r in validas})
+                self.facial._publicar_galeria()
+            identidades = {indice.nombre(indice.clave(destinos[r])) for r in validas}
+            self._actualizar(avisar=True, estado="listo", identidades=len(identidades),
+                             sin_rostro=len(rutas) - len(validas))
+            logger.info(f"[{self.facial.id}] Importación {self.id}: {len(validas)} muestras de "
+                        f"{len(identidades)} identidades en {self.estado['segundos']} s")
+        except Exception as e:
+            logger.error(f"[{self.facial.id}] Error en la importación {self.id}: {e}")
+            self._actualizar(avisar=True, estado="error", error=str(e))
+        finally:
+            shutil.rmtree(entrantes, ignore_errors=True)
+            try:
+                os.remove(self.archivo)
+            except OSError:
+                pass
+
+    def _extraer(self, entrantes):
+        """
+        Copia las imágenes a entrantes/<identidad>/ y devuelve {copia: destino en rostros/}.
+        Nunca usa las rutas del archivo tal cual.
+        """
+        carpeta = self.facial.indice.carpeta
+        destinos, omitidas = {}, 0
+        for interna, leer, tamano in _miembros(self.archivo):
+            partes = [p for p in interna.replace("\\", "/").split("/") if p]
+            base, ext = os.path.splitext(partes[-1]) if partes else ("", "")
+            nombre = limpiar_nombre(partes[-2] if len(partes) > 1 else base)
+            muestra = limpiar_nombre(base)
+            if ext.lower() not in EXTENSIONES or not nombre or not muestra or base.startswith(".") \
+                    or tamano > MAX_IMAGEN:
+                omitidas += 1
+                continue
+            relativa = os.path.join(nombre, f"{muestra}{ext.lower()}")
+            ruta = os.path.join(entrantes, relativa)
+            os.makedirs(os.path.dirname(ruta), exist_ok=True)
+            with open(ruta, 'wb') as f:
+                f.write(leer())
+            destinos[ruta] = os.path.join(carpeta, relativa)
+            if len(destinos) % 50 == 0:
+                self._actualizar(imagenes=len(destinos), omitidas=omitidas)
+        self._actualizar(imagenes=len(destinos), omitidas=omitidas)
+        return destinos
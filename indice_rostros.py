@@ -0,0 +1,435 @@
+import collections
+import contextlib
+import glob
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: un solo proceso escribe el índice
+    fcntl = None
+
+from reconocimiento import codificar_imagen
+
+logger = logging.getLogger(__name__)
+
+DIMENSION = 128  # Tamaño del encoding de dlib
+TIPOS_IMAGEN = ('*.jpg', '*.jpeg', '*.png')
+# Segundos que los archivos de una generación reemplazada siguen en disco
+RETENCION_GENERACIONES = float(os.getenv("ROSTROS_RETENCION_GENERACIONES", 60))
+
+
+def _sha1(ruta):
+    h = hashlib.sha1()
+    with open(ruta, 'rb') as f:
+        for bloque in iter(lambda: f.read(1 << 16), b''):
+            h.update(bloque)
+    return h.hexdigest()
+
+
+def _guardar_atomico(ruta, escribir):
+    """Escribe en un temporal y lo renombra: un lector nunca ve un archivo a medias."""
+    temporal = f"{ruta}.tmp"
+    with open(temporal, 'wb') as f:
+        escribir(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporal, ruta)
+
+
+class IndiceRostros:
+    """
+    Índice persistente de encodings de la carpeta rostros/.
+
+    Cada identidad es una imagen suelta (rostros/Ana.jpg) o una subcarpeta con
+    varias muestras (rostros/Ana/*.jpg); cada muestra con rostro es una fila.
+
+    Los encodings se guardan en una matriz float32 (.npy, se abre con mmap)
+    y la metadata en un JSON con el hash de contenido, mtime y tamaño de cada
+    archivo. Al sincronizar solo se codifican las imágenes nuevas o modificadas;
+    un archivo renombrado (mismo hash) reutiliza su encoding.
+
+    Varios procesos (workers de uvicorn) pueden compartir la carpeta: las
+    modificaciones se serializan con un lock de archivo y cada proceso mapea
+    la misma matriz, así el sistema operativo la mantiene una sola vez en memoria.
+    """
+
+    def __init__(self, carpeta="rostros", codificar=codificar_imagen):
+        self.carpeta = carpeta
+        self.codificar = codificar
+        self.directorio = os.path.join(carpeta, ".indice")
+        self.ruta_meta = os.path.join(self.directorio, "indice.json")
+        self.ruta_lock = os.path.join(self.directorio, "lock")
+
+        # archivo (relativo: "Ana.jpg" o "Ana/1.jpg") -> {"nombre", "sha1", "mtime", "tamano", "fila"};
+        # fila None = sin rostro
+        self.entradas = {}
+        self.encodings = np.empty((0, DIMENSION), np.float32)
+        self.nombres = []
+        self.version = 0
+        self._archivo_matriz = None
+        self._archivo_nombres = None
+        self._generacion = 0
+
+        self._lock = threading.RLock()
+        self._vigilante = None
+        self._detener = threading.Event()
+
+    # --- Persistencia ---
+
+    @property
+    def archivo_matriz(self):
+        """Ruta del .npy de la versión actual (None si el índice no se guardó nunca)."""
+        return os.path.join(self.directorio, self._archivo_matriz) if self._archivo_matriz else None
+
+    @property
+    def archivos_galeria(self):
+        """(.npy, .json de nombres) de la versión actual, para los procesos del motor; None si no hay."""
+        if not self._archivo_matriz or not self._archivo_nombres:
+            return None
+        return self.archivo_matriz, os.path.join(self.directorio, self._archivo_nombres)
+
+    @contextlib.contextmanager
+    def _exclusivo(self):
+        """Lock del índice entre procesos; dentro, el índice en memoria es la última versión en disco."""
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            os.makedirs(self.directorio, exist_ok=True)
+            with open(self.ruta_lock, 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    if self._generacion_en_disco() != self._generacion:
+                        self.cargar()
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _firma_meta(self):
+        try:
+            st = os.stat(self.ruta_meta)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _generacion_en_disco(self):
+        try:
+            with open(self.ruta_meta, 'r', encoding='utf-8') as f:
+                return json.load(f)["generacion"]
+        except (OSError, ValueError, KeyError):
+            return 0
+
+    def cargar(self):
+        """Lee el índice del disco (milisegundos: la matriz se mapea, no se decodifica nada)."""
+        with self._lock:
+            try:
+                with open(self.ruta_meta, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+                matriz = np.load(os.path.join(self.directorio, meta["matriz"]), mmap_mode='r')
+            except FileNotFoundError:
+                return False
+            except Exception as e:
+                logger.error(f"Índice de rostros ilegible, se reconstruirá: {e}")
+                return False
+
+            self.entradas = meta["entradas"]
+            self._archivo_matriz = meta["matriz"]
+            self._archivo_nombres = meta.get("nombres")  # Índices anteriores no lo tienen
+            self._generacion = meta["generacion"]
+            self._aplicar(matriz)
+            return True
+
+    def _guardar(self, entradas, matriz):
+        """Persiste y publica una nueva versión del índice."""
+        os.makedirs(self.directorio, exist_ok=True)
+        # Cada versión de la matriz va en su propio archivo: el anterior puede seguir
+        # mapeado por otro lector (y en Windows no se puede reemplazar un archivo mapeado).
+        self._generacion += 1
+        archivo_matriz = f"encodings-{self._generacion:06d}.npy"
+        _guardar_atomico(os.path.join(self.directorio, archivo_matriz), lambda f: np.save(f, matriz))
+        # Los nombres por fila de la misma generación: lo que abren los procesos del motor
+        archivo_nombres = f"nombres-{self._generacion:06d}.json"
+        nombres = json.dumps(self._nombres(entradas, len(matriz)), ensure_ascii=False).encode('utf-8')
+        _guardar_atomico(os.path.join(self.directorio, archivo_nombres), lambda f: f.write(nombres))
+        datos = json.dumps({"dimension": DIMENSION, "generacion": self._generacion,
+                            "matriz": archivo_matriz, "nombres": archivo_nombres, "entradas": entradas},
+                           ensure_ascii=False).encode('utf-8')
+        _guardar_atomico(self.ruta_meta, lambda f: f.write(datos))
+
+        self.entradas = entradas
+        self._archivo_matriz = archivo_matriz
+        self._archivo_nombres = archivo_nombres
+        # Publicar la versión mapeada del archivo, no la copia en memoria de este proceso
+        self._aplicar(np.load(os.path.join(self.directorio, archivo_matriz), mmap_mode='r'))
+
+        self._limpiar_generaciones()
+
+    def _limpiar_generaciones(self, ahora=None):
+        """
+        Borra las generaciones reemplazadas hace más de RETENCION_GENERACIONES segundos.
+        Una tarea del motor lleva las rutas de la generación vigente al encolarse, y otro
+        worker sigue usando la suya hasta que su vigilancia lee la nueva: la generación
+        anterior tiene que seguir ahí un rato (en Linux el archivo se puede borrar aunque
+        esté mapeado, pero no abrir después).
+        """
+        generaciones = collections.defaultdict(list)
+        for patron in ("encodings-*.npy", "nombres-*.json"):
+            for ruta in glob.glob(os.path.join(self.directorio, patron)):
+                try:
+                    generaciones[int(os.path.basename(ruta).split("-")[1].split(".")[0])].append(ruta)
+                except ValueError:
+                    continue
+        ahora = ahora if ahora is not None else time.time()
+        numeros = sorted(generaciones)
+        for numero, siguiente in zip(numeros, numeros[1:]):
+            if numero >= self._generacion:
+                break
+            try:
+                # Quedó reemplazada cuando se escribió la siguiente
+                reemplazo = os.stat(generaciones[siguiente][0]).st_mtime
+            except OSError:
+                continue
+            if ahora - reemplazo < RETENCION_GENERACIONES:
+                continue
+            for ruta in generaciones[numero]:
+                try:
+                    os.remove(ruta)
+                except OSError:
+                    pass # En Windows, todavía mapeado por alguien: se limpia en la próxima versión
+
+    def _aplicar(self, matriz):
+        """Publica matriz y nombres (en el orden de filas) para el reconocimiento."""
+        self.encodings = matriz
+        self.nombres = self._nombres(self.entradas, len(matriz))
+        self.version += 1
+
+    @staticmethod
+    def _nombres(entradas, filas):
+        nombres = [None] * filas
+        for entrada in entradas.values():
+            if entrada["fila"] is not None:
+                nombres[entrada["fila"]] = entrada["nombre"]
+        return nombres
+
+    # --- Actualización incremental ---
+
+    def _archivos(self):
+        archivos = []
+        for ext in TIPOS_IMAGEN:
+            archivos.extend(glob.glob(os.path.join(self.carpeta, ext)))
+            archivos.extend(glob.glob(os.path.join(self.carpeta, "*", ext)))  # Muestras por identidad
+        return {self.clave(ruta): ruta for ruta in archivos}
+
+    def clave(self, ruta):
+        """Clave de una imagen en el índice: su ruta relativa a la carpeta, con '/'."""
+        return os.path.relpath(ruta, self.carpeta).replace(os.sep, "/")
+
+    @staticmethod
+    def nombre(archivo):
+        """Identidad de una imagen: la subcarpeta, o el nombre del archivo si está suelta."""
+        carpeta, _, base = archivo.rpartition("/")
+        return carpeta or os.path.splitext(base)[0]
+
+    def firma(self):
+        """Firma barata del contenido de la carpeta (nombres, mtimes y tamaños)."""
+        firma = []
+        for archivo, ruta in sorted(self._archivos().items()):
+            try:
+                st = os.stat(ruta)
+            except FileNotFoundError:
+                continue
+            firma.append((archivo, st.st_mtime_ns, st.st_size))
+        return tuple(firma)
+
+    def _por_hash(self):
+        return {e["sha1"]: e for e in self.entradas.values()}
+
+    def _codificar(self, ruta, nombre):
+        try:
+            vector = self.codificar(ruta)
+        except Exception as e:
+            logger.error(f"Error cargando {ruta}: {e}")
+            return None
+        if vector is None:
+            logger.warning(f"No se detectó rostro en {nombre}")
+        else:
+            logger.info(f"Rostro cargado: {nombre}")
+        return vector
+
+    def _entrada(self, archivo, ruta, st, por_hash, vectores=None):
+        """
+        Entrada nueva para un archivo, reutilizando el encoding si el contenido ya se conoce.
+        `vectores` (ruta -> encoding o None) trae los ya calculados en otro lado (importación en paralelo).
+        """
+        nombre = self.nombre(archivo)
+        sha1 = _sha1(ruta)
+        conocida = por_hash.get(sha1)
+        if vectores is not None and ruta in vectores:
+            vector = vectores[ruta]
+            conocida = None
+        elif conocida is None:
+            vector = self._codificar(ruta, nombre)
+        else:
+            # Mismo contenido (renombre o copia): no se vuelve a codificar
+            vector = None if conocida["fila"] is None else self.encodings[conocida["fila"]]
+        entrada = {"nombre": nombre, "sha1": sha1, "mtime": st.st_mtime_ns, "tamano": st.st_size, "fila": None}
+        return entrada, vector, conocida is None
+
+    def sincronizar(self, al_progresar=None):
+        """
+        Aplica los cambios de la carpeta. Devuelve (codificados, eliminados).
+        `al_progresar(revisados, total)` se llama después de cada archivo.
+        """
+        with self._exclusivo():
+            archivos = self._archivos()
+            por_hash = self._por_hash()
+            entradas = {}
+            filas = []
+            codificados = 0
+            cambios = False
+
+            for archivo, ruta in sorted(archivos.items()):
+                try:
+                    st = os.stat(ruta)
+                except FileNotFoundError:
+                    continue
+                previa = self.entradas.get(archivo)
+
+                if previa and previa["mtime"] == st.st_mtime_ns and previa["tamano"] == st.st_size:
+                    entrada = dict(previa)
+                    vector = None if previa["fila"] is None else self.encodings[previa["fila"]]
+                else:
+                    entrada, vector, codificado = self._entrada(archivo, ruta, st, por_hash)
+                    codificados += codificado
+                    cambios = True
+
+                entrada["fila"] = None
+                if vector is not None:
+                    entrada["fila"] = len(filas)
+                    filas.append(vector)
+                entradas[archivo] = entrada
+                if al_progresar:
+                    al_progresar(len(entradas), len(archivos))
+
+            eliminados = len(set(self.entradas) - set(entradas))
+            if not cambios and not eliminados and self._archivo_matriz and self._archivo_nombres:
+                return 0, 0
+
+            self._guardar(entradas, np.array(filas, np.float32).reshape(-1, DIMENSION))
+            logger.info(f"Índice de rostros: {codificados} codificados, {eliminados} eliminados, "
+                        f"{len(filas)} en total")
+            return codificados, eliminados
+
+    def agregar(self, ruta):
+        """Incorpora (o reemplaza) una sola imagen sin tocar el resto de la galería."""
+        return self.agregar_varios([ruta])[ruta]
+
+    def carpeta_entrantes(self):
+        """Carpeta temporal para imágenes que todavía no entran al índice (la vigilancia no la recorre)."""
+        os.makedirs(self.directorio, exist_ok=True)
+        return tempfile.mkdtemp(prefix="entrantes-", dir=self.directorio)
+
+    def agregar_varios(self, rutas, vectores=None, origenes=None):
+        """
+        Incorpora (o reemplaza) varias imágenes con una sola escritura del índice.
+        `origenes` (ruta -> archivo en carpeta_entrantes) se mueven a su lugar dentro
+        del lock: la vigilancia nunca ve un archivo que todavía no está en el índice.
+        Devuelve {ruta: True si tiene rostro}.
+        """
+        with self._exclusivo():
+            for ruta, origen in (origenes or {}).items():
+                os.makedirs(os.path.dirname(ruta), exist_ok=True)
+                os.replace(origen, ruta)
+            por_hash = self._por_hash()
+            nuevas = {}
+            for ruta in rutas:
+                archivo = self.clave(ruta)
+                nuevas[archivo] = (ruta,) + self._entrada(archivo, ruta, os.stat(ruta), por_hash, vectores)[:2]
+
+            entradas, matriz = self._sin_archivos(set(nuevas))
+            filas = [matriz]
+            con_rostro = {}
+            for archivo, (ruta, entrada, vector) in nuevas.items():
+                if vector is not None:
+                    entrada["fila"] = len(matriz) + len(filas) - 1
+                    filas.append(np.asarray(vector, np.float32)[None, :])
+                entradas[archivo] = entrada
+                con_rostro[ruta] = vector is not None
+            self._guardar(entradas, np.vstack(filas))
+            return con_rostro
+
+    def eliminar(self, nombre):
+        """Borra las imágenes de una identidad y sus encodings. Devuelve cuántas se borraron."""
+        with self._exclusivo():
+            archivos = {a for a, e in self.entradas.items() if e["nombre"] == nombre}
+            if not archivos:
+                return 0
+            for archivo in archivos:
+                try:
+                    os.remove(os.path.join(self.carpeta, archivo))
+                except FileNotFoundError:
+                    pass
+            # La subcarpeta de la identidad, si quedó vacía
+            try:
+                os.rmdir(os.path.join(self.carpeta, nombre))
+            except OSError:
+                pass
+            self._guardar(*self._sin_archivos(archivos))
+            return len(archivos)
+
+    def _sin_archivos(self, archivos):
+        """Copia de entradas y matriz sin las filas de `archivos` (renumerando el resto)."""
+        quitar = {self.entradas[a]["fila"] for a in archivos if a in self.entradas} - {None}
+        conservar = np.ones(len(self.encodings), bool)
+        conservar[list(quitar)] = False
+        nueva_fila = np.cumsum(conservar) - 1
+
+        entradas = {}
+        for archivo, entrada in self.entradas.items():
+            if archivo in archivos:
+                continue
+            entrada = dict(entrada)
+            if entrada["fila"] is not None:
+                entrada["fila"] = int(nueva_fila[entrada["fila"]])
+            entradas[archivo] = entrada
+        return entradas, np.array(self.encodings[conservar], np.float32).reshape(-1, DIMENSION)
+
+    # --- Vigilancia de la carpeta ---
+
+    def vigilar(self, intervalo, al_cambiar):
+        """
+        Revisa la carpeta cada `intervalo` segundos y aplica los archivos copiados a mano,
+        y las versiones del índice guardadas por otro proceso.
+        """
+        if self._vigilante and self._vigilante.is_alive():
+            return
+        self._detener.clear()
+
+        def bucle():
+            firma = (self.firma(), self._firma_meta())
+            while not self._detener.wait(intervalo):
+                actual = (self.firma(), self._firma_meta())
+                if actual == firma:
+                    continue
+                firma = actual
+                try:
+                    version = self.version
+                    self.sincronizar()  # Si otro proceso guardó una versión, se carga antes
+                    if self.version != version:
+                        al_cambiar()
+                except Exception as e:
+                    logger.error(f"Error sincronizando rostros/: {e}")
+
+        self._vigilante = threading.Thread(target=bucle, name="vigilante-rostros", daemon=True)
+        self._vigilante.start()
+
+    def detener(self):
+        self._detener.set()
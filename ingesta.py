@@ -0,0 +1,244 @@
+import asyncio
+import collections
+import functools
+import logging
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+import requests
+
+from mjpeg import DemuxMJPEG
+from preprocesamiento import nitidez
+from metricas import (CAMARA_FRAMES, CAMARA_BYTES, CAMARA_FPS, CAMARA_ULTIMO_FRAME, CAMARA_RECONEXIONES,
+                      CAMARA_RESINCRONIZACIONES, CAMARA_LARGOS_INVALIDOS)
+
+# Configurar logger
+logger = logging.getLogger(__name__)
+
+RECIENTES = int(os.getenv("RAFAGA_FRAMES", 8))  # Frames reales que se guardan para los escaneos en ráfaga
+
+
+@functools.lru_cache(maxsize=64)
+def imagen_espera(mensaje):
+    """
+    JPEG de estado que se muestra mientras la cámara no entrega video.
+    Se dibuja y codifica una sola vez por mensaje (los mensajes son pocos y se repiten).
+    """
+    # Fondo Gris Azulado para distinguir de "OFF"
+    blank = np.full((480, 640, 3), (50, 50, 50), np.uint8)
+    cv2.putText(blank, "SISTEMA DE VIDEO", (180, 200), cv2.FONT_HERSHEY_DUPLEX, 0.8, (200, 200, 200), 1)
+    # Centrar texto aprox
+    cv2.putText(blank, mensaje, (50, 250), cv2.FONT_HERSHEY_DUPLEX, 0.8, (100, 100, 255), 2)
+    ret, buf = cv2.imencode('.jpg', blank)
+    return buf.tobytes()
+
+
+class RanuraFrame:
+    """
+    Ranura compartida con el último JPEG publicado por la ingesta.
+    Los lectores solo reciben el frame más nuevo: si un cliente es lento,
+    los frames intermedios se descartan en lugar de encolarse.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.jpg = None
+        self.secuencia = 0
+        self.marca = 0.0
+        # Un evento por event loop: un único aviso cross-thread por frame y loop,
+        # sin importar cuántos visores estén esperando.
+        self._eventos = {}
+
+    def publicar(self, jpg):
+        with self._lock:
+            self.jpg = jpg
+            self.secuencia += 1
+            self.marca = time.time()
+            loops = list(self._eventos)
+
+        for loop in loops:
+            try:
+                loop.call_soon_threadsafe(self._despertar, loop)
+            except RuntimeError:
+                # El loop ya se cerró
+                with self._lock:
+                    self._eventos.pop(loop, None)
+
+    def _despertar(self, loop):
+        # Corre dentro del loop: libera a los que esperan y deja un evento nuevo
+        with self._lock:
+            evento = self._eventos.get(loop)
+            self._eventos[loop] = asyncio.Event()
+        if evento:
+            evento.set()
+
+    def leer(self):
+        with self._lock:
+            return self.secuencia, self.jpg
+
+    async def esperar(self, ultima_secuencia):
+        """Espera sin bloquear el loop a un frame más nuevo que ultima_secuencia."""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                if self.secuencia > ultima_secuencia:
+                    return self.secuencia, self.jpg
+                evento = self._eventos.get(loop)
+                if evento is None:
+                    evento = self._eventos[loop] = asyncio.Event()
+            await evento.wait()
+
+
+class FramesRecientes:
+    """
+    Los últimos frames reales de la cámara, para elegir los más nítidos en un escaneo
+    en ráfaga. Se guardan los JPEG tal cual: la nitidez se calcula recién cuando
+    alguien la pide, y una sola vez por frame.
+    """
+
+    def __init__(self, tamano=RECIENTES):
+        self._lock = threading.Lock()
+        self._frames = collections.deque(maxlen=tamano)  # [secuencia, marca, jpg, nitidez o None]
+
+    def agregar(self, secuencia, jpg):
+        with self._lock:
+            self._frames.append([secuencia, time.time(), jpg, None])
+
+    def mas_nitidos(self, cantidad, edad_maxima=None, ahora=None):
+        """Hasta `cantidad` frames (secuencia, jpg, nitidez), del más nítido al menos, no más viejos que edad_maxima."""
+        ahora = ahora if ahora is not None else time.time()
+        with self._lock:
+            frames = [f for f in self._frames if edad_maxima is None or ahora - f[1] <= edad_maxima]
+        for frame in frames:
+            if frame[3] is None:
+                frame[3] = nitidez(frame[2])
+        frames.sort(key=lambda f: f[3], reverse=True)
+        return [(secuencia, jpg, valor) for secuencia, _, jpg, valor in frames[:cantidad]]
+
+    def __len__(self):
+        return len(self._frames)
+
+
+class IngestaCamara:
+    """
+    Única conexión al stream del ESP32. Un hilo en segundo plano lee el MJPEG
+    y publica cada JPEG en la ranura compartida; los visores de /video_feed
+    se suscriben a la ranura en vez de abrir su propia conexión.
+
+    Con `anillo` (bus_frames.AnilloFrames) cada frame también se escribe en
+    memoria compartida para los workers de uvicorn.
+    """
+
+    # La ingesta local es siempre la dueña de la cámara (ver IngestaCompartida)
+    es_lider = True
+
+    def __init__(self, url_stream, anillo=None):
+        self.url_stream = url_stream
+        self.ranura = RanuraFrame()
+        self.anillo = anillo
+
+        # Último frame REAL de la cámara (nunca un placeholder de espera) con su número de secuencia.
+        # Se reemplaza la tupla completa, así los lectores de otros hilos nunca ven un par mezclado.
+        self.ultimo_frame = (0, None)
+        self.recientes = FramesRecientes()
+        self.oyentes = []  # Funciones (secuencia, jpg) que reciben cada frame real (p.ej. clips.GrabadorClips)
+
+        self._detener = threading.Event()
+        self._hilo = None
+        self._marca_anterior = None
+        self._fps = 0.0
+
+    def iniciar(self):
+        if self._hilo and self._hilo.is_alive():
+            return
+        self._detener.clear()
+        self._hilo = threading.Thread(target=self._bucle, name="ingesta-camara", daemon=True)
+        self._hilo.start()
+
+    def detener(self):
+        self._detener.set()
+
+    def _espera(self, mensaje, segundos=0):
+        jpg = imagen_espera(mensaje)
+        self.ranura.publicar(jpg)
+        if self.anillo is not None:
+            self.anillo.publicar(jpg, real=False)
+        if segundos:
+            self._detener.wait(segundos)
+
+    @property
+    def ultimo_frame_bytes(self):
+        return self.ultimo_frame[1]
+
+    def _publicar_frame(self, jpg):
+        # GUARDAR CACHE para uso de verificar_identidad
+        self.ultimo_frame = (self.ultimo_frame[0] + 1, jpg)
+        self.recientes.agregar(*self.ultimo_frame)
+        for oyente in self.oyentes:
+            oyente(*self.ultimo_frame)
+        self.ranura.publicar(jpg)
+        if self.anillo is not None:
+            self.anillo.publicar(jpg)
+
+        ahora = time.time()
+        if self._marca_anterior is not None and ahora > self._marca_anterior:
+            self._fps = 0.9 * self._fps + 0.1 / (ahora - self._marca_anterior)
+            CAMARA_FPS.fijar(round(self._fps, 2))
+        self._marca_anterior = ahora
+        CAMARA_FRAMES.inc()
+        CAMARA_ULTIMO_FRAME.fijar(ahora)
+
+    def _bucle(self):
+        """
+        Lee el stream HTTP byte a byte (PROXY).
+        Evita problemas de OpenCV/FFmpeg con streams remotos.
+        """
+        while not self._detener.is_set():
+            res = None
+            try:
+                if not self.url_stream:
+                    self._espera("URL NO DEFINIDA", 2)
+                    continue
+
+                res = requests.get(self.url_stream, stream=True, timeout=5)
+
+                if res.status_code != 200:
+                    CAMARA_RECONEXIONES.etiquetar("http").inc()
+                    self._espera(f"ERROR {res.status_code}", 2)
+                    continue
+
+                demux = DemuxMJPEG()
+                for chunk in res.iter_content(chunk_size=4096):
+                    if not chunk or self._detener.is_set(): break
+                    CAMARA_BYTES.inc(len(chunk))
+
+                    resincronizaciones = demux.resincronizaciones
+                    largos_invalidos = demux.largos_invalidos
+                    for jpg in demux.alimentar(chunk):
+                        self._publicar_frame(jpg)
+
+                    if demux.largos_invalidos != largos_invalidos:
+                        CAMARA_LARGOS_INVALIDOS.inc(demux.largos_invalidos - largos_invalidos)
+                    # Si leemos y leemos y no encontramos fin de frame, quizás estamos desincronizados
+                    if demux.resincronizaciones != resincronizaciones:
+                        CAMARA_RESINCRONIZACIONES.inc(demux.resincronizaciones - resincronizaciones)
+                        self._espera("RESINCRONIZANDO...")
+
+                if not self._detener.is_set():
+                    CAMARA_RECONEXIONES.etiquetar("fin_stream").inc()
+
+            except requests.exceptions.ReadTimeout:
+                CAMARA_RECONEXIONES.etiquetar("timeout").inc()
+                logger.warning("Stream pausado (Posiblemente ESP32 ocupado)...")
+                self._espera("ESPERANDO... (TIMEOUT)", 1)
+            except Exception as e:
+                CAMARA_RECONEXIONES.etiquetar("error").inc()
+                logger.error(f"Error stream: {e}")
+                self._espera("INTENTANDO RECONECTAR...", 2)
+            finally:
+                try:
+                    res.close()
+                except: pass
@@ -0,0 +1,132 @@
+import collections
+import logging
+import os
+import threading
+import time
+
+from paho.mqtt.client import topic_matches_sub
+
+from metricas import MQTT_COLA, MQTT_ESPERA, MQTT_DESCARTADOS, MQTT_PROCESAMIENTO
+
+logger = logging.getLogger(__name__)
+
+# Configuración (ajustable por .env)
+COLA_MAXIMA = int(os.getenv("MQTT_COLA_MAXIMA", 1000))  # Mensajes esperando a ser procesados
+
+# Prioridades: menor número = se atiende antes
+PRIORIDAD_ALTA = 0    # estado de la caja
+PRIORIDAD_MEDIA = 1   # estado del reconocimiento
+PRIORIDAD_BAJA = 2    # logs y alertas
+NIVELES = 3
+
+Ruta = collections.namedtuple("Ruta", "nombre patron prioridad manejador")
+
+
+class Enrutador:
+    """Tabla de rutas: patrón de tópico MQTT (con + y #) -> prioridad y manejador. Gana la primera."""
+
+    def __init__(self):
+        self.rutas = []
+        self._cache = {}
+
+    def agregar(self, nombre, patron, prioridad, manejador):
+        self.rutas.append(Ruta(nombre, patron, prioridad, manejador))
+        self._cache.clear()
+
+    def resolver(self, topico):
+        """La ruta del tópico o None. El resultado se recuerda: los tópicos se repiten."""
+        try:
+            return self._cache[topico]
+        except KeyError:
+            pass
+        ruta = next((r for r in self.rutas if topic_matches_sub(r.patron, topico)), None)
+        if len(self._cache) > 1024:
+            self._cache.clear()  # Tópicos arbitrarios no hacen crecer la cache sin límite
+        self._cache[topico] = ruta
+        return ruta
+
+
+class ColaIngesta:
+    """
+    Cola acotada entre el hilo de red de paho y un hilo procesador.
+
+    El callback de paho solo resuelve la ruta y encola; el procesador atiende
+    primero la prioridad más alta, así una ráfaga de logs no demora el estado.
+    Con la cola llena se descarta el mensaje más viejo de la prioridad más baja
+    (nunca uno más importante que el que llega).
+    """
+
+    def __init__(self, enrutador, capacidad=COLA_MAXIMA):
+        self.enrutador = enrutador
+        self.capacidad = capacidad
+        self.colas = [collections.deque() for _ in range(NIVELES)]
+        self.pendientes = 0
+        self.procesando = False
+        self._cond = threading.Condition()
+        self._activo = False
+        self._hilo = None
+        MQTT_COLA.calcular_con(lambda: self.pendientes)
+
+    def encolar(self, topico, payload, retain=0):
+        """Desde el hilo de paho. False si el tópico no tiene ruta o el mensaje se descartó."""
+        ruta = self.enrutador.resolver(topico)
+        if ruta is None:
+            return False
+        with self._cond:
+            if self.pendientes >= self.capacidad and not self._descartar(ruta.prioridad):
+                MQTT_DESCARTADOS.etiquetar(ruta.nombre).inc()
+                return False
+            self.colas[ruta.prioridad].append((time.monotonic(), ruta, topico, payload, retain))
+            self.pendientes += 1
+            self._cond.notify()
+        return True
+
+    def _descartar(self, prioridad):
+        for nivel in range(NIVELES - 1, prioridad - 1, -1):
+            if self.colas[nivel]:
+                _, ruta, _, _, _ = self.colas[nivel].popleft()
+                self.pendientes -= 1
+                MQTT_DESCARTADOS.etiquetar(ruta.nombre).inc()
+                return True
+        return False
+
+    def iniciar(self):
+        if self._hilo is None:
+            self._activo = True
+            self._hilo = threading.Thread(target=self._bucle, name="mqtt-ingesta", daemon=True)
+            self._hilo.start()
+
+    def detener(self):
+        if self._hilo is not None:
+            with self._cond:
+                self._activo = False
+                self._cond.notify_all()
+            self._hilo.join(timeout=5)
+            self._hilo = None
+
+    def esperar(self, timeout=None):
+        """Bloquea hasta que no quede nada pendiente (benchmarks, apagado)."""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self.pendientes and not self.procesando, timeout)
+
+    def _bucle(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self.pendientes or not self._activo)
+                if not self._activo:
+                    return
+                cola = next(c for c in self.colas if c)
+                llegada, ruta, topico, payload, retain = cola.popleft()
+                self.pendientes -= 1
+                self.procesando = True
+
+            MQTT_ESPERA.etiquetar(ruta.nombre).observar(time.monotonic() - llegada)
+            try:
+                with MQTT_PROCESAMIENTO.cronometrar():
+                    ruta.manejador(topico, payload.decode('utf-8', 'replace'), retain)
+            except Exception as e:
+                logger.error(f"Error procesando mensaje de {topico}: {e}")
+            finally:
+                with self._cond:
+                    self.procesando = False
+                    self._cond.notify_all()
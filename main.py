@@ -1,14 +1,20 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, Query, HTTPException, File, UploadFile
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, StreamingResponse, PlainTextResponse, JSONResponse, Response, FileResponse
 from pydantic import BaseModel
 import asyncio
 import logging
 import os
+import shutil
+import tempfile
+import time
 from dotenv import load_dotenv
-from mqtt_client import manejadorMqtt, TOPICO_COMANDO
-from camera_facial import sistema_facial
+from mqtt_client import manejadorMqtt
+from dispositivos import registro_dispositivos
+from metricas import REGISTRO
+import importacion
+import clips
 
 # Cargar variables de entorno
 load_dotenv()
@@ -21,8 +27,17 @@ CAMERA_STREAM_URL = "/video_feed"
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+INICIO = time.monotonic()
+
 app = FastAPI(title="Control Caja Fuerte IoT")
 
+def _dispositivo(dispositivo=None):
+    """Dispositivo del registro; sin id, el por defecto (rutas de una sola caja)."""
+    try:
+        return registro_dispositivos.obtener(dispositivo)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Dispositivo desconocido: {dispositivo}")
+
 # Montar Archivos Estáticos
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
@@ -30,77 +45,274 @@ templates = Jinja2Templates(directory="templates")
 @app.on_event("startup")
 async def eventoInicio():
     loop = asyncio.get_event_loop()
-    # Mqtt se inicia con el loop actual. La gestión de clientes se realiza en /ws.
+    # Mqtt se inicia con el loop actual: una conexión para todas las cajas. La gestión de clientes se realiza en /ws.
     manejadorMqtt.iniciar(loop)
+    # Una sola conexión a cada ESP32 para todos los visores de su /video_feed
+    registro_dispositivos.iniciar()
 
 @app.on_event("shutdown")
 async def eventoCierre():
     manejadorMqtt.detener()
-    sistema_facial.detener_escaneo()
+    await manejadorMqtt.detener_difusion()
+    registro_dispositivos.detener()
 
 @app.get("/", response_class=HTMLResponse)
-async def obtenerInicio(request: Request):
+async def obtenerInicio(request: Request, dispositivo: str | None = None):
+    # /?dispositivo=<id> muestra el panel de esa caja (app.js toma el id de la URL)
+    _dispositivo(dispositivo)
     return templates.TemplateResponse("index.html", {
         "request": request,
-        "camera_stream_url": CAMERA_STREAM_URL,
+        "camera_stream_url": f"{CAMERA_STREAM_URL}/{dispositivo}" if dispositivo else CAMERA_STREAM_URL,
         "system_status": "ESPERA"
     })
 
+@app.get("/api/dispositivos")
+async def listar_dispositivos():
+    return [d.resumen() for d in registro_dispositivos]
+
 @app.get("/video_feed")
-async def video_feed():
-    return StreamingResponse(sistema_facial.generar_frames(), media_type="multipart/x-mixed-replace; boundary=frame")
+@app.get("/video_feed/{dispositivo}")
+async def video_feed(dispositivo: str | None = None,
+                     w: int | None = Query(None, ge=80, le=1600),
+                     fps: float | None = Query(None, gt=0, le=30),
+                     q: int | None = Query(None, ge=10, le=95),
+                     auto: bool | None = None,
+                     overlay: bool = False):
+    """
+    MJPEG de la cámara. ?w=320&fps=5&q=60 fija el nivel; sin parámetros se adapta
+    a lo que el cliente alcanza a recibir (?auto=0 entrega el stream original).
+    ?overlay=1 dibuja los rostros detectados con su nombre.
+    """
+    facial = _dispositivo(dispositivo).facial
+    automatico = auto if auto is not None else (w is None and fps is None and q is None)
+    return StreamingResponse(facial.generar_frames(w, fps, q, automatico, overlay),
+                             media_type="multipart/x-mixed-replace; boundary=frame")
+
+@app.get("/health/ready")
+async def salud_listo():
+    """
+    Progreso del arranque en frío. La app atiende desde el primer segundo; esto informa
+    cuándo el reconocimiento está a punto: 200 listo, 503 mientras carga dlib o la galería.
+    """
+    galerias = {d.id: d.facial.progreso_galeria for d in registro_dispositivos}
+    motor = registro_dispositivos.motor.listo
+    listo = motor and all(g["estado"] == "listo" for g in galerias.values())
+    return JSONResponse({
+        "listo": listo,
+        "segundos": round(time.monotonic() - INICIO, 2),
+        "motor": motor,
+        "galerias": galerias,
+    }, status_code=200 if listo else 503)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metricas():
+    # Formato de texto de Prometheus
+    return PlainTextResponse(REGISTRO.exponer(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/api/logs")
+@app.get("/api/logs/{dispositivo}")
+async def obtener_logs(dispositivo: str | None = None, since: int | None = None,
+                       limit: int = Query(100, ge=1, le=1000)):
+    """Historial de logs y alertas. Para paginar, pasar como `since` el `siguiente` de la respuesta anterior."""
+    return _dispositivo(dispositivo).caja.historial.pagina(since, limit)
 
 @app.post("/api/scan/start")
 async def iniciar_escaneo():
     return {"estado": "exito", "mensaje": "Escaneo iniciado"}
 
 @app.post("/api/scan-face")
-async def verificar_rostro():
-    resultado = sistema_facial.verificar_identidad()
+@app.post("/api/scan-face/{dispositivo}")
+async def verificar_rostro(dispositivo: str | None = None, rafaga: bool | None = None):
+    # El reconocimiento corre en el pool de procesos (compartido, con turnos por cámara):
+    # el loop sigue atendiendo WebSockets y MQTT. ?rafaga=1 decide entre varios frames recientes.
+    resultado = await _dispositivo(dispositivo).facial.verificar_identidad_async(rafaga)
     return resultado
 
+@app.get("/api/facial/estadisticas")
+@app.get("/api/facial/estadisticas/{dispositivo}")
+async def estadisticas_facial(dispositivo: str | None = None):
+    return _dispositivo(dispositivo).facial.estadisticas()
+
 class RegistroData(BaseModel):
     nombre: str
     imagen: str | None = None # Base64 opcional
 
 @app.post("/api/register-face")
-async def register_face(data: RegistroData):
+@app.post("/api/dispositivos/{dispositivo}/register-face")
+async def register_face(data: RegistroData, dispositivo: str | None = None):
     """Registra el rostro. Si viene 'imagen', usa esa. Si no, usa el stream."""
-    resultado = sistema_facial.registrar_usuario(data.nombre, data.imagen)
-    return resultado
+    facial = _dispositivo(dispositivo).facial
+    # Codificar con dlib tarda: fuera del event loop
+    return await asyncio.to_thread(facial.registrar_usuario, data.nombre, data.imagen)
+
+@app.post("/api/rostros/{nombre}/muestras")
+@app.post("/api/dispositivos/{dispositivo}/rostros/{nombre}/muestras")
+def agregar_muestras(nombre: str, muestras: list[UploadFile] = File(...), dispositivo: str | None = None):
+    """Varias fotos de una misma persona (multipart, campo 'muestras'); se suman a las que ya tenga."""
+    facial = _dispositivo(dispositivo).facial
+    imagenes = []
+    for muestra in muestras:
+        datos = muestra.file.read(importacion.MAX_IMAGEN + 1)
+        if len(datos) > importacion.MAX_IMAGEN:
+            raise HTTPException(status_code=413, detail=f"{muestra.filename}: imagen demasiado grande")
+        imagenes.append(datos)
+    return facial.agregar_muestras(nombre, imagenes)
+
+@app.post("/api/rostros/importar", status_code=202)
+@app.post("/api/dispositivos/{dispositivo}/rostros/importar", status_code=202)
+async def importar_rostros(request: Request, dispositivo: str | None = None):
+    """
+    Alta masiva: el cuerpo es un .zip o .tar(.gz) con una carpeta (o una imagen) por persona.
+    Responde enseguida; el progreso se consulta en GET .../importar/{id} y llega por WebSocket.
+    """
+    facial = _dispositivo(dispositivo).facial
+    if any(i.en_curso for i in facial.importaciones.values()):
+        raise HTTPException(status_code=409, detail="Ya hay una importación en curso")
+
+    # El archivo puede ser grande: a disco a medida que llega, sin tenerlo entero en memoria
+    descriptor, ruta = tempfile.mkstemp(suffix=".importacion")
+    recibidos = 0
+    try:
+        with os.fdopen(descriptor, "wb") as f:
+            async for bloque in request.stream():
+                recibidos += len(bloque)
+                if recibidos > importacion.MAX_ARCHIVO:
+                    raise HTTPException(status_code=413, detail="Archivo demasiado grande")
+                f.write(bloque)
+    except BaseException:
+        os.remove(ruta)
+        raise
+
+    nueva = facial.importar(ruta)
+    if nueva is None:
+        os.remove(ruta)
+        raise HTTPException(status_code=409, detail="Ya hay una importación en curso")
+    return nueva.estado
+
+@app.get("/api/rostros/importar/{id_importacion}")
+@app.get("/api/dispositivos/{dispositivo}/rostros/importar/{id_importacion}")
+async def estado_importacion(id_importacion: str, dispositivo: str | None = None):
+    importacion_pedida = _dispositivo(dispositivo).facial.importaciones.get(id_importacion)
+    if importacion_pedida is None:
+        raise HTTPException(status_code=404, detail=f"Importación desconocida: {id_importacion}")
+    return importacion_pedida.estado
+
+@app.delete("/api/register-face/{nombre}")
+@app.delete("/api/dispositivos/{dispositivo}/register-face/{nombre}")
+async def eliminar_rostro(nombre: str, dispositivo: str | None = None):
+    facial = _dispositivo(dispositivo).facial
+    # Lock del índice, borrado y reescritura: fuera del event loop (puede esperar a una sincronización)
+    return await asyncio.to_thread(facial.eliminar_usuario, nombre)
+
+def _clip(dispositivo, id_clip):
+    carpeta = _dispositivo(dispositivo).facial.clips.carpeta
+    try:
+        return clips.Clip(carpeta, id_clip)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Clip desconocido: {id_clip}")
+
+@app.get("/api/clips")
+@app.get("/api/dispositivos/{dispositivo}/clips")
+async def listar_clips(dispositivo: str | None = None):
+    """Clips de incidentes grabados, del más nuevo al más viejo."""
+    return clips.listar(_dispositivo(dispositivo).facial.clips.carpeta)
+
+@app.get("/api/clips/{id_clip}")
+@app.get("/api/dispositivos/{dispositivo}/clips/{id_clip}")
+async def obtener_clip(id_clip: str, dispositivo: str | None = None):
+    """Metadata y rango de tiempo de cada segmento (para pedir .../segmentos/{n} con Range)."""
+    return _clip(dispositivo, id_clip).resumen()
+
+@app.get("/api/clips/{id_clip}/frame")
+@app.get("/api/dispositivos/{dispositivo}/clips/{id_clip}/frame")
+async def frame_clip(id_clip: str, t: float = Query(0, ge=0), dispositivo: str | None = None):
+    """El JPEG original en el segundo t del clip (búsqueda por el índice, sin leer el resto)."""
+    clip = _clip(dispositivo, id_clip)
+    if not len(clip):
+        raise HTTPException(status_code=404, detail="Clip sin frames")
+    return Response(clip.frame(clip.posicion(t)), media_type="image/jpeg")
+
+@app.get("/api/clips/{id_clip}/video")
+@app.get("/api/dispositivos/{dispositivo}/clips/{id_clip}/video")
+async def video_clip(id_clip: str, t: float = Query(0, ge=0), velocidad: float = Query(1, gt=0, le=16),
+                     dispositivo: str | None = None):
+    """Reproduce el clip como MJPEG (sirve en un <img>) desde el segundo t, con sus tiempos originales."""
+    clip = _clip(dispositivo, id_clip)
+
+    async def partes():
+        async for jpg in clip.reproducir(t, velocidad):
+            yield b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + jpg + b'\r\n'
+
+    return StreamingResponse(partes(), media_type="multipart/x-mixed-replace; boundary=frame")
+
+@app.get("/api/clips/{id_clip}/segmentos/{segmento}")
+@app.get("/api/dispositivos/{dispositivo}/clips/{id_clip}/segmentos/{segmento}")
+async def segmento_clip(id_clip: str, segmento: int, dispositivo: str | None = None):
+    """Un segmento tal cual (JPEGs concatenados). Admite Range: con el índice se pide justo un tramo."""
+    clip = _clip(dispositivo, id_clip)
+    try:
+        ruta = clip.ruta_segmento(segmento)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Segmento desconocido: {segmento}")
+    return FileResponse(ruta, media_type="video/x-motion-jpeg", filename=f"{id_clip}-{segmento:03d}.mjpeg")
+
+@app.get("/api/clips/{id_clip}/indice")
+@app.get("/api/dispositivos/{dispositivo}/clips/{id_clip}/indice")
+async def indice_clip(id_clip: str, dispositivo: str | None = None):
+    """Índice binario: un registro por frame, little-endian <dHII (marca, segmento, offset, largo)."""
+    clip = _clip(dispositivo, id_clip)
+    return Response(clip.indice.tobytes(), media_type="application/octet-stream")
+
+@app.delete("/api/clips/{id_clip}")
+@app.delete("/api/dispositivos/{dispositivo}/clips/{id_clip}")
+async def eliminar_clip(id_clip: str, dispositivo: str | None = None):
+    clip = _clip(dispositivo, id_clip)
+    await asyncio.to_thread(shutil.rmtree, clip.ruta, True)
+    return {"status": "OK", "mensaje": f"Clip {id_clip} eliminado"}
 
 @app.post("/api/comando/{accion}")
-async def enviarComando(accion: str):
+@app.post("/api/comando/{dispositivo}/{accion}")
+async def enviarComando(accion: str, dispositivo: str | None = None):
+    caja = _dispositivo(dispositivo).caja
     accion = accion.upper()
     if accion in ["ABRIR", "CERRAR"]:
-        manejadorMqtt.publicar(TOPICO_COMANDO, accion)
+        caja.publicar(caja.topico_comando, accion)
         return {"estado": "exito", "mensaje": f"Comando {accion} enviado"}
     return {"estado": "error", "mensaje": "Comando inválido"}
 
 @app.websocket("/ws")
-async def endpointWebsocket(websocket: WebSocket):
+@app.websocket("/ws/{dispositivo}")
+async def endpointWebsocket(websocket: WebSocket, dispositivo: str | None = None):
+    try:
+        caja = registro_dispositivos.obtener(dispositivo).caja
+    except KeyError:
+        await websocket.close(code=1008)
+        return
     await websocket.accept()
 
-    async def enviarMensaje(tipo, datos):
-        await websocket.send_json({"tipo": tipo, "datos": datos})
-    
-    # Registrar este cliente para recibir actualizaciones MQTT
-    manejadorMqtt.registrar_cliente(enviarMensaje)
+    async def cerrar():
+        # Política "desconectar": el cliente no daba abasto, que reconecte
+        await websocket.close(code=1013)
+
+    # Registrar este cliente para recibir actualizaciones MQTT.
+    # Solo la tarea del hub escribe en el socket: todo pasa por su cola.
+    cliente = caja.registrar_cliente(websocket.send_json, cerrar)
 
     try:
-        # 1. Enviar estado actual (cached en manejadorMqtt)
-        await enviarMensaje("estado", manejadorMqtt.estadoActual)
+        # 1. Enviar estado actual (cached en la caja)
+        cliente.encolar("estado", caja.estadoActual)
 
-        # 2. Enviar historial de logs (en memoria)
-        for log in reversed(manejadorMqtt.historialLogs):
-            await websocket.send_json(log)
+        # 2. Enviar en un solo mensaje lo que el navegador se perdió desde su último evento (?desde=id)
+        desde = websocket.query_params.get("desde")
+        desde = int(desde) if desde and desde.isdigit() else None
+        cliente.encolar("historial", caja.historial.para_reconexion(desde))
         
         while True:
             # Mantener conexión viva y escuchar comandos desde el Front
             data = await websocket.receive_text()
             # ... Logica de comandos (opcional si se enviaran por WS) ...
     except WebSocketDisconnect:
-        manejadorMqtt.deregistrar_cliente(enviarMensaje)
+        caja.deregistrar_cliente(cliente)
     except Exception as e:
         print(f"Error en WebSocket: {e}")
-        manejadorMqtt.deregistrar_cliente(enviarMensaje)
+        caja.deregistrar_cliente(cliente)
@@ -0,0 +1,256 @@
+import bisect
+import threading
+import time
+
+# Métricas en formato de texto de Prometheus, sin dependencias externas.
+# Las familias se declaran al final de este archivo y cada módulo importa las que usa.
+
+BUCKETS_DEFECTO = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escapar(valor):
+    return str(valor).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _numero(valor):
+    if valor == float('inf'):
+        return "+Inf"
+    return repr(float(valor)) if isinstance(valor, float) and not valor.is_integer() else str(int(valor))
+
+
+class Registro:
+    def __init__(self):
+        self._familias = []
+        self._lock = threading.Lock()
+
+    def registrar(self, familia):
+        with self._lock:
+            self._familias.append(familia)
+
+    def exponer(self):
+        """Todas las métricas en el formato de exposición de texto (versión 0.0.4)."""
+        lineas = []
+        for familia in list(self._familias):
+            lineas.append(f"# HELP {familia.nombre} {familia.ayuda}")
+            lineas.append(f"# TYPE {familia.nombre} {familia.tipo}")
+            lineas.extend(familia.muestras())
+        return "\n".join(lineas) + "\n"
+
+
+REGISTRO = Registro()
+
+
+class _Familia:
+    """Una métrica con nombre; cada combinación de valores de etiquetas es un hijo independiente."""
+
+    tipo = None
+
+    def __init__(self, nombre, ayuda, etiquetas=(), registro=REGISTRO):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._hijos = {}
+        self._lock = threading.Lock()
+        registro.registrar(self)
+        if not self.etiquetas:
+            self._raiz = self.etiquetar()
+
+    def etiquetar(self, *valores):
+        hijo = self._hijos.get(valores)
+        if hijo is None:
+            if len(valores) != len(self.etiquetas):
+                raise ValueError(f"{self.nombre} espera las etiquetas {self.etiquetas}")
+            with self._lock:
+                hijo = self._hijos.setdefault(valores, self._nuevo_hijo())
+        return hijo
+
+    def _selector(self, valores, extra=None):
+        pares = [f'{k}="{_escapar(v)}"' for k, v in zip(self.etiquetas, valores)]
+        if extra:
+            pares.append(extra)
+        return "{" + ",".join(pares) + "}" if pares else ""
+
+    def muestras(self):
+        for valores, hijo in sorted(self._hijos.items()):
+            yield f"{self.nombre}{self._selector(valores)} {_numero(hijo.valor())}"
+
+
+class _Valor:
+    def __init__(self):
+        self._valor = 0.0
+        self._lock = threading.Lock()
+        self._funcion = None
+
+    def inc(self, n=1):
+        with self._lock:
+            self._valor += n
+
+    def dec(self, n=1):
+        with self._lock:
+            self._valor -= n
+
+    def fijar(self, valor):
+        self._valor = valor
+
+    def valor(self):
+        return self._funcion() if self._funcion else self._valor
+
+    def calcular_con(self, funcion):
+        """El valor se calcula recién al exponer (p.ej. leído de otro proceso)."""
+        self._funcion = funcion
+
+
+class Contador(_Familia):
+    tipo = "counter"
+
+    def _nuevo_hijo(self):
+        return _Valor()
+
+    def inc(self, n=1):
+        self._raiz.inc(n)
+
+
+class Medidor(_Familia):
+    """Gauge. Con `funcion` el valor se calcula recién al exponer (costo cero en el camino crítico)."""
+
+    tipo = "gauge"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), registro=REGISTRO, funcion=None):
+        super().__init__(nombre, ayuda, etiquetas, registro)
+        if funcion is not None:
+            self.calcular_con(funcion)
+
+    def _nuevo_hijo(self):
+        return _Valor()
+
+    def inc(self, n=1):
+        self._raiz.inc(n)
+
+    def dec(self, n=1):
+        self._raiz.dec(n)
+
+    def fijar(self, valor):
+        self._raiz.fijar(valor)
+
+    def calcular_con(self, funcion):
+        self._raiz.calcular_con(funcion)
+
+
+class _ValorHistograma:
+    def __init__(self, limites):
+        self.limites = limites
+        self.cuentas = [0] * (len(limites) + 1)
+        self.suma = 0.0
+        self._lock = threading.Lock()
+
+    def observar(self, valor):
+        i = bisect.bisect_left(self.limites, valor)
+        with self._lock:
+            self.cuentas[i] += 1
+            self.suma += valor
+
+    def cronometrar(self):
+        return _Cronometro(self)
+
+
+class _Cronometro:
+    def __init__(self, destino):
+        self.destino = destino
+
+    def __enter__(self):
+        self.inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.destino.observar(time.perf_counter() - self.inicio)
+
+
+class Histograma(_Familia):
+    tipo = "histogram"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), registro=REGISTRO, buckets=BUCKETS_DEFECTO):
+        self.limites = tuple(sorted(buckets))
+        super().__init__(nombre, ayuda, etiquetas, registro)
+
+    def _nuevo_hijo(self):
+        return _ValorHistograma(self.limites)
+
+    def observar(self, valor):
+        self._raiz.observar(valor)
+
+    def cronometrar(self):
+        return _Cronometro(self._raiz)
+
+    def muestras(self):
+        for valores, hijo in sorted(self._hijos.items()):
+            with hijo._lock:
+                cuentas, suma = list(hijo.cuentas), hijo.suma
+            acumulado = 0
+            for limite, cuenta in zip(self.limites + (float('inf'),), cuentas):
+                acumulado += cuenta
+                le = 'le="%s"' % _numero(limite)
+                yield f"{self.nombre}_bucket{self._selector(valores, le)} {acumulado}"
+            yield f"{self.nombre}_sum{self._selector(valores)} {_numero(suma)}"
+            yield f"{self.nombre}_count{self._selector(valores)} {acumulado}"
+
+
+# --- Catálogo ---
+
+# Cámara (ingesta.py)
+CAMARA_FRAMES = Contador("enclave_camara_frames_total", "Frames JPEG recibidos del ESP32")
+CAMARA_BYTES = Contador("enclave_camara_bytes_total", "Bytes leídos del stream del ESP32")
+CAMARA_FPS = Medidor("enclave_camara_fps", "fps de entrada (promedio móvil)")
+CAMARA_ULTIMO_FRAME = Medidor("enclave_camara_ultimo_frame_timestamp_segundos",
+                              "Hora Unix del último frame real recibido")
+CAMARA_RECONEXIONES = Contador("enclave_camara_reconexiones_total",
+                               "Cortes del stream que obligaron a reconectar", ["motivo"])
+CAMARA_RESINCRONIZACIONES = Contador("enclave_camara_resincronizaciones_total",
+                                     "Buffer descartado por no encontrar el fin de un frame")
+CAMARA_LARGOS_INVALIDOS = Contador("enclave_camara_largos_invalidos_total",
+                                   "Content-Length que no coincidió con el JPEG")
+
+# Visores de /video_feed
+VIDEO_VISORES = Medidor("enclave_video_visores", "Clientes conectados a /video_feed")
+VIDEO_FRAMES = Contador("enclave_video_frames_enviados_total", "Frames entregados a los visores")
+VIDEO_BYTES = Contador("enclave_video_bytes_enviados_total", "Bytes entregados a los visores")
+VIDEO_VARIANTES = Medidor("enclave_video_variantes", "Variantes (resolución y calidad) con visores activos")
+VIDEO_TRANSCODIFICACIONES = Contador("enclave_video_transcodificaciones_total",
+                                     "Frames reescalados/recomprimidos, uno por frame y variante", ["variante"])
+VIDEO_CAMBIOS_NIVEL = Contador("enclave_video_cambios_nivel_total",
+                               "Cambios de nivel automático por visor", ["direccion"])
+
+# Reconocimiento
+RECONOCIMIENTO_ESCANEOS = Contador("enclave_reconocimiento_escaneos_total",
+                                   "Escaneos pedidos por resultado", ["resultado"])
+RECONOCIMIENTO_DURACION = Histograma("enclave_reconocimiento_duracion_segundos",
+                                     "Duración de punta a punta por operación", ["operacion"])
+RECONOCIMIENTO_ETAPA = Histograma("enclave_reconocimiento_etapa_segundos",
+                                  "Duración de cada etapa del preprocesado/reconocimiento", ["etapa"],
+                                  buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+RECONOCIMIENTO_CACHE = Contador("enclave_reconocimiento_cache_total",
+                                "Escaneos resueltos por el cache de resultados (acierto) o calculados (fallo)",
+                                ["resultado"])
+RECONOCIMIENTO_COLA = Medidor("enclave_reconocimiento_cola", "Escaneos esperando un proceso libre")
+GALERIA_CARGA = Histograma("enclave_galeria_carga_segundos", "Duración de cargar_referencia",
+                           buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300))
+GALERIA_ENCODINGS = Medidor("enclave_galeria_encodings", "Encodings en la galería publicada")
+
+# MQTT (mqtt_client.py)
+MQTT_MENSAJES = Contador("enclave_mqtt_mensajes_total", "Mensajes MQTT recibidos por tópico", ["topico"])
+MQTT_PROCESAMIENTO = Histograma("enclave_mqtt_procesamiento_segundos", "Tiempo del manejador de cada mensaje",
+                                buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.1))
+MQTT_COLA = Medidor("enclave_mqtt_cola", "Mensajes MQTT esperando al hilo de ingesta")
+MQTT_ESPERA = Histograma("enclave_mqtt_espera_segundos", "Demora entre la llegada y el procesamiento, por ruta",
+                         ["ruta"], buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+MQTT_DESCARTADOS = Contador("enclave_mqtt_descartados_total", "Mensajes descartados con la cola de ingesta llena",
+                            ["ruta"])
+MQTT_CONECTADO = Medidor("enclave_mqtt_conectado", "1 si hay sesión con el broker")
+MQTT_DESCONEXIONES = Contador("enclave_mqtt_desconexiones_total", "Desconexiones del broker")
+
+# WebSockets (/ws)
+WS_CLIENTES = Medidor("enclave_ws_clientes", "Clientes WebSocket conectados")
+WS_MENSAJES = Contador("enclave_ws_mensajes_enviados_total", "Mensajes enviados a WebSockets por tipo", ["tipo"])
+WS_PENDIENTES = Medidor("enclave_ws_envios_pendientes", "Mensajes en las colas de los WebSockets")
+WS_DESCARTADOS = Contador("enclave_ws_descartados_total",
+                          "Mensajes que no llegaron a un WebSocket lento, por motivo", ["motivo"])
+WS_LOTES = Contador("enclave_ws_lotes_total", "Envíos que agruparon varios mensajes atrasados")
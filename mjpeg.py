@@ -0,0 +1,110 @@
+import re
+
+SOI = b'\xff\xd8'
+EOI = b'\xff\xd9'
+
+# Las cabeceras multipart del ESP32 van justo antes del JPEG; no hace falta mirar más atrás
+_VENTANA_CABECERAS = 512
+_RE_CONTENT_LENGTH = re.compile(rb'content-length:\s*(\d+)', re.IGNORECASE)
+
+
+class DemuxMJPEG:
+    """
+    Separador incremental de frames para streams multipart/x-mixed-replace.
+
+    Acumula los chunks en un único bytearray y recuerda hasta dónde ya buscó,
+    así cada byte se escanea una sola vez. Si la parte trae Content-Length se
+    salta el cuerpo completo sin buscar el marcador de fin; si no, se usan los
+    marcadores SOI (0xFF 0xD8) / EOI (0xFF 0xD9) como respaldo.
+    Cada frame se entrega como bytes copiados una única vez desde el buffer.
+    """
+
+    def __init__(self, limite_buffer=1 << 20):
+        self.limite_buffer = limite_buffer
+
+        self._buf = bytearray()
+        self._escaneo = 0   # Próxima posición a revisar (no se re-escanea lo ya visto)
+        self._soi = -1      # Inicio del frame en curso, -1 si aún no hay
+        self._largo = None  # Content-Length del frame en curso, si vino en la cabecera
+
+        # Contadores
+        self.frames = 0
+        self.bytes = 0
+        self.resincronizaciones = 0
+        self.largos_invalidos = 0
+
+    def alimentar(self, chunk):
+        """Agrega un chunk del stream y devuelve la lista de JPEGs completos."""
+        self._buf += chunk
+        self.bytes += len(chunk)
+
+        frames = []
+        consumido = 0
+        while True:
+            fin = self._siguiente(consumido)
+            if fin is None:
+                break
+            with memoryview(self._buf) as vista:
+                frames.append(bytes(vista[self._soi:fin]))
+            consumido = self._escaneo = fin
+            self._soi = -1
+            self._largo = None
+        self.frames += len(frames)
+
+        # Descartar lo ya consumido (bytearray recorta el inicio sin mover todo)
+        if consumido:
+            del self._buf[:consumido]
+            self._escaneo -= consumido
+            if self._soi >= 0:
+                self._soi -= consumido
+
+        # Si no aparece un frame completo en mucho tiempo estamos desincronizados
+        if len(self._buf) > self.limite_buffer:
+            self.reiniciar()
+            self.resincronizaciones += 1
+
+        return frames
+
+    def reiniciar(self):
+        self._buf.clear()
+        self._escaneo = 0
+        self._soi = -1
+        self._largo = None
+
+    def _siguiente(self, consumido):
+        """Devuelve la posición de fin del próximo frame completo, o None."""
+        buf = self._buf
+
+        if self._soi < 0:
+            soi = buf.find(SOI, self._escaneo)
+            if soi < 0:
+                # Conservar el último byte por si el marcador quedó partido entre chunks
+                self._escaneo = max(consumido, len(buf) - 1)
+                return None
+            self._soi = soi
+            self._largo = self._content_length(max(consumido, soi - _VENTANA_CABECERAS), soi)
+            self._escaneo = soi + 2
+
+        if self._largo is not None:
+            fin = self._soi + self._largo
+            if len(buf) < fin:
+                return None
+            if buf[fin - 2:fin] == EOI:
+                return fin
+            # Content-Length no coincide con el JPEG: seguir con marcadores
+            self._largo = None
+            self.largos_invalidos += 1
+
+        eoi = buf.find(EOI, self._escaneo)
+        if eoi < 0:
+            self._escaneo = max(self._soi + 2, len(buf) - 1)
+            return None
+        return eoi + 2
+
+    def _content_length(self, desde, hasta):
+        if hasta <= desde:
+            return None
+        encontrado = _RE_CONTENT_LENGTH.search(self._buf, desde, hasta)
+        if not encontrado:
+            return None
+        return int(encontrado.group(1))
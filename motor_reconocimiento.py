@@ -0,0 +1,404 @@
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from galeria import Galeria
+from metricas import RECONOCIMIENTO_CACHE
+from preprocesamiento import calentar
+from reconocimiento import reconocer_jpg, reconocer_rafaga, detectar_jpg, identificar_jpg
+
+logger = logging.getLogger(__name__)
+
+# Configuración (ajustable por .env)
+PROCESOS = int(os.getenv("RECONOCIMIENTO_PROCESOS", min(2, os.cpu_count() or 1)))
+CONCURRENCIA = int(os.getenv("RECONOCIMIENTO_CONCURRENCIA", PROCESOS))
+COLA_MAXIMA = int(os.getenv("RECONOCIMIENTO_COLA_MAX", 8))
+TIMEOUT_COLA = float(os.getenv("RECONOCIMIENTO_TIMEOUT_COLA", 5))
+TIMEOUT_PROCESO = float(os.getenv("RECONOCIMIENTO_TIMEOUT", 15))
+CACHE_TAMANO = int(os.getenv("RECONOCIMIENTO_CACHE_TAMANO", 64))
+CACHE_TTL = float(os.getenv("RECONOCIMIENTO_CACHE_TTL", 10))   # Segundos; 0 desactiva el cache
+NO_CACHEABLES = ("OCUPADO", "ERROR")                            # Fallas pasajeras: se reintenta
+
+# --- Lado del proceso trabajador ---
+# Los procesos viven lo mismo que el motor: dlib se carga una sola vez por proceso.
+# Cada tarea lleva la referencia de la galería de su dispositivo (versión y rutas de
+# una generación del índice en disco) y el proceso la vuelve a abrir solo si la que
+# tiene quedó vieja. Todos los procesos mapean la misma matriz y comparten sus
+# páginas en memoria.
+_galerias_trabajador = {}  # dispositivo -> (versión, Galeria)
+_GALERIA_VACIA = Galeria([], [])
+
+
+def _inicializar_trabajador():
+    calentar()
+
+
+def _galeria(dispositivo, referencia):
+    """Galería del dispositivo en la versión de la tarea: la cargada si sigue vigente."""
+    if referencia is None:
+        return _GALERIA_VACIA
+    version, encodings, nombres = referencia
+    cargada = _galerias_trabajador.get(dispositivo)
+    if cargada is not None and cargada[0] == version:
+        return cargada[1]
+    if isinstance(encodings, str):
+        encodings = np.load(encodings, mmap_mode='r')
+        with open(nombres, 'r', encoding='utf-8') as f:
+            nombres = json.load(f)
+    galeria = Galeria(encodings, nombres)
+    _galerias_trabajador[dispositivo] = (version, galeria)
+    return galeria
+
+
+def _reconocer_en_trabajador(dispositivo, referencia, jpg):
+    return reconocer_jpg(jpg, _galeria(dispositivo, referencia))
+
+
+def _reconocer_rafaga_en_trabajador(dispositivo, referencia, jpgs):
+    return reconocer_rafaga(jpgs, _galeria(dispositivo, referencia))
+
+
+def _detectar_en_trabajador(dispositivo, referencia, jpg):
+    return detectar_jpg(jpg)
+
+
+def _identificar_en_trabajador(dispositivo, referencia, jpg, ubicaciones):
+    return identificar_jpg(jpg, ubicaciones, _galeria(dispositivo, referencia))
+
+
+def _ping():
+    return os.getpid()
+
+
+class MotorOcupado(Exception):
+    """La cola del motor está llena o no llegó el turno a tiempo."""
+
+
+class TurnosJustos:
+    """
+    Cupos de procesamiento repartidos por turnos entre dispositivos.
+    Cuando se libera un cupo lo recibe el siguiente dispositivo con escaneos
+    esperando (round robin), no el escaneo más viejo: una cámara con muchos
+    pedidos no deja sin turno a las demás. Se usa solo desde el event loop.
+    """
+
+    def __init__(self, cupos):
+        self.libres = cupos
+        self.colas = collections.OrderedDict()  # dispositivo -> deque de futures, en orden de turno
+
+    async def adquirir(self, dispositivo):
+        if self.libres > 0 and not self.colas:
+            self.libres -= 1
+            return
+        futuro = asyncio.get_running_loop().create_future()
+        self.colas.setdefault(dispositivo, collections.deque()).append(futuro)
+        try:
+            await futuro
+        except asyncio.CancelledError:
+            if futuro.done() and not futuro.cancelled():
+                self.liberar()  # El cupo llegó junto con la cancelación: pasarlo al siguiente
+            else:
+                cola = self.colas.get(dispositivo)
+                if cola is not None and futuro in cola:
+                    cola.remove(futuro)
+                    if not cola:
+                        del self.colas[dispositivo]
+            raise
+
+    def liberar(self):
+        while self.colas:
+            dispositivo, cola = self.colas.popitem(last=False)
+            futuro = cola.popleft()
+            if cola:
+                self.colas[dispositivo] = cola  # Al final de la ronda
+            if not futuro.done():
+                futuro.set_result(None)
+                return
+        self.libres += 1
+
+    def esperando(self):
+        return sum(len(c) for c in self.colas.values())
+
+
+class CacheResultados:
+    """
+    LRU con vencimiento de resultados de reconocimiento. La clave es (dispositivo,
+    huella del JPEG, versión de la galería): el mismo frame escaneado dos veces
+    (doble clic, cámara quieta) no vuelve a pasar por CLAHE, HOG y dlib.
+    """
+
+    def __init__(self, tamano=CACHE_TAMANO, ttl=CACHE_TTL):
+        self.tamano = tamano
+        self.ttl = ttl
+        self._entradas = collections.OrderedDict()  # clave -> (vence, resultado)
+
+    @staticmethod
+    def huella(*jpgs):
+        h = hashlib.blake2b(digest_size=16)
+        for jpg in jpgs:
+            h.update(len(jpg).to_bytes(8, "little"))
+            h.update(jpg)
+        return h.digest()
+
+    def obtener(self, clave, ahora=None):
+        entrada = self._entradas.get(clave)
+        if entrada is None:
+            return None
+        if entrada[0] <= (ahora if ahora is not None else time.monotonic()):
+            del self._entradas[clave]
+            return None
+        self._entradas.move_to_end(clave)
+        return entrada[1]
+
+    def guardar(self, clave, resultado, ahora=None):
+        if self.ttl <= 0 or self.tamano <= 0:
+            return
+        self._entradas[clave] = ((ahora if ahora is not None else time.monotonic()) + self.ttl, resultado)
+        self._entradas.move_to_end(clave)
+        while len(self._entradas) > self.tamano:
+            self._entradas.popitem(last=False)
+
+    def invalidar(self, dispositivo):
+        """Descarta los resultados de un dispositivo (su galería cambió). Se puede llamar desde otro hilo."""
+        for clave in [c for c in list(self._entradas) if c[0] == dispositivo]:
+            self._entradas.pop(clave, None)
+
+    def __len__(self):
+        return len(self._entradas)
+
+
+class MotorReconocimiento:
+    """
+    Pool de procesos para el reconocimiento facial, compartido por todos los dispositivos.
+    Saca el trabajo de CPU (CLAHE, HOG, dlib) del event loop, limita la
+    concurrencia (con turnos justos entre cámaras), rechaza cuando la cola está
+    llena o se agota la espera, y une en un solo cálculo los escaneos simultáneos
+    sobre el mismo frame. Los resultados recientes quedan en un cache por frame.
+    """
+
+    def __init__(self, procesos=PROCESOS, concurrencia=CONCURRENCIA, cola_maxima=COLA_MAXIMA,
+                 timeout_cola=TIMEOUT_COLA, timeout_proceso=TIMEOUT_PROCESO):
+        self.procesos = procesos
+        self.concurrencia = concurrencia
+        self.cola_maxima = cola_maxima
+        self.timeout_cola = timeout_cola
+        self.timeout_proceso = timeout_proceso
+
+        # dispositivo -> (versión, .npy o matriz, .json o lista de nombres): viaja con cada tarea
+        self._galerias = {}
+        self.listo = False   # Algún proceso del pool actual ya cargó dlib (primer escaneo sin demora)
+        self._pool = None
+        self._loop = None    # Event loop de los turnos (lo fija iniciar)
+        self._turnos = None
+        self._esperando = 0
+        # (dispositivo, tipo, frames) -> Future compartido por los escaneos simultáneos
+        self._en_curso = {}
+        # Resultados por frame; la versión de la galería entra en la clave
+        self.cache = CacheResultados()
+        self._versiones = collections.defaultdict(int)  # dispositivo -> versión de su galería
+        self._lock = threading.Lock()
+
+    def _crear_pool(self):
+        # "spawn" evita heredar los hilos de paho/ingesta al hacer fork
+        return ProcessPoolExecutor(
+            max_workers=self.procesos,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_inicializar_trabajador,
+        )
+
+    def iniciar(self):
+        """
+        Arranca los procesos por adelantado para no pagar la carga de dlib en el primer escaneo.
+        No bloquea: los procesos cargan los modelos en segundo plano (ver `listo`).
+        Llamado desde el event loop, lo toma para los turnos de las tareas bloqueantes.
+        """
+        try:
+            self._loop = asyncio.get_running_loop()
+        except RuntimeError:
+            pass  # Sin event loop (scripts): las tareas bloqueantes van directo al pool
+        self._pool_actual()
+
+    def _pool_actual(self):
+        """El pool vigente; si no hay, lo crea y lo calienta. Seguro desde cualquier hilo."""
+        with self._lock:
+            if self._pool is not None:
+                return self._pool
+            pool = self._pool = self._crear_pool()
+            self.listo = False
+        for _ in range(self.procesos):
+            pool.submit(_ping).add_done_callback(lambda futuro: self._al_calentar(futuro, pool))
+        return pool
+
+    def _reemplazar_pool(self, roto):
+        """Un proceso murió (p.ej. dlib sin memoria): el pool queda inutilizable, se recrea una sola vez."""
+        with self._lock:
+            if self._pool is not roto:
+                return  # Otra tarea ya lo reemplazó
+            self._pool = None
+        logger.error("Pool de reconocimiento caído. Reiniciando procesos...")
+        roto.shutdown(wait=False, cancel_futures=True)
+        self._pool_actual()
+
+    def _al_calentar(self, futuro, pool):
+        # El aviso de un pool ya reemplazado no cuenta: sus procesos no atienden más tareas
+        if pool is self._pool and not futuro.cancelled() and futuro.exception() is None:
+            self.listo = True
+
+    def detener(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def actualizar_galeria(self, dispositivo, galeria, archivos=None):
+        """
+        Publica una nueva versión de la galería de un dispositivo sin tocar el pool:
+        las tareas siguientes llevan la versión nueva y cada proceso la abre al recibirla.
+        `archivos` son el .npy (mapeable) y el .json de nombres de una generación del
+        índice, con las mismas filas que la galería; sin ellos la matriz viaja en cada tarea.
+        """
+        with self._lock:
+            # Altas y bajas de rostros cambian el resultado de un mismo frame
+            self._versiones[dispositivo] += 1
+            version = self._versiones[dispositivo]
+            if archivos is not None:
+                referencia = (version, *archivos)
+            else:
+                referencia = (version, np.array(galeria.encodings), list(galeria.nombres))
+            galerias = dict(self._galerias)
+            galerias[dispositivo] = referencia
+            self._galerias = galerias
+        self.cache.invalidar(dispositivo)
+
+    # --- Uso bloqueante desde hilos en segundo plano (nunca desde el event loop) ---
+
+    def detectar(self, dispositivo, jpg):
+        """Ubicaciones de rostros en el frame original."""
+        return self._ejecutar_bloqueante(dispositivo, _detectar_en_trabajador, jpg)
+
+    def identificar(self, dispositivo, jpg, ubicaciones):
+        """Coincidencias en la galería del dispositivo para rostros ya ubicados."""
+        return self._ejecutar_bloqueante(dispositivo, _identificar_en_trabajador, jpg, ubicaciones)
+
+    def _ejecutar_bloqueante(self, dispositivo, funcion, *args):
+        """
+        Como los escaneos: la tarea espera su turno (TurnosJustos, en el event loop) y
+        cuenta para el límite de concurrencia. MotorOcupado si no hay lugar.
+        """
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            pool = self._pool_actual()
+            try:
+                return pool.submit(funcion, dispositivo, self._galerias.get(dispositivo), *args) \
+                    .result(timeout=self.timeout_proceso)
+            except BrokenProcessPool:
+                self._reemplazar_pool(pool)
+                raise
+        futuro = asyncio.run_coroutine_threadsafe(self._en_turno(dispositivo, funcion, *args), loop)
+        try:
+            return futuro.result(timeout=self.timeout_cola + self.timeout_proceso + 1)
+        except TimeoutError:
+            futuro.cancel()  # El loop no respondió (apagado)
+            raise
+
+    async def verificar(self, dispositivo, jpg, al_resultado=None):
+        """
+        Reconoce un JPEG contra la galería del dispositivo. `al_resultado` se ejecuta
+        una sola vez por cálculo, aunque varios escaneos simultáneos compartan el resultado
+        o lo tomen del cache (entonces viene con "cache": True).
+        """
+        return await self._verificar(dispositivo, "frame", (jpg,), _reconocer_en_trabajador, jpg, al_resultado)
+
+    async def verificar_rafaga(self, dispositivo, jpgs, al_resultado=None):
+        """
+        Como verificar, pero decide entre varios frames (reconocimiento.reconocer_rafaga).
+        Van juntos en una sola tarea del pool: un turno y un viaje entre procesos.
+        """
+        jpgs = tuple(jpgs)
+        return await self._verificar(dispositivo, "rafaga", jpgs, _reconocer_rafaga_en_trabajador, jpgs, al_resultado)
+
+    async def _verificar(self, dispositivo, tipo, frames, funcion, argumento, al_resultado):
+        clave_cache = (dispositivo, tipo, self.cache.huella(*frames), self._versiones[dispositivo])
+        guardado = self.cache.obtener(clave_cache)
+        if guardado is not None:
+            RECONOCIMIENTO_CACHE.etiquetar("acierto").inc()
+            return dict(guardado, cache=True)
+        RECONOCIMIENTO_CACHE.etiquetar("fallo").inc()
+
+        clave = (dispositivo, tipo, frames)
+        compartido = self._en_curso.get(clave)
+        if compartido is not None:
+            return await asyncio.shield(compartido)
+
+        futuro = asyncio.get_running_loop().create_future()
+        self._en_curso[clave] = futuro
+        try:
+            resultado = await self._ejecutar(dispositivo, funcion, argumento)
+            if resultado.get("status") not in NO_CACHEABLES:
+                self.cache.guardar(clave_cache, resultado)
+            if al_resultado:
+                al_resultado(resultado)
+            futuro.set_result(resultado)
+            return resultado
+        except BaseException as e:
+            futuro.set_exception(e)
+            # Evitar "exception was never retrieved" si nadie más esperaba
+            futuro.exception()
+            raise
+        finally:
+            del self._en_curso[clave]
+
+    async def _ejecutar(self, dispositivo, funcion, argumento):
+        try:
+            return await self._en_turno(dispositivo, funcion, argumento)
+        except MotorOcupado as e:
+            return {"status": "OCUPADO", "mensaje": str(e)}
+        except asyncio.TimeoutError:
+            logger.error("Reconocimiento excedió el tiempo límite")
+            return {"status": "ERROR", "mensaje": "El reconocimiento tardó demasiado"}
+        except BrokenProcessPool:
+            return {"status": "ERROR", "mensaje": "Motor de reconocimiento reiniciado. Intente nuevamente."}
+        except Exception as e:
+            logger.error(f"Error en el motor de reconocimiento: {e}")
+            return {"status": "ERROR", "mensaje": str(e)}
+
+    async def _en_turno(self, dispositivo, funcion, *args):
+        """
+        Corre funcion(dispositivo, galería vigente, *args) en el pool cuando le toca al dispositivo.
+        MotorOcupado si la cola está llena o no llega el turno; asyncio.TimeoutError si el proceso tarda demasiado.
+        """
+        if self._esperando >= self.cola_maxima:
+            raise MotorOcupado("Demasiados escaneos en curso. Intente nuevamente.")
+        if self._turnos is None:
+            self._turnos = TurnosJustos(self.concurrencia)
+
+        self._esperando += 1
+        try:
+            await asyncio.wait_for(self._turnos.adquirir(dispositivo), self.timeout_cola)
+        except asyncio.TimeoutError:
+            raise MotorOcupado("Tiempo de espera agotado. Intente nuevamente.") from None
+        finally:
+            self._esperando -= 1
+
+        try:
+            pool = self._pool_actual()
+            # La galería se toma al enviar la tarea: la versión más nueva, aunque haya esperado turno
+            tarea = asyncio.get_running_loop().run_in_executor(pool, funcion, dispositivo,
+                                                               self._galerias.get(dispositivo), *args)
+            try:
+                return await asyncio.wait_for(tarea, self.timeout_proceso)
+            except BrokenProcessPool:
+                self._reemplazar_pool(pool)
+                raise
+        finally:
+            self._turnos.liberar()
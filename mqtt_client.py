@@ -10,6 +10,12 @@ from typing import Callable, Optional
 import os
 from dotenv import load_dotenv
 
+from difusion import HubDifusion
+from estado_persistente import EstadoPersistente
+from historial import Historial
+from ingesta_mqtt import Enrutador, ColaIngesta, PRIORIDAD_ALTA, PRIORIDAD_MEDIA, PRIORIDAD_BAJA
+from metricas import MQTT_MENSAJES, MQTT_CONECTADO, MQTT_DESCONEXIONES, WS_CLIENTES, WS_PENDIENTES
+
 # Cargar variables de entorno
 load_dotenv()
 
@@ -18,166 +24,225 @@ BROKER = os.getenv("HIVEMQ_BROKER", "766bf786657c44d4b1b9079c887442da.s1.eu.hive
 PUERTO = int(os.getenv("HIVEMQ_PORT", 8883))
 USUARIO = os.getenv("HIVEMQ_USERNAME", "ruben")
 CONTRASEÑA = os.getenv("HIVEMQ_PASSWORD", "YCCKRD1v$bw4")
-PREFIJO_TOPICO = "enclave/caja"
+MQTT_TLS = os.getenv("MQTT_TLS", "1") == "1"  # 0 para un broker local (simulacion/broker.py)
+MQTT_PROTOCOLO = os.getenv("MQTT_PROTOCOLO", "5")  # "5" o "3.1.1"
+PREFIJO_TOPICO = "enclave/caja"  # Prefijo de la caja por defecto (sin registro de dispositivos)
 
-# Tópicos
+# Tópicos de la caja por defecto
 TOPICO_COMANDO = f"{PREFIJO_TOPICO}/comando"
 TOPICO_ESTADO = f"{PREFIJO_TOPICO}/estado"
 TOPICO_ALERTA = f"{PREFIJO_TOPICO}/alerta"
 TOPICO_LOG = f"{PREFIJO_TOPICO}/log"
+TOPICO_FACIAL_STATUS = f"{PREFIJO_TOPICO}/facial_status"
+
+class CajaMqtt:
+    """
+    Una caja fuerte vista por MQTT: sus tópicos (bajo su prefijo), su estado,
+    su historial y los WebSockets que la miran. Todas comparten la conexión de ClienteMqtt.
+    """
+
+    def __init__(self, conexion, id_dispositivo, prefijo=PREFIJO_TOPICO, datos="."):
+        self.conexion = conexion
+        self.id = id_dispositivo
+        self.prefijo = prefijo
+
+        # Tópicos
+        self.topico_comando = f"{prefijo}/comando"
+        self.topico_estado = f"{prefijo}/estado"
+        self.topico_alerta = f"{prefijo}/alerta"
+        self.topico_log = f"{prefijo}/log"
+        self.topico_facial_status = f"{prefijo}/facial_status"
+
+        # Difusión a los WebSockets de FastAPI (Soporte Multi-Cliente)
+        self.difusion = HubDifusion()
+        
+        # Modo Simulación (Desactivado si hay dispositivo real)
+        self.modoSimulacion = False 
+        
+        # Persistencia de Estado: solo transiciones reales, escritas en segundo plano (state.json)
+        # Siempre iniciar CERRADO por seguridad; el estado retenido del broker lo corrige al conectar
+        os.makedirs(datos, exist_ok=True)
+        self.estadoPersistente = EstadoPersistente(os.path.join(datos, "state.json"), inicial="CERRADO")
+        
+        # Logs y alertas: buffer en RAM + SQLite, sobrevive a reinicios
+        self.historial = Historial(os.path.join(datos, "historial.db"))
+        self.oyentes = []  # Funciones (tipo, mensaje) que reciben cada evento del historial
+
+    def rutas(self):
+        """(nombre, tópico, prioridad, manejador) para el enrutador de la conexión."""
+        return [
+            ("estado", self.topico_estado, PRIORIDAD_ALTA, self._manejarEstado),
+            ("comando", self.topico_comando, PRIORIDAD_ALTA, self._manejarComando),
+            ("facial_status", self.topico_facial_status, PRIORIDAD_MEDIA, self._manejarFacialStatus),
+            ("alerta", self.topico_alerta, PRIORIDAD_BAJA, self._manejarAlerta),
+            ("log", self.topico_log, PRIORIDAD_BAJA, self._manejarLog),
+        ]
+
+    @property
+    def estadoActual(self):
+        return self.estadoPersistente.estado
+
+    def registrar_cliente(self, enviar, cerrar=None):
+        """Suscribe un WebSocket (desde el loop). Devuelve el cliente para deregistrarlo."""
+        return self.difusion.registrar(enviar, cerrar)
+
+    def deregistrar_cliente(self, cliente):
+        self.difusion.quitar(cliente)
+
+    def _agregarHistorial(self, tipo, mensaje):
+        """Registra el evento en el historial persistente y lo difunde con su id."""
+        evento = self.historial.agregar(tipo, mensaje)
+        self._notificar_clientes(tipo, mensaje, evento["id"])
+        for oyente in self.oyentes:
+            oyente(tipo, mensaje)
+
+    def _manejarEstado(self, topico, payload, retain):
+        # Normalización: Manejar ABIERTA/ABIERTO
+        estado_normalizado = payload.upper()
+
+        # Detectar cambio de estado
+        nuevo_estado = "CERRADO"
+        if "ABIER" in estado_normalizado:
+             nuevo_estado = "ABIERTO"
+
+        # Regla de Log: Si cambia el estado O si es un mensaje en vivo (retain=0)
+        # msg.retain suele ser 0 en mensajes nuevos y 1 en históricos
+        cambio = self.estadoPersistente.actualizar(nuevo_estado, "mqtt_retenido" if retain else "mqtt")
+        deberia_loguear = cambio or (retain == 0)
+
+        if deberia_loguear:
+             mensaje_log = f"Estado cambiado a: {self.estadoActual}"
+             # Guarda y envía el 'log' a todos los clientes
+             self._agregarHistorial("log", mensaje_log)
+
+        self._notificar_clientes("estado", self.estadoActual)
+
+    def _manejarComando(self, topico, payload, retain):
+        # Manejar Lógica de Simulación (el servidor también recibe sus propios comandos)
+        if self.modoSimulacion:
+            self._manejarComandoSimulado(payload)
+
+    def _manejarFacialStatus(self, topico, payload, retain):
+        # No guardamos historial para esto, es transitorio
+        self._notificar_clientes("facial_status", payload)
+
+    def _manejarAlerta(self, topico, payload, retain):
+        # Se difunde desde el historial, con su id
+        self._agregarHistorial("alerta", payload)
+
+    def _manejarLog(self, topico, payload, retain):
+        self._agregarHistorial("log", payload)
+
+    def _notificar_clientes(self, tipo, datos, id_evento=None):
+        # Un único traspaso al loop por mensaje; el hub lo reparte a las colas de cada cliente
+        self.difusion.publicar(tipo, datos, id_evento)
+
+    def _manejarComandoSimulado(self, comando):
+        """Simula el comportamiento de la caja física."""
+        comando = comando.upper()
+        if comando == "ABRIR":
+            self.estadoPersistente.actualizar("ABIERTO", "simulacion")
+            self.publicar(self.topico_estado, "ABIERTO", retain=True)
+            self.publicar(self.topico_log, "Apertura remota ejecutada")
+        elif comando == "CERRAR":
+            self.estadoPersistente.actualizar("CERRADO", "simulacion")
+            self.publicar(self.topico_estado, "CERRADO", retain=True)
+            self.publicar(self.topico_log, "Cierre remoto ejecutado")
+        else:
+            self.publicar(self.topico_alerta, f"Intento de comando no autorizado: {comando}")
+
+    def publicar(self, topico, mensaje, retain=False):
+        self.conexion.publicar(topico, mensaje, retain=retain)
+
+    def iniciar(self, loop):
+        self.difusion.iniciar(loop)
+        self.estadoPersistente.iniciar()
+
+    def detener(self):
+        self.estadoPersistente.detener()
+
 
 class ClienteMqtt:
+    """
+    Única conexión al broker para todas las cajas: una suscripción por prefijo
+    y un enrutador que lleva cada tópico al manejador de su caja.
+    """
+
     def __init__(self):
         # En paho-mqtt 2.0+ callback_api_version por defecto es CallbackAPIVersion.VERSION2
         # Usamos protocolo MQTTv5 o v311. Para simpleza usamos v5 o default.
         # Generar ID aleatorio para evitar conflictos de "Session taken over" al reiniciar
         client_id = f"FastAPI_Server_{random.randint(1000, 9999)}"
-        self.cliente = mqtt.Client(client_id=client_id, protocol=mqtt.MQTTv5)
+        protocolo = mqtt.MQTTv311 if MQTT_PROTOCOLO == "3.1.1" else mqtt.MQTTv5
+        self.cliente = mqtt.Client(client_id=client_id, protocol=protocolo)
         
         # Configurar TLS con certificados de Certifi
-        self.cliente.tls_set(ca_certs=certifi.where())
+        if MQTT_TLS:
+            self.cliente.tls_set(ca_certs=certifi.where())
         
         # Configuración de Autenticación
-        self.cliente.username_pw_set(USUARIO, CONTRASEÑA)
+        if USUARIO:
+            self.cliente.username_pw_set(USUARIO, CONTRASEÑA)
 
         self.cliente.on_connect = self.alConectar
         self.cliente.on_message = self.alRecibirMensaje
         self.cliente.on_disconnect = self.alDesconectar
-        
-        # Callbacks para enviar datos a FastAPI (Soporte Multi-Cliente)
-        self.clientes_conectados = set()
-        
-        # Modo Simulación (Desactivado si hay dispositivo real)
-        self.modoSimulacion = False 
-        
-        # Persistencia de Estado
-        self.archivoEstado = "state.txt"
-        # self.estadoActual = self._cargarEstado() # Desactivado: Siempre iniciar CERRADO por seguridad
-        self.estadoActual = "CERRADO"
-        self._guardarEstado() # Actualizar archivo para reflejar el inicio cerrado
-        
-        self.historialLogs = []
-        self.loop = None
 
-    def _cargarEstado(self):
-        try:
-            if os.path.exists(self.archivoEstado):
-                with open(self.archivoEstado, 'r') as f:
-                    estado = f.read().strip()
-                    # print(f"DEBUG: Estado recuperado: {estado}")
-                    return estado
-        except Exception as e:
-            print(f"Error cargando estado: {e}")
-        return "CERRADO"
+        # Ruteo de mensajes entrantes: el estado de la caja se atiende antes que logs y alertas
+        self.enrutador = Enrutador()
+        self.ingesta = ColaIngesta(self.enrutador)
 
-    def _guardarEstado(self):
-        try:
-            with open(self.archivoEstado, 'w') as f:
-                f.write(self.estadoActual)
-        except Exception as e:
-            print(f"Error guardando estado: {e}")
-
-    def registrar_cliente(self, callback):
-        self.clientes_conectados.add(callback)
+        self.cajas = {}  # id -> CajaMqtt
+        self.conectado = False
+        self.loop = None
 
-    def deregistrar_cliente(self, callback):
-        self.clientes_conectados.discard(callback)
+        # Un hub por caja; las métricas suman los de todas
+        WS_CLIENTES.calcular_con(lambda: sum(len(c.difusion.clientes) for c in list(self.cajas.values())))
+        WS_PENDIENTES.calcular_con(lambda: sum(c.difusion.pendientes() for c in list(self.cajas.values())))
 
-    def _agregarHistorial(self, tipo, mensaje):
-        """Guarda los últimos 50 eventos en memoria RAM."""
-        evento = {"tipo": tipo, "datos": mensaje}
-        self.historialLogs.insert(0, evento)
-        if len(self.historialLogs) > 50:
-            self.historialLogs.pop()
+    def agregar_caja(self, id_dispositivo, prefijo=PREFIJO_TOPICO, datos="."):
+        if id_dispositivo in self.cajas:
+            raise ValueError(f"Dispositivo duplicado: {id_dispositivo}")
+        caja = CajaMqtt(self, id_dispositivo, prefijo, datos)
+        for nombre, topico, prioridad, manejador in caja.rutas():
+            self.enrutador.agregar(nombre, topico, prioridad, manejador)
+        self.cajas[id_dispositivo] = caja
+        if self.loop is not None:
+            caja.iniciar(self.loop)
+        if self.conectado:
+            self.cliente.subscribe(f"{prefijo}/#")
+        return caja
 
     def alConectar(self, cliente, userdata, flags, rc, properties=None):
         if rc == 0:
+            MQTT_CONECTADO.fijar(1)
+            self.conectado = True
             logging.info("Conectado exitosamente al Cluster HiveMQ Cloud (RC: Success)")
-            # Suscribirse a Tópicos
-            cliente.subscribe(f"{PREFIJO_TOPICO}/#")
-            logging.info(f"Suscrito a {PREFIJO_TOPICO}/# para simulación")
+            # Suscribirse a Tópicos: un filtro por caja, en un solo SUBSCRIBE
+            prefijos = sorted({caja.prefijo for caja in self.cajas.values()})
+            if prefijos:
+                cliente.subscribe([(f"{p}/#", 0) for p in prefijos])
+                logging.info(f"Suscrito a {len(prefijos)} caja(s): {', '.join(prefijos)}")
         else:
             logging.error(f"Fallo en conexión RC: {rc}")
 
     def alDesconectar(self, cliente, userdata, rc, properties=None):
+        MQTT_CONECTADO.fijar(0)
+        MQTT_DESCONEXIONES.inc()
+        self.conectado = False
         logging.warning(f"Desconectado del Broker MQTT (RC: {rc})")
 
     def alRecibirMensaje(self, cliente, userdata, msg):
-        try:
-            payload = msg.payload.decode()
-            topico = msg.topic
-            print(f"MENSAJE RECIBIDO [{topico}]: {payload}") 
-
-            # Manejar Lógica de Simulación
-            if self.modoSimulacion and topico == TOPICO_COMANDO:
-                self._manejarComandoSimulado(payload)
-
-            # Identificar tipo de mensaje
-            tipoMensaje = "desconocido"
-            if topico == TOPICO_ESTADO:
-                tipoMensaje = "estado"
-                # Normalización: Manejar ABIERTA/ABIERTO
-                estado_normalizado = payload.upper()
-                
-                # Detectar cambio de estado
-                nuevo_estado = "CERRADO"
-                if "ABIER" in estado_normalizado:
-                     nuevo_estado = "ABIERTO"
-                
-                # Regla de Log: Si cambia el estado O si es un mensaje en vivo (retain=0)
-                # msg.retain suele ser 0 en mensajes nuevos y 1 en históricos
-                deberia_loguear = (nuevo_estado != self.estadoActual) or (msg.retain == 0)
-
-                self.estadoActual = nuevo_estado
-                self._guardarEstado() # Guardar siempre para asegurar consistencia
-                
-                if deberia_loguear:
-                     mensaje_log = f"Estado cambiado a: {self.estadoActual}"
-                     self._agregarHistorial("log", mensaje_log)
-                     
-                     # Enviar 'log' a todos los clientes
-                     self._notificar_clientes("log", mensaje_log)
-                
-                payload = self.estadoActual 
-
-            elif topico == TOPICO_ALERTA:
-                tipoMensaje = "alerta"
-                self._agregarHistorial("alerta", payload)
-            elif topico == TOPICO_LOG:
-                tipoMensaje = "log"
-                self._agregarHistorial("log", payload)
-            elif "facial_status" in topico:
-                tipoMensaje = "facial_status"
-                # No guardamos historial para esto, es transitorio
-            
-            # Enviar el mensaje original (tipo 'estado', 'alerta', etc.) a todos
-            if tipoMensaje != "desconocido":
-                 self._notificar_clientes(tipoMensaje, payload)
-
-        except Exception as e:
-            logging.error(f"Error procesando mensaje: {e}")
-
-    def _notificar_clientes(self, tipo, datos):
-        if self.loop and self.clientes_conectados:
-            for callback in list(self.clientes_conectados):
-                asyncio.run_coroutine_threadsafe(callback(tipo, datos), self.loop)
-
-    def _manejarComandoSimulado(self, comando):
-        """Simula el comportamiento de la caja física."""
-        comando = comando.upper()
-        if comando == "ABRIR":
-            self.estadoActual = "ABIERTO"
-            self.publicar(TOPICO_ESTADO, "ABIERTO", retain=True)
-            self.publicar(TOPICO_LOG, "Apertura remota ejecutada")
-        elif comando == "CERRAR":
-            self.estadoActual = "CERRADO"
-            self.publicar(TOPICO_ESTADO, "CERRADO", retain=True)
-            self.publicar(TOPICO_LOG, "Cierre remoto ejecutado")
-        else:
-            self.publicar(TOPICO_ALERTA, f"Intento de comando no autorizado: {comando}")
+        # Hilo de red de paho: solo contar y encolar; el procesamiento va en el hilo de ingesta
+        ruta = self.enrutador.resolver(msg.topic)
+        MQTT_MENSAJES.etiquetar(ruta.nombre if ruta else "otro").inc()
+        self.ingesta.encolar(msg.topic, msg.payload, msg.retain)
 
     def iniciar(self, loop):
         self.loop = loop
+        for caja in self.cajas.values():
+            caja.iniciar(loop)
+        self.ingesta.iniciar()
         try:
             logging.info(f"Conectando a {BROKER}:{PUERTO}...")
             self.cliente.connect(BROKER, PUERTO, 60)
@@ -188,6 +253,13 @@ class ClienteMqtt:
     def detener(self):
         self.cliente.loop_stop()
         self.cliente.disconnect()
+        self.ingesta.detener()
+        for caja in self.cajas.values():
+            caja.detener()
+
+    async def detener_difusion(self):
+        for caja in self.cajas.values():
+            await caja.difusion.detener()
 
     def publicar(self, topico, mensaje, retain=False):
         self.cliente.publish(topico, mensaje, retain=retain)
@@ -0,0 +1,192 @@
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# Configuración (ajustable por .env)
+CONFIGURACION = {
+    # Etapas en orden; se puede quitar alguna (p.ej. "mejorar") sin tocar código
+    "etapas": os.getenv("PREPROCESADO_ETAPAS", "decodificar,rgb,detectar,mejorar,codificar").split(","),
+    # 1 = resolución completa, 2 = mitad, 4 = cuarto (el JPEG se decodifica ya reducido)
+    "reduccion": int(os.getenv("PREPROCESADO_REDUCCION", 2)),
+    # "roi" = CLAHE solo sobre los rostros, "completo" = todo el frame, "no" = sin CLAHE
+    "clahe": os.getenv("PREPROCESADO_CLAHE", "roi"),
+    "clahe_limite": float(os.getenv("PREPROCESADO_CLAHE_LIMITE", 3.0)),
+    "clahe_rejilla": int(os.getenv("PREPROCESADO_CLAHE_REJILLA", 8)),
+    "upsample": int(os.getenv("PREPROCESADO_UPSAMPLE", 1)),  # Pasadas de upsample del HOG
+    "margen_roi": 0.25,  # Margen alrededor del rostro al mejorar la ROI
+}
+
+_FLAGS_REDUCCION = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+class ImagenCorrupta(Exception):
+    pass
+
+
+# Buffers reutilizables por hilo (cada proceso del motor tiene uno solo)
+_buffers = threading.local()
+
+
+def _buffer(nombre, forma):
+    cache = getattr(_buffers, "arrays", None)
+    if cache is None:
+        cache = _buffers.arrays = {}
+    buf = cache.get(nombre)
+    if buf is None or buf.shape != forma:
+        buf = cache[nombre] = np.empty(forma, np.uint8)
+    return buf
+
+
+def _clahe(cfg, rejilla=None):
+    rejilla = rejilla or cfg["clahe_rejilla"]
+    return cv2.createCLAHE(clipLimit=cfg["clahe_limite"], tileGridSize=(rejilla, rejilla))
+
+
+def _clahe_completo(ctx, cfg):
+    """RGB mejorado con CLAHE sobre la luminancia de todo el frame (LAB se calcula una sola vez)."""
+    if "rgb_mejorada" not in ctx:
+        rgb = ctx["rgb"]
+        lab = cv2.cvtColor(rgb, cv2.COLOR_RGB2LAB, dst=_buffer("lab", rgb.shape))
+        lab[:, :, 0] = _clahe(cfg).apply(lab[:, :, 0])
+        ctx["rgb_mejorada"] = cv2.cvtColor(lab, cv2.COLOR_LAB2RGB, dst=_buffer("rgb_mejorada", rgb.shape))
+    return ctx["rgb_mejorada"]
+
+
+def modelos():
+    """
+    Módulo face_recognition. Importarlo carga dlib y sus modelos (segundos): se hace
+    en el primer uso, así el servidor abre el puerto sin esperar al reconocimiento.
+    """
+    import face_recognition
+    return face_recognition
+
+
+def calentar():
+    """
+    Carga dlib y sus modelos, y la primera conversión a/desde LAB inicializa tablas
+    de OpenCV (~100 ms): hacerlo al arrancar cada proceso del motor, no en el primer escaneo.
+    """
+    modelos()
+    lab = cv2.cvtColor(np.zeros((8, 8, 3), np.uint8), cv2.COLOR_RGB2LAB)
+    cv2.cvtColor(lab, cv2.COLOR_LAB2RGB)
+
+
+def nitidez(jpg):
+    """
+    Nitidez de un JPEG: varianza del Laplaciano sobre un gris decodificado a 1/4
+    (~1 ms). Más alto = más nítido; un frame movido o desenfocado da valores bajos.
+    """
+    gris = cv2.imdecode(np.frombuffer(jpg, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    if gris is None:
+        return 0.0
+    return float(cv2.Laplacian(gris, cv2.CV_32F).var())
+
+
+# --- Etapas ---
+
+def etapa_decodificar(ctx, cfg):
+    """JPEG -> BGR, decodificado directamente a la resolución reducida (escalado en la IDCT)."""
+    bgr = cv2.imdecode(np.frombuffer(ctx["jpg"], np.uint8), _FLAGS_REDUCCION[cfg["reduccion"]])
+    if bgr is None:
+        raise ImagenCorrupta()
+    ctx["bgr"] = bgr
+    ctx["factor"] = cfg["reduccion"]
+
+
+def etapa_rgb(ctx, cfg):
+    bgr = ctx["bgr"]
+    ctx["rgb"] = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=_buffer("rgb", bgr.shape))
+
+
+def etapa_detectar(ctx, cfg):
+    """HOG sobre la imagen tal cual; si no encuentra nada, reintenta con CLAHE del frame completo."""
+    ubicaciones = modelos().face_locations(ctx["rgb"], number_of_times_to_upsample=cfg["upsample"])
+    if not ubicaciones and cfg["clahe"] != "no":
+        # Respaldo para imagenes "opacas" o con mala luz: reutiliza el RGB ya decodificado
+        inicio = time.perf_counter()
+        ubicaciones = modelos().face_locations(_clahe_completo(ctx, cfg),
+                                               number_of_times_to_upsample=cfg["upsample"])
+        ctx["tiempos"]["detectar_respaldo"] = (time.perf_counter() - inicio) * 1000
+    ctx["ubicaciones"] = ubicaciones
+
+
+def etapa_mejorar(ctx, cfg):
+    """CLAHE solo donde hay rostros (o en todo el frame si así se configuró)."""
+    if cfg["clahe"] == "no" or not ctx.get("ubicaciones"):
+        return
+    if cfg["clahe"] == "completo" or "rgb_mejorada" in ctx:
+        ctx["rgb_codificar"] = _clahe_completo(ctx, cfg)
+        return
+
+    rgb = ctx["rgb"]  # Ya no se usa para detectar: se mejora en el lugar
+    alto, ancho = rgb.shape[:2]
+    clahe = _clahe(cfg, rejilla=max(2, cfg["clahe_rejilla"] // 2))
+    for top, right, bottom, left in ctx["ubicaciones"]:
+        mh = int((bottom - top) * cfg["margen_roi"])
+        mw = int((right - left) * cfg["margen_roi"])
+        t, b = max(0, top - mh), min(alto, bottom + mh)
+        l, r = max(0, left - mw), min(ancho, right + mw)
+        if b <= t or r <= l:
+            continue
+        lab = cv2.cvtColor(rgb[t:b, l:r], cv2.COLOR_RGB2LAB)
+        lab[:, :, 0] = clahe.apply(lab[:, :, 0])
+        rgb[t:b, l:r] = cv2.cvtColor(lab, cv2.COLOR_LAB2RGB)
+    ctx["rgb_codificar"] = rgb
+
+
+def etapa_codificar(ctx, cfg):
+    if not ctx.get("ubicaciones"):
+        ctx["encodings"] = []
+        return
+    imagen = ctx.get("rgb_codificar", ctx["rgb"])
+    ctx["encodings"] = modelos().face_encodings(imagen, ctx["ubicaciones"])
+
+
+ETAPAS = {
+    "decodificar": etapa_decodificar,
+    "rgb": etapa_rgb,
+    "detectar": etapa_detectar,
+    "mejorar": etapa_mejorar,
+    "codificar": etapa_codificar,
+}
+
+
+class PipelinePreprocesado:
+    """
+    Preprocesado + detección + encoding como una secuencia de etapas con nombre.
+    Cada ejecución devuelve un contexto con los resultados y el tiempo (ms) de cada etapa.
+    """
+
+    def __init__(self, configuracion=None):
+        self.cfg = dict(CONFIGURACION, **(configuracion or {}))
+        self.etapas = [(nombre, ETAPAS[nombre]) for nombre in self.cfg["etapas"]]
+
+    def ejecutar(self, jpg, omitir=(), **contexto):
+        """
+        Corre las etapas configuradas sobre un JPEG. `omitir` salta etapas por nombre
+        (p.ej. "detectar" cuando las ubicaciones ya vienen dadas en `contexto`).
+        Lanza ImagenCorrupta si el JPEG no se puede decodificar.
+        """
+        ctx = dict(contexto, jpg=jpg, tiempos={})
+        for nombre, etapa in self.etapas:
+            if nombre in omitir:
+                continue
+            inicio = time.perf_counter()
+            etapa(ctx, self.cfg)
+            ctx["tiempos"][nombre] = (time.perf_counter() - inicio) * 1000
+        return ctx
+
+    def a_original(self, ubicacion):
+        """Coordenadas de la imagen reducida -> frame original."""
+        return tuple(int(v * self.cfg["reduccion"]) for v in ubicacion)
+
+    def a_reducido(self, ubicacion):
+        return tuple(int(round(v / self.cfg["reduccion"])) for v in ubicacion)
@@ -0,0 +1,159 @@
+import collections
+import os
+import time
+
+import cv2
+
+from galeria import TOLERANCIA
+from preprocesamiento import PipelinePreprocesado, ImagenCorrupta, modelos
+
+# Funciones puras de reconocimiento: sin MQTT, sin estado global.
+# Se ejecutan tanto en el proceso principal como en los procesos del motor.
+
+
+def codificar_imagen(ruta):
+    """Encoding del primer rostro de una imagen de referencia, o None si no hay rostro."""
+    face_recognition = modelos()
+    imagen = face_recognition.load_image_file(ruta)
+
+    # Redimensionar para velocidad
+    h, w = imagen.shape[:2]
+    if w > 800 or h > 800: # Permitir un poco más de calidad que antes
+        scale = 800 / max(w, h)
+        imagen = cv2.resize(imagen, (0, 0), fx=scale, fy=scale)
+
+    # Buscar cara
+    encodings = face_recognition.face_encodings(imagen)
+    return encodings[0] if encodings else None
+
+
+# Decodificación reducida, detección, CLAHE por ROI y encoding (ver preprocesamiento.py)
+_pipeline = PipelinePreprocesado()
+
+# Escaneo en ráfaga: "votos" = la identidad que gana en la mayoría de los frames,
+# "media" = la de menor distancia promedio entre todos los frames con rostro
+RAFAGA_DECISION = os.getenv("RAFAGA_DECISION", "votos")
+_DISTANCIA_AUSENTE = 1.0  # Para la media: identidad que no aparece entre los candidatos de un frame
+
+
+def _veredicto(coincidencias):
+    reconocidas = [c for c in coincidencias if c["nombre"] is not None]
+    mejor = min(reconocidas or coincidencias, key=lambda c: c["distancia"] if c["distancia"] is not None else 1e9)
+
+    detalle = {"nombre": mejor["nombre"], "distancia": mejor["distancia"], "candidatos": mejor["candidatos"]}
+    if reconocidas:
+        return {"status": "RECONOCIDO", "mensaje": "Identidad Verificada. Abriendo...", **detalle}
+    return {"status": "NO_AUTORIZADO", "mensaje": "Rostro no autorizado", **detalle}
+
+
+def reconocer_jpg(jpg, galeria):
+    """Detecta e identifica rostros en un JPEG contra la galería conocida (galeria.Galeria)."""
+    try:
+        ctx = _pipeline.ejecutar(jpg)
+    except ImagenCorrupta:
+        return {"status": "ERROR", "mensaje": "Imagen corrupta"}
+
+    tiempos = {k: round(v, 2) for k, v in ctx["tiempos"].items()}
+    if not ctx["ubicaciones"]:
+        return {"status": "NO_DETECTADO", "mensaje": "No se distingue un rostro claro. Acerquece a la cámara.",
+                "tiempos_ms": tiempos}
+
+    # Identificar: todas las caras contra toda la galería en una sola operación
+    inicio = time.perf_counter()
+    coincidencias = galeria.buscar(ctx["encodings"])
+    resultado = _veredicto(coincidencias)
+    tiempos["buscar"] = round((time.perf_counter() - inicio) * 1000, 2)
+    resultado["tiempos_ms"] = tiempos
+    # Cada rostro con su caja en el frame original (para dibujarlos en ?overlay=1)
+    resultado["rostros"] = [{"caja": list(_pipeline.a_original(u)), "nombre": c["nombre"]}
+                            for u, c in zip(ctx["ubicaciones"], coincidencias)]
+    return resultado
+
+
+def _distancia(resultado, nombre):
+    return min((c["distancia"] for c in resultado["candidatos"] if c["nombre"] == nombre), default=None)
+
+
+def _por_distancia_media(con_rostro, tolerancia=TOLERANCIA):
+    nombres = {c["nombre"] for r in con_rostro for c in r["candidatos"]}
+    medias = {}
+    for nombre in nombres:
+        distancias = [_distancia(r, nombre) for r in con_rostro]
+        medias[nombre] = sum(_DISTANCIA_AUSENTE if d is None else d for d in distancias) / len(distancias)
+    if not medias:
+        return None, None
+    nombre = min(medias, key=medias.get)
+    return (nombre if medias[nombre] <= tolerancia else None), round(medias[nombre], 4)
+
+
+def reconocer_rafaga(jpgs, galeria, decision=RAFAGA_DECISION):
+    """
+    Reconoce varios frames del mismo momento (los más nítidos primero) y decide entre
+    todos, así un solo frame movido no hace fallar el escaneo. Con "votos" deja de
+    procesar frames en cuanto una respuesta tiene mayoría asegurada.
+    """
+    tiempos, votos, con_rostro = {}, collections.Counter(), []
+    procesados = corruptos = 0
+    for jpg in jpgs:
+        resultado = reconocer_jpg(jpg, galeria)
+        procesados += 1
+        for etapa, ms in resultado.get("tiempos_ms", {}).items():
+            tiempos[etapa] = round(tiempos.get(etapa, 0) + ms, 2)
+        if resultado["status"] == "ERROR":
+            corruptos += 1
+        elif resultado["status"] != "NO_DETECTADO":
+            con_rostro.append(resultado)
+            votos[resultado["nombre"] if resultado["status"] == "RECONOCIDO" else None] += 1
+            if decision == "votos" and votos.most_common(1)[0][1] > len(jpgs) // 2:
+                break  # Los frames que faltan ya no cambian el resultado
+
+    rafaga = {"frames": len(jpgs), "procesados": procesados, "con_rostro": len(con_rostro), "decision": decision,
+              "votos": {(nombre or "desconocido"): n for nombre, n in votos.items()}}
+    if not con_rostro:
+        if procesados and corruptos == procesados:
+            return {"status": "ERROR", "mensaje": "Imagen corrupta", "rafaga": rafaga}
+        return {"status": "NO_DETECTADO", "mensaje": "No se distingue un rostro claro. Acerquece a la cámara.",
+                "tiempos_ms": tiempos, "rafaga": rafaga}
+
+    distancia = None
+    if decision == "media":
+        nombre, distancia = _por_distancia_media(con_rostro)
+    else:
+        nombre, n = votos.most_common(1)[0]
+        if n * 2 <= len(con_rostro):
+            nombre = None  # Empate: no se abre
+
+    if nombre is not None:
+        # El frame donde mejor se ve al ganador aporta las cajas y los candidatos
+        elegido = min(con_rostro, key=lambda r: _distancia(r, nombre) if _distancia(r, nombre) is not None else 1e9)
+        resultado = dict(elegido, status="RECONOCIDO", mensaje="Identidad Verificada. Abriendo...", nombre=nombre,
+                         distancia=distancia if distancia is not None else _distancia(elegido, nombre))
+    else:
+        elegido = min(con_rostro, key=lambda r: r["distancia"] if r["distancia"] is not None else 1e9)
+        resultado = dict(elegido, status="NO_AUTORIZADO", mensaje="Rostro no autorizado", nombre=None)
+        if distancia is not None:
+            resultado["distancia"] = distancia
+    resultado["tiempos_ms"] = tiempos
+    resultado["rafaga"] = rafaga
+    return resultado
+
+
+def detectar_jpg(jpg):
+    """Ubicaciones (top, right, bottom, left) de los rostros, en coordenadas del frame original."""
+    try:
+        ctx = _pipeline.ejecutar(jpg, omitir=("mejorar", "codificar"))
+    except ImagenCorrupta:
+        return []
+    return [_pipeline.a_original(u) for u in ctx["ubicaciones"]]
+
+
+def identificar_jpg(jpg, ubicaciones, galeria):
+    """Coincidencias en la galería para rostros ya ubicados (coordenadas del frame original)."""
+    if not ubicaciones:
+        return []
+    try:
+        ctx = _pipeline.ejecutar(jpg, omitir=("detectar",),
+                                 ubicaciones=[_pipeline.a_reducido(u) for u in ubicaciones])
+    except ImagenCorrupta:
+        return []
+    return galeria.buscar(ctx["encodings"])
@@ -0,0 +1,99 @@
+import itertools
+import time
+
+
+def iou(a, b):
+    """Intersección sobre unión de dos cajas (top, right, bottom, left)."""
+    top, bottom = max(a[0], b[0]), min(a[2], b[2])
+    left, right = max(a[3], b[3]), min(a[1], b[1])
+    interseccion = max(0, bottom - top) * max(0, right - left)
+    if not interseccion:
+        return 0.0
+    area_a = (a[2] - a[0]) * (a[1] - a[3])
+    area_b = (b[2] - b[0]) * (b[1] - b[3])
+    return interseccion / float(area_a + area_b - interseccion)
+
+
+class Pista:
+    """Un rostro seguido a través de los frames."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, caja, ahora):
+        self.id = next(self._ids)
+        self.caja = caja
+        self.visto = ahora
+        self.nombre = None
+        self.distancia = None
+        self.identificado_en = None  # None = todavía no se codificó
+
+    def a_dict(self):
+        return {"id": self.id, "caja": list(self.caja), "nombre": self.nombre, "distancia": self.distancia}
+
+
+class SeguidorRostros:
+    """
+    Asocia las detecciones de cada frame con las pistas existentes por solapamiento
+    de cajas (IoU). Mientras la caja de una pista se mantiene estable se reutiliza
+    su identidad, así el encoding de dlib corre una vez por rostro nuevo y no una
+    vez por frame.
+    """
+
+    def __init__(self, iou_minimo=0.3, iou_estable=0.5, olvido=1.5, reintento_desconocido=3.0):
+        self.iou_minimo = iou_minimo            # Para considerar que es el mismo rostro
+        self.iou_estable = iou_estable          # Por debajo, el rostro se movió mucho: re-identificar
+        self.olvido = olvido                    # Segundos sin ver una pista antes de descartarla
+        self.reintento_desconocido = reintento_desconocido
+        self.pistas = []
+        self._ultimo = None
+
+    def actualizar(self, cajas, ahora=None):
+        """
+        Incorpora las detecciones de un frame.
+        Devuelve las pistas que necesitan (re)identificación.
+        """
+        ahora = ahora if ahora is not None else time.time()
+
+        # Emparejamiento voraz por IoU descendente
+        pares = sorted(((iou(p.caja, c), i, j) for i, p in enumerate(self.pistas) for j, c in enumerate(cajas)),
+                       reverse=True)
+        usadas_p, usadas_c = set(), set()
+        pendientes = []
+        for solapamiento, i, j in pares:
+            if solapamiento < self.iou_minimo:
+                break
+            if i in usadas_p or j in usadas_c:
+                continue
+            usadas_p.add(i)
+            usadas_c.add(j)
+            pista = self.pistas[i]
+            pista.caja = cajas[j]
+            pista.visto = ahora
+            if solapamiento < self.iou_estable:
+                pendientes.append(pista)
+            elif pista.nombre is None and ahora - (pista.identificado_en or 0) > self.reintento_desconocido:
+                # Un desconocido puede deberse a un frame malo: reintentar cada tanto
+                pendientes.append(pista)
+
+        for j, caja in enumerate(cajas):
+            if j not in usadas_c:
+                pista = Pista(caja, ahora)
+                self.pistas.append(pista)
+                pendientes.append(pista)
+
+        self.pistas = [p for p in self.pistas if ahora - p.visto <= self.olvido]
+        self._ultimo = ahora
+        return pendientes
+
+    def asignar(self, pista, coincidencia, ahora=None):
+        pista.nombre = coincidencia["nombre"]
+        pista.distancia = coincidencia["distancia"]
+        pista.identificado_en = ahora if ahora is not None else time.time()
+
+    def visibles(self):
+        """Pistas presentes en el último frame procesado."""
+        return [p for p in self.pistas if p.visto == self._ultimo]
+
+    def reiniciar(self):
+        self.pistas = []
+        self._ultimo = None
@@ -0,0 +1,305 @@
+"""
+Broker MQTT mínimo para pruebas locales, con la caja fuerte simulada conectada.
+
+Implementa lo que usan el servidor y el firmware: MQTT 3.1.1 y 5, CONNECT,
+SUBSCRIBE/UNSUBSCRIBE con comodines + y #, PUBLISH QoS 0/1, mensajes retenidos,
+PINGREQ y DISCONNECT. Sin TLS ni autenticación: no exponer fuera de la máquina.
+
+Uso:
+    python -m simulacion.broker --puerto 1883 --cierre-automatico 5
+
+y en el servidor:
+    HIVEMQ_BROKER=127.0.0.1 HIVEMQ_PORT=1883 MQTT_TLS=0 HIVEMQ_USERNAME= uvicorn main:app
+"""
+import argparse
+import asyncio
+import logging
+import struct
+
+logger = logging.getLogger(__name__)
+
+PREFIJO_TOPICO = "enclave/caja"
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+
+def coincide(filtro, topico):
+    """True si el tópico cumple el filtro de suscripción (con + y #)."""
+    partes_f = filtro.split('/')
+    partes_t = topico.split('/')
+    for i, parte in enumerate(partes_f):
+        if parte == '#':
+            return True
+        if i >= len(partes_t) or (parte != '+' and parte != partes_t[i]):
+            return False
+    return len(partes_f) == len(partes_t)
+
+
+def _varint(n):
+    salida = bytearray()
+    while True:
+        byte, n = n % 128, n // 128
+        salida.append(byte | (0x80 if n else 0))
+        if not n:
+            return bytes(salida)
+
+
+def _cadena(texto):
+    datos = texto.encode('utf-8')
+    return struct.pack('!H', len(datos)) + datos
+
+
+def _paquete(tipo, cuerpo, banderas=0):
+    return bytes([(tipo << 4) | banderas]) + _varint(len(cuerpo)) + cuerpo
+
+
+class _Lector:
+    def __init__(self, datos):
+        self.datos = datos
+        self.pos = 0
+
+    def byte(self):
+        self.pos += 1
+        return self.datos[self.pos - 1]
+
+    def entero16(self):
+        self.pos += 2
+        return struct.unpack_from('!H', self.datos, self.pos - 2)[0]
+
+    def varint(self):
+        valor, mult = 0, 1
+        while True:
+            b = self.byte()
+            valor += (b & 0x7F) * mult
+            if not b & 0x80:
+                return valor
+            mult *= 128
+
+    def binario(self):
+        n = self.entero16()
+        self.pos += n
+        return self.datos[self.pos - n:self.pos]
+
+    def cadena(self):
+        return self.binario().decode('utf-8')
+
+    def saltar_propiedades(self):
+        largo = self.varint()
+        self.pos += largo
+
+    def resto(self):
+        return self.datos[self.pos:]
+
+
+class _Sesion:
+    def __init__(self, escritor):
+        self.escritor = escritor
+        self.id_cliente = None
+        self.version = 4  # 4 = 3.1.1, 5 = MQTT 5
+        self.filtros = set()
+
+    def enviar(self, datos):
+        if not self.escritor.is_closing():
+            self.escritor.write(datos)
+
+    def publicar(self, topico, payload, retain=False):
+        cuerpo = _cadena(topico) + (b'\x00' if self.version == 5 else b'') + payload
+        self.enviar(_paquete(PUBLISH, cuerpo, 0x01 if retain else 0))
+
+
+class BrokerLocal:
+    """Broker en memoria: todas las sesiones en un solo loop asyncio."""
+
+    def __init__(self):
+        self.sesiones = set()
+        self.retenidos = {}
+        self.observadores = []  # Callbacks (topico, payload) para clientes internos
+        self.mensajes = 0
+
+    async def iniciar(self, host="127.0.0.1", puerto=1883):
+        self.servidor = await asyncio.start_server(self._atender, host, puerto)
+        logger.info(f"Broker local escuchando en {host}:{puerto}")
+        return self.servidor
+
+    def publicar(self, topico, payload, retain=False):
+        """Distribuye un mensaje (QoS 0) a todas las suscripciones que coinciden."""
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        self.mensajes += 1
+        if retain:
+            if payload:
+                self.retenidos[topico] = payload
+            else:
+                self.retenidos.pop(topico, None)
+        for sesion in list(self.sesiones):
+            if any(coincide(f, topico) for f in sesion.filtros):
+                sesion.publicar(topico, payload)
+        for observador in self.observadores:
+            observador(topico, payload)
+
+    async def _leer_paquete(self, lector):
+        cabecera = (await lector.readexactly(1))[0]
+        largo, mult = 0, 1
+        while True:
+            b = (await lector.readexactly(1))[0]
+            largo += (b & 0x7F) * mult
+            if not b & 0x80:
+                break
+            mult *= 128
+        return cabecera >> 4, cabecera & 0x0F, await lector.readexactly(largo)
+
+    async def _atender(self, lector, escritor):
+        sesion = _Sesion(escritor)
+        try:
+            while True:
+                tipo, banderas, cuerpo = await self._leer_paquete(lector)
+                if tipo == CONNECT:
+                    self._conectar(sesion, cuerpo)
+                elif tipo == PUBLISH:
+                    self._recibir_publicacion(sesion, banderas, cuerpo)
+                elif tipo == SUBSCRIBE:
+                    self._suscribir(sesion, cuerpo)
+                elif tipo == UNSUBSCRIBE:
+                    self._desuscribir(sesion, cuerpo)
+                elif tipo == PINGREQ:
+                    sesion.enviar(_paquete(PINGRESP, b''))
+                elif tipo == DISCONNECT:
+                    break
+                await escritor.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.sesiones.discard(sesion)
+            escritor.close()
+            logger.info(f"Cliente desconectado: {sesion.id_cliente}")
+
+    def _conectar(self, sesion, cuerpo):
+        r = _Lector(cuerpo)
+        r.cadena()  # "MQTT"
+        sesion.version = r.byte()
+        banderas = r.byte()
+        r.entero16()  # keepalive
+        if sesion.version == 5:
+            r.saltar_propiedades()
+        sesion.id_cliente = r.cadena()
+        # Will, usuario y contraseña se aceptan sin validar
+        if banderas & 0x04:
+            if sesion.version == 5:
+                r.saltar_propiedades()
+            r.cadena()
+            r.binario()
+        self.sesiones.add(sesion)
+        propiedades = b'\x00' if sesion.version == 5 else b''
+        sesion.enviar(_paquete(CONNACK, b'\x00\x00' + propiedades))
+        logger.info(f"Cliente conectado: {sesion.id_cliente} (MQTT {'5' if sesion.version == 5 else '3.1.1'})")
+
+    def _recibir_publicacion(self, sesion, banderas, cuerpo):
+        r = _Lector(cuerpo)
+        topico = r.cadena()
+        qos = (banderas >> 1) & 0x03
+        if qos:
+            id_paquete = r.entero16()
+        if sesion.version == 5:
+            r.saltar_propiedades()
+        if qos == 1:
+            sesion.enviar(_paquete(PUBACK, struct.pack('!H', id_paquete)))
+        self.publicar(topico, r.resto(), retain=bool(banderas & 0x01))
+
+    def _suscribir(self, sesion, cuerpo):
+        r = _Lector(cuerpo)
+        id_paquete = r.entero16()
+        if sesion.version == 5:
+            r.saltar_propiedades()
+        nuevos = []
+        while r.pos < len(cuerpo):
+            filtro = r.cadena()
+            r.byte()  # Opciones / QoS pedido: siempre se entrega en QoS 0
+            sesion.filtros.add(filtro)
+            nuevos.append(filtro)
+        propiedades = b'\x00' if sesion.version == 5 else b''
+        sesion.enviar(_paquete(SUBACK, struct.pack('!H', id_paquete) + propiedades + b'\x00' * len(nuevos), 0))
+        for topico, payload in self.retenidos.items():
+            if any(coincide(f, topico) for f in nuevos):
+                sesion.publicar(topico, payload, retain=True)
+
+    def _desuscribir(self, sesion, cuerpo):
+        r = _Lector(cuerpo)
+        id_paquete = r.entero16()
+        if sesion.version == 5:
+            r.saltar_propiedades()
+        filtros = 0
+        while r.pos < len(cuerpo):
+            sesion.filtros.discard(r.cadena())
+            filtros += 1
+        cuerpo = struct.pack('!H', id_paquete)
+        if sesion.version == 5:
+            cuerpo += b'\x00' + b'\x00' * filtros
+        sesion.enviar(_paquete(UNSUBACK, cuerpo))
+
+
+class FirmwareSimulado:
+    """
+    Caja fuerte simulada: responde a enclave/caja/comando igual que el firmware
+    (estado retenido + log, alerta ante comandos desconocidos).
+    """
+
+    def __init__(self, broker, cierre_automatico=0, latencia=0.05):
+        self.broker = broker
+        self.cierre_automatico = cierre_automatico  # Segundos hasta re-cerrar (0 = nunca)
+        self.latencia = latencia                    # Tiempo de respuesta del actuador
+        self.estado = "CERRADO"
+        self._cierre = None
+        broker.observadores.append(self._al_mensaje)
+        broker.publicar(f"{PREFIJO_TOPICO}/estado", self.estado, retain=True)
+
+    def _al_mensaje(self, topico, payload):
+        if topico != f"{PREFIJO_TOPICO}/comando":
+            return
+        comando = payload.decode('utf-8', 'replace').strip().upper()
+        asyncio.get_running_loop().call_later(self.latencia, self._ejecutar, comando)
+
+    def _ejecutar(self, comando):
+        if comando == "ABRIR":
+            self._cambiar("ABIERTO", "Apertura remota ejecutada")
+            if self.cierre_automatico:
+                if self._cierre:
+                    self._cierre.cancel()
+                self._cierre = asyncio.get_running_loop().call_later(
+                    self.cierre_automatico, self._cambiar, "CERRADO", "Cierre automático")
+        elif comando == "CERRAR":
+            self._cambiar("CERRADO", "Cierre remoto ejecutado")
+        else:
+            self.broker.publicar(f"{PREFIJO_TOPICO}/alerta", f"Intento de comando no autorizado: {comando}")
+
+    def _cambiar(self, estado, log):
+        self.estado = estado
+        self.broker.publicar(f"{PREFIJO_TOPICO}/estado", estado, retain=True)
+        self.broker.publicar(f"{PREFIJO_TOPICO}/log", log)
+
+
+async def _principal(args):
+    broker = BrokerLocal()
+    servidor = await broker.iniciar(args.host, args.puerto)
+    FirmwareSimulado(broker, args.cierre_automatico, args.latencia)
+    async with servidor:
+        await servidor.serve_forever()
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--puerto", type=int, default=1883)
+    ap.add_argument("--cierre-automatico", type=float, default=0, help="Segundos hasta volver a cerrar")
+    ap.add_argument("--latencia", type=float, default=0.05, help="Demora del actuador simulado (s)")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(_principal(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
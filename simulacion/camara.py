@@ -0,0 +1,149 @@
+"""
+ESP32-CAM simulada: sirve /stream (MJPEG) y acepta /abrir como la placa real.
+
+Los frames salen de una captura grabada (bench_mjpeg --grabar), de una carpeta de
+imágenes o, si no se indica nada, de un patrón sintético con movimiento.
+
+Uso:
+    python -m simulacion.camara --puerto 8081 --fps 15 --resolucion 640x480
+    python -m simulacion.camara --captura esp32.mjpeg
+    python -m simulacion.camara --imagenes rostros --fps 5
+
+y en el servidor:
+    CAMERA_STREAM_URL=http://127.0.0.1:8081/stream
+"""
+import argparse
+import asyncio
+import glob
+import logging
+import os
+import time
+
+import cv2
+import numpy as np
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+
+from mjpeg import DemuxMJPEG
+
+logger = logging.getLogger(__name__)
+
+BOUNDARY = "123456789000000000000987654321"  # El mismo que usa el firmware CameraWebServer
+
+
+def frames_sinteticos(ancho, alto, cantidad=60, calidad=80):
+    """Gradiente que se desplaza más un contador: cada frame es distinto (hay movimiento)."""
+    base = np.tile(np.linspace(0, 255, ancho, dtype=np.uint8), (alto, 1))
+    frames = []
+    for i in range(cantidad):
+        img = cv2.merge((base, np.roll(base, i * ancho // cantidad, axis=1), np.flipud(base)))
+        cv2.putText(img, f"SIMULACION {i:03d}", (20, alto - 20), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+        frames.append(cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, calidad])[1].tobytes())
+    return frames
+
+
+def frames_de_imagenes(carpeta, ancho, alto, calidad=80):
+    frames = []
+    for ext in ('*.jpg', '*.jpeg', '*.png'):
+        for ruta in sorted(glob.glob(os.path.join(carpeta, ext))):
+            img = cv2.imread(ruta)
+            if img is not None:
+                img = cv2.resize(img, (ancho, alto), interpolation=cv2.INTER_AREA)
+                frames.append(cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, calidad])[1].tobytes())
+    return frames
+
+
+def frames_de_captura(ruta):
+    with open(ruta, 'rb') as f:
+        return DemuxMJPEG(limite_buffer=64 << 20).alimentar(f.read())
+
+
+class CamaraSimulada:
+    def __init__(self, frames, fps, content_length=True):
+        if not frames:
+            raise ValueError("No hay frames para servir")
+        self.frames = frames
+        self.fps = fps
+        self.content_length = content_length
+        self.inicio = time.monotonic()
+        self.clientes = 0
+        self.frames_enviados = 0
+        self.aperturas = 0
+
+    def frame_actual(self):
+        """Todos los clientes ven la misma secuencia, como una cámara real."""
+        return self.frames[int((time.monotonic() - self.inicio) * self.fps) % len(self.frames)]
+
+    async def stream(self):
+        self.clientes += 1
+        intervalo = 1.0 / self.fps
+        proximo = time.monotonic()
+        try:
+            while True:
+                jpg = self.frame_actual()
+                cabecera = f"--{BOUNDARY}\r\nContent-Type: image/jpeg\r\n"
+                if self.content_length:
+                    cabecera += f"Content-Length: {len(jpg)}\r\nX-Timestamp: {time.time():.6f}\r\n"
+                yield cabecera.encode() + b"\r\n" + jpg + b"\r\n"
+                self.frames_enviados += 1
+                proximo += intervalo
+                await asyncio.sleep(max(0.0, proximo - time.monotonic()))
+        finally:
+            self.clientes -= 1
+
+
+def crear_app(camara):
+    app = FastAPI(title="ESP32-CAM simulada")
+
+    @app.get("/stream")
+    async def stream():
+        return StreamingResponse(camara.stream(), media_type=f"multipart/x-mixed-replace;boundary={BOUNDARY}")
+
+    @app.get("/capture")
+    async def capture():
+        return Response(camara.frame_actual(), media_type="image/jpeg")
+
+    @app.get("/abrir")
+    async def abrir():
+        camara.aperturas += 1
+        logger.info(f"/abrir recibido ({camara.aperturas})")
+        return PlainTextResponse("OK")
+
+    @app.get("/estadisticas")
+    async def estadisticas():
+        return {"clientes": camara.clientes, "frames_enviados": camara.frames_enviados,
+                "aperturas": camara.aperturas, "fps": camara.fps, "frames": len(camara.frames)}
+
+    return app
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--puerto", type=int, default=8081)
+    ap.add_argument("--fps", type=float, default=10)
+    ap.add_argument("--resolucion", default="640x480", help="ANCHOxALTO (sintético e imágenes)")
+    ap.add_argument("--calidad", type=int, default=80)
+    ap.add_argument("--captura", help="Archivo .mjpeg grabado para reproducir en bucle")
+    ap.add_argument("--imagenes", help="Carpeta de imágenes para reproducir en bucle")
+    ap.add_argument("--sin-content-length", action="store_true", help="Omitir Content-Length (firmware viejo)")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    import uvicorn
+
+    ancho, alto = (int(v) for v in args.resolucion.lower().split('x'))
+    if args.captura:
+        frames = frames_de_captura(args.captura)
+    elif args.imagenes:
+        frames = frames_de_imagenes(args.imagenes, ancho, alto, args.calidad)
+    else:
+        frames = frames_sinteticos(ancho, alto, calidad=args.calidad)
+    logger.info(f"Sirviendo {len(frames)} frames a {args.fps} fps")
+
+    camara = CamaraSimulada(frames, args.fps, content_length=not args.sin_content_length)
+    uvicorn.run(crear_app(camara), host=args.host, port=args.puerto, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+"""
+Generador de carga de punta a punta contra el servidor.
+
+Abre N WebSockets (/ws) y M visores (/video_feed), dispara escaneos
+(/api/scan-face) y comandos (/api/comando/...) a una tasa fija y reporta
+percentiles de latencia, fps entregados por visor y tasas de error.
+
+Con --local levanta todo en la máquina: broker + caja simulada
+(simulacion.broker), ESP32-CAM simulada (simulacion.camara) y el servidor
+(uvicorn main:app) apuntando a ellos.
+
+Uso:
+    python -m simulacion.carga --local --ws 50 --visores 10 --escaneos 1 --comandos 0.5 --duracion 30
+    python -m simulacion.carga --url http://127.0.0.1:8000 --ws 200 --json carga.json
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+from mjpeg import DemuxMJPEG
+
+
+class Metricas:
+    def __init__(self):
+        self.latencias = collections.defaultdict(list)  # nombre -> [ms]
+        self.intentos = collections.Counter()
+        self.errores = collections.Counter()
+        self.detalle = collections.Counter()              # p.ej. status de los escaneos
+        self.fps_visores = []
+        self.pausas_visores = []                          # Máxima pausa entre frames por visor (ms)
+        self.mensajes_ws = collections.Counter()
+        self._lock = threading.Lock()
+
+    def latencia(self, nombre, ms):
+        with self._lock:
+            self.latencias[nombre].append(ms)
+
+    def intento(self, nombre, ok=True):
+        with self._lock:
+            self.intentos[nombre] += 1
+            if not ok:
+                self.errores[nombre] += 1
+
+    def reporte(self, duracion):
+        def percentiles(valores):
+            v = np.asarray(valores, float)
+            return {"n": len(v), "p50": round(float(np.percentile(v, 50)), 2),
+                    "p90": round(float(np.percentile(v, 90)), 2), "p99": round(float(np.percentile(v, 99)), 2),
+                    "max": round(float(v.max()), 2)}
+
+        fps = np.asarray(self.fps_visores, float)
+        return {
+            "duracion_s": duracion,
+            "latencias_ms": {k: percentiles(v) for k, v in sorted(self.latencias.items()) if v},
+            "errores": {k: {"intentos": n, "errores": self.errores[k], "tasa": round(self.errores[k] / n, 4)}
+                        for k, n in sorted(self.intentos.items())},
+            "visores": {"cantidad": len(fps),
+                        "fps_min": round(float(fps.min()), 2) if len(fps) else None,
+                        "fps_mediana": round(float(np.median(fps)), 2) if len(fps) else None,
+                        "fps_max": round(float(fps.max()), 2) if len(fps) else None,
+                        "pausa_max_ms_p90": round(float(np.percentile(self.pausas_visores, 90)), 1)
+                        if self.pausas_visores else None},
+            "mensajes_ws": dict(self.mensajes_ws),
+            "detalle": dict(self.detalle),
+        }
+
+
+class Comandos:
+    """Último comando enviado, para medir cuánto tarda el estado en llegar a cada WebSocket."""
+
+    def __init__(self):
+        self.id = 0
+        self.esperado = None
+        self.enviado = 0.0
+
+    def nuevo(self, esperado):
+        self.id += 1
+        self.esperado = esperado
+        self.enviado = time.perf_counter()
+
+
+# --- Clientes ---
+
+async def cliente_ws(url, fin, metricas, comandos):
+    import websockets
+
+    inicio = time.perf_counter()
+    try:
+        async with websockets.connect(url, open_timeout=10, max_queue=None) as ws:
+            metricas.latencia("ws_conexion", (time.perf_counter() - inicio) * 1000)
+            metricas.intento("ws")
+            medido = 0
+            while time.monotonic() < fin:
+                try:
+                    texto = await asyncio.wait_for(ws.recv(), timeout=max(0.1, fin - time.monotonic()))
+                except asyncio.TimeoutError:
+                    break
+                mensaje = json.loads(texto)
+                if mensaje.get("tipo") == "lote":
+                    metricas.mensajes_ws["lote"] += 1
+                    mensajes = mensaje["datos"]
+                else:
+                    mensajes = [mensaje]
+                for mensaje in mensajes:
+                    metricas.mensajes_ws[mensaje.get("tipo")] += 1
+                    if (mensaje.get("tipo") == "estado" and mensaje.get("datos") == comandos.esperado
+                            and medido != comandos.id):
+                        medido = comandos.id
+                        metricas.latencia("comando_a_ws", (time.perf_counter() - comandos.enviado) * 1000)
+    except Exception as e:
+        metricas.intento("ws", ok=False)
+        metricas.detalle[f"ws_error:{type(e).__name__}"] += 1
+
+
+def visor(url, fin, metricas):
+    """Un navegador mirando /video_feed: cuenta frames completos y pausas."""
+    demux = DemuxMJPEG()
+    marcas = []
+    try:
+        with requests.get(url, stream=True, timeout=(5, 10)) as res:
+            res.raise_for_status()
+            for chunk in res.iter_content(chunk_size=16384):
+                ahora = time.monotonic()
+                marcas.extend(ahora for _ in demux.alimentar(chunk))
+                if ahora >= fin:
+                    break
+        metricas.intento("video_feed")
+    except Exception as e:
+        metricas.intento("video_feed", ok=False)
+        metricas.detalle[f"video_feed_error:{type(e).__name__}"] += 1
+    if len(marcas) >= 2:
+        with metricas._lock:
+            metricas.fps_visores.append((len(marcas) - 1) / (marcas[-1] - marcas[0]))
+            metricas.pausas_visores.append(float(np.diff(marcas).max()) * 1000)
+    else:
+        with metricas._lock:
+            metricas.fps_visores.append(0.0)
+
+
+def escanear(base, metricas):
+    inicio = time.perf_counter()
+    try:
+        res = requests.post(f"{base}/api/scan-face", timeout=30)
+        metricas.latencia("escaneo", (time.perf_counter() - inicio) * 1000)
+        ok = res.status_code == 200
+        metricas.intento("escaneo", ok)
+        if ok:
+            metricas.detalle[f"escaneo:{res.json().get('status')}"] += 1
+    except Exception as e:
+        metricas.intento("escaneo", ok=False)
+        metricas.detalle[f"escaneo_error:{type(e).__name__}"] += 1
+
+
+def comandar(base, accion, metricas):
+    inicio = time.perf_counter()
+    try:
+        res = requests.post(f"{base}/api/comando/{accion}", timeout=10)
+        metricas.latencia("comando_http", (time.perf_counter() - inicio) * 1000)
+        metricas.intento("comando", res.status_code == 200 and res.json().get("estado") == "exito")
+    except Exception as e:
+        metricas.intento("comando", ok=False)
+        metricas.detalle[f"comando_error:{type(e).__name__}"] += 1
+
+
+async def a_tasa(tasa, fin, pool, funcion, *args):
+    """Lazo abierto: lanza `funcion` cada 1/tasa segundos sin esperar a que termine la anterior."""
+    if tasa <= 0:
+        return
+    loop = asyncio.get_running_loop()
+    pendientes = []
+    proximo = time.monotonic()
+    while proximo < fin:
+        await asyncio.sleep(max(0.0, proximo - time.monotonic()))
+        pendientes.append(loop.run_in_executor(pool, funcion, *args))
+        proximo += 1.0 / tasa
+    await asyncio.gather(*pendientes)
+
+
+async def ejecutar(args):
+    base = args.url.rstrip('/')
+    url_ws = base.replace("http", "ws", 1) + "/ws"
+    metricas = Metricas()
+    comandos = Comandos()
+    fin = time.monotonic() + args.duracion
+
+    hilos = [threading.Thread(target=visor, args=(f"{base}/video_feed", fin, metricas), daemon=True)
+             for _ in range(args.visores)]
+    for hilo in hilos:
+        hilo.start()
+
+    def siguiente_comando():
+        accion = "ABRIR" if comandos.id % 2 == 0 else "CERRAR"
+        comandos.nuevo("ABIERTO" if accion == "ABRIR" else "CERRADO")
+        comandar(base, accion.lower(), metricas)
+
+    with ThreadPoolExecutor(max_workers=args.hilos) as pool:
+        tareas = [cliente_ws(url_ws, fin, metricas, comandos) for _ in range(args.ws)]
+        tareas.append(a_tasa(args.escaneos, fin, pool, escanear, base, metricas))
+        tareas.append(a_tasa(args.comandos, fin, pool, siguiente_comando))
+        inicio = time.monotonic()
+        await asyncio.gather(*tareas)
+
+    for hilo in hilos:
+        hilo.join(timeout=15)
+    return metricas.reporte(round(time.monotonic() - inicio, 2))
+
+
+# --- Entorno local ---
+
+def _esperar_http(url, timeout=60):
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite:
+        try:
+            requests.get(url, timeout=2)
+            return True
+        except requests.RequestException:
+            time.sleep(0.5)
+    return False
+
+
+def levantar_local(args):
+    """Broker, cámara y servidor como subprocesos. Devuelve la lista de procesos."""
+    python = sys.executable
+    procesos = [
+        subprocess.Popen([python, "-m", "simulacion.broker", "--puerto", str(args.puerto_broker),
+                          "--cierre-automatico", "0"]),
+        subprocess.Popen([python, "-m", "simulacion.camara", "--puerto", str(args.puerto_camara),
+                          "--fps", str(args.fps_camara)] + (["--captura", args.captura] if args.captura else [])
+                         + (["--imagenes", args.imagenes] if args.imagenes else [])),
+    ]
+    entorno = dict(os.environ,
+                   CAMERA_STREAM_URL=f"http://127.0.0.1:{args.puerto_camara}/stream",
+                   HIVEMQ_BROKER="127.0.0.1", HIVEMQ_PORT=str(args.puerto_broker),
+                   HIVEMQ_USERNAME="", MQTT_TLS="0")
+    puerto = args.url.rstrip('/').rsplit(':', 1)[-1]
+    procesos.append(subprocess.Popen([python, "-m", "uvicorn", "main:app", "--port", puerto,
+                                      "--log-level", "warning"], env=entorno))
+    if not _esperar_http(f"http://127.0.0.1:{args.puerto_camara}/estadisticas") or not _esperar_http(args.url):
+        detener_local(procesos)
+        raise RuntimeError("El entorno local no arrancó a tiempo")
+    return procesos
+
+
+def detener_local(procesos):
+    for p in reversed(procesos):
+        p.terminate()
+    for p in procesos:
+        try:
+            p.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            p.kill()
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--url", default="http://127.0.0.1:8000")
+    ap.add_argument("--ws", type=int, default=20, help="Clientes WebSocket")
+    ap.add_argument("--visores", type=int, default=5, help="Clientes de /video_feed")
+    ap.add_argument("--escaneos", type=float, default=0.5, help="Escaneos por segundo")
+    ap.add_argument("--comandos", type=float, default=0.2, help="Comandos ABRIR/CERRAR por segundo")
+    ap.add_argument("--duracion", type=float, default=20)
+    ap.add_argument("--hilos", type=int, default=32, help="Hilos para escaneos y comandos concurrentes")
+    ap.add_argument("--json", metavar="RUTA", help="Guardar el reporte")
+    ap.add_argument("--local", action="store_true", help="Levantar broker, cámara y servidor simulados")
+    ap.add_argument("--puerto-broker", type=int, default=1883)
+    ap.add_argument("--puerto-camara", type=int, default=8081)
+    ap.add_argument("--fps-camara", type=float, default=10)
+    ap.add_argument("--captura", help="(--local) captura .mjpeg para la cámara simulada")
+    ap.add_argument("--imagenes", help="(--local) carpeta de imágenes para la cámara simulada")
+    args = ap.parse_args()
+
+    procesos = levantar_local(args) if args.local else []
+    try:
+        reporte = asyncio.run(ejecutar(args))
+    finally:
+        detener_local(procesos)
+
+    print(json.dumps(reporte, indent=2, ensure_ascii=False))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(reporte, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
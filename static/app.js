@@ -11,10 +11,22 @@ const panelEstado = document.querySelector('.status-indicator'); // Selector mod
 const listaAlertas = document.getElementById('alerts-list');
 const listaLogs = document.getElementById('logs-list');
 
+// Dispositivo (caja) de este panel: /?dispositivo=<id>. Sin id, la caja por defecto.
+const dispositivo = new URLSearchParams(window.location.search).get('dispositivo');
+const sufijoDispositivo = dispositivo ? `/${encodeURIComponent(dispositivo)}` : '';
+const rutaRegistro = dispositivo ? `/api/dispositivos${sufijoDispositivo}/register-face` : '/api/register-face';
+
+// Claves de localStorage separadas por caja
+function clave(nombre) {
+    return dispositivo ? `${nombre}:${dispositivo}` : nombre;
+}
+
 // WebSocket
 function conectarWebSocket() {
     const protocolo = window.location.protocol === 'https:' ? 'wss' : 'ws';
-    const wsUrl = `${protocolo}://${window.location.host}/ws`;
+    // Al reconectar, el servidor manda en un solo mensaje solo lo posterior al último evento visto
+    const ultimoEvento = localStorage.getItem(clave('ultimo_evento'));
+    const wsUrl = `${protocolo}://${window.location.host}/ws${sufijoDispositivo}` + (ultimoEvento ? `?desde=${ultimoEvento}` : '');
     const socket = new WebSocket(wsUrl);
 
     socket.onopen = () => {
@@ -26,16 +38,30 @@ function conectarWebSocket() {
 
     socket.onmessage = (event) => {
         const data = JSON.parse(event.data);
+        // Si el navegador se atrasó, el servidor agrupa los mensajes pendientes en un lote
+        const mensajes = data.tipo === 'lote' ? data.datos : [data];
+        mensajes.forEach(procesarMensaje);
+    };
+
+    function procesarMensaje(data) {
+        if (data.id !== undefined) {
+            localStorage.setItem(clave('ultimo_evento'), data.id);
+        }
+        // Los eventos del historial traen la hora en que ocurrieron
+        const tiempo = data.ts ? new Date(data.ts * 1000).toLocaleTimeString() : undefined;
+
         if (data.tipo === 'estado') {
             actualizarEstado(data.datos);
+        } else if (data.tipo === 'historial') {
+            data.datos.forEach(procesarMensaje);
         } else if (data.tipo === 'log') {
-            agregarItemLog(listaLogs, data.datos, 'log');
+            agregarItemLog(listaLogs, data.datos, 'log', tiempo);
         } else if (data.tipo === 'alerta') {
-            agregarItemLog(listaAlertas, data.datos, 'alert');
+            agregarItemLog(listaAlertas, data.datos, 'alert', tiempo);
         } else if (data.tipo === 'facial_status') {
             actualizarEstadoFacial(data.datos);
         }
-    };
+    }
 
     socket.onclose = () => {
         indicadorEstado.classList.remove('connected');
@@ -105,13 +131,13 @@ const MAX_LOGS = 10;
 
 function cargarLogsGuardados() {
     // Cargar Logs Comunes
-    const logsGuardados = JSON.parse(localStorage.getItem('logs_historial') || '[]');
+    const logsGuardados = JSON.parse(localStorage.getItem(clave('logs_historial')) || '[]');
     logsGuardados.forEach(log => {
         itemHTML(listaLogs, log.texto, log.tipo, log.tiempo);
     });
 
     // Cargar Alertas
-    const alertasGuardadas = JSON.parse(localStorage.getItem('alertas_historial') || '[]');
+    const alertasGuardadas = JSON.parse(localStorage.getItem(clave('alertas_historial')) || '[]');
     alertasGuardadas.forEach(alerta => {
         itemHTML(listaAlertas, alerta.texto, alerta.tipo, alerta.tiempo);
     });
@@ -128,16 +154,16 @@ function itemHTML(elementoLista, texto, tipo, tiempo) {
     elementoLista.insertBefore(li, elementoLista.firstChild);
 }
 
-function agregarItemLog(elementoLista, texto, tipo) {
-    const tiempo = new Date().toLocaleTimeString();
+function agregarItemLog(elementoLista, texto, tipo, tiempo) {
+    tiempo = tiempo || new Date().toLocaleTimeString();
 
     // 1. Renderizar en HTML
     itemHTML(elementoLista, texto, tipo, tiempo);
 
     // 2. Guardar en LocalStorage
     // Identificar si es Alerta o Log normal para usar la key correcta
-    let key = 'logs_historial';
-    if (elementoLista === listaAlertas) key = 'alertas_historial';
+    let key = clave('logs_historial');
+    if (elementoLista === listaAlertas) key = clave('alertas_historial');
 
     const historial = JSON.parse(localStorage.getItem(key) || '[]');
     historial.unshift({ texto, tipo, tiempo }); // Agregar al inicio
@@ -219,7 +245,7 @@ async function enviarComando(accion) {
         const btnClose = document.querySelector('.btn-action.close');
         /* btnOpen.disabled = true; btnClose.disabled = true; */
 
-        const respuesta = await fetch(`/api/comando/${accion}`, {
+        const respuesta = await fetch(`/api/comando${sufijoDispositivo}/${accion}`, {
             method: 'POST'
         });
         const resultado = await respuesta.json();
@@ -339,7 +365,7 @@ async function capturarYRegistrar() {
 
     try {
         // 2. Enviar al Backend
-        const respuesta = await fetch('/api/register-face', {
+        const respuesta = await fetch(rutaRegistro, {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({ nombre: nombre, imagen: imagenBase64 })
@@ -391,7 +417,7 @@ async function registrarRostro_Legacy() { // Renamed to avoid usage
 
     try {
         // 2. Llamar API Backend
-        const respuesta = await fetch('/api/register-face', {
+        const respuesta = await fetch(rutaRegistro, {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({ nombre: nombre })
@@ -443,7 +469,7 @@ async function verificarRostro() {
 
     try {
         // 2. Llamar API Backend
-        const respuesta = await fetch('/api/scan-face', { method: 'POST' });
+        const respuesta = await fetch(`/api/scan-face${sufijoDispositivo}`, { method: 'POST' });
         const resultado = await respuesta.json();
 
         // Ocultar loader
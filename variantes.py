@@ -0,0 +1,257 @@
+"""
+Variantes del MJPEG por visor: resolución, fps y calidad.
+
+Cada combinación distinta de ancho, calidad y overlay (una variante) se transcodifica
+una sola vez por frame de la cámara y la comparten todos sus visores. Los fps son por
+visor y se respetan salteando frames: siempre se entrega el más nuevo, nunca se
+encolan. Sin parámetros, el nivel se elige solo según lo que tarda en enviarse
+cada frame (si el socket no drena, el cliente no da abasto).
+"""
+import asyncio
+import math
+import os
+import time
+
+import cv2
+import numpy as np
+
+from metricas import VIDEO_VARIANTES, VIDEO_TRANSCODIFICACIONES, VIDEO_CAMBIOS_NIVEL
+
+# Configuración (ajustable por .env)
+CALIDAD_DEFECTO = int(os.getenv("VIDEO_CALIDAD", 70))
+VARIANTES_MAXIMAS = int(os.getenv("VIDEO_VARIANTES_MAXIMAS", 8))  # Por dispositivo
+ANCHO_MINIMO, ANCHO_MAXIMO = 80, 1600
+
+# Niveles del modo automático, de mejor a peor: (ancho, fps, calidad); None = tal como llega del ESP32
+NIVELES = [(None, None, None), (640, 15, 75), (480, 10, 65), (320, 5, 55), (240, 3, 45)]
+OCUPACION_BAJAR = 0.8   # Fracción del tiempo entre frames que se va en enviar: por encima, bajar de nivel
+OCUPACION_SUBIR = 0.3   # Por debajo (sostenido), probar el nivel de arriba
+ESPERA_BAJAR = 1.0      # Segundos mínimos en un nivel antes de bajar
+ESPERA_SUBIR = 5.0      # ... antes de subir; se duplica cada vez que subir no funcionó
+VENTANA = 3.0           # Segundos de memoria de la ocupación
+
+_REDUCCIONES = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                (2, cv2.IMREAD_REDUCED_COLOR_2), (1, cv2.IMREAD_COLOR))
+
+COLOR_AUTORIZADO = (0, 200, 0)      # BGR
+COLOR_DESCONOCIDO = (0, 0, 230)
+
+
+def dibujar_rostros(imagen, rostros, escala=1.0):
+    """Cajas (top, right, bottom, left en el frame original) con el nombre, o DESCONOCIDO."""
+    for caja, nombre in rostros:
+        top, right, bottom, left = (int(v * escala) for v in caja)
+        color = COLOR_AUTORIZADO if nombre else COLOR_DESCONOCIDO
+        cv2.rectangle(imagen, (left, top), (right, bottom), color, 2)
+        etiqueta = nombre or "DESCONOCIDO"
+        (ancho_texto, alto_texto), _ = cv2.getTextSize(etiqueta, cv2.FONT_HERSHEY_DUPLEX, 0.5, 1)
+        y = max(top, alto_texto + 6)
+        cv2.rectangle(imagen, (left, y - alto_texto - 6), (left + ancho_texto + 6, y), color, cv2.FILLED)
+        cv2.putText(imagen, etiqueta, (left + 3, y - 4), cv2.FONT_HERSHEY_DUPLEX, 0.5, (255, 255, 255), 1)
+
+
+def transcodificar(jpg, ancho, calidad, ancho_fuente=None, rostros=()):
+    """
+    (JPEG reescalado a `ancho`, con los rostros dibujados y recomprimido, ancho original).
+    Si se conoce el ancho de la fuente, el JPEG se decodifica ya reducido (escalado en la IDCT).
+    """
+    flag = cv2.IMREAD_COLOR
+    reduccion = 1
+    if ancho and ancho_fuente:
+        reduccion, flag = next((r, f) for r, f in _REDUCCIONES if ancho_fuente // r >= ancho or r == 1)
+    imagen = cv2.imdecode(np.frombuffer(jpg, np.uint8), flag)
+    if imagen is None:
+        return jpg, ancho_fuente
+    alto_img, ancho_img = imagen.shape[:2]
+    if ancho and ancho_img > ancho:
+        imagen = cv2.resize(imagen, (ancho, max(1, round(alto_img * ancho / ancho_img))),
+                            interpolation=cv2.INTER_AREA)
+    if rostros:
+        dibujar_rostros(imagen, rostros, imagen.shape[1] / (ancho_img * reduccion))
+    ok, buf = cv2.imencode('.jpg', imagen, [cv2.IMWRITE_JPEG_QUALITY, calidad or CALIDAD_DEFECTO])
+    return (buf.tobytes() if ok else jpg), ancho_img * reduccion
+
+
+class VarianteVideo:
+    """
+    Un ancho, una calidad y si lleva overlay. Guarda el último frame transcodificado
+    para todos sus visores. Una variante de solo overlay deja pasar sin tocar los
+    frames que no tienen nada que dibujar.
+    """
+
+    def __init__(self, ancho, calidad, anotador=None):
+        self.ancho = ancho
+        self.calidad = calidad
+        self.anotador = anotador    # Función -> [(caja, nombre)] vigentes
+        self.clave = (ancho, calidad, anotador is not None)
+        self.nombre = f"{ancho or 'original'}{f'q{calidad}' if calidad else ''}{'+overlay' if anotador else ''}"
+        self.visores = 0
+        self._ultimo = (0, None)
+        self._en_curso = None     # (secuencia, future) de la transcodificación en marcha
+        self._ancho_fuente = None
+
+    def _transcodificar(self, jpg, rostros):
+        salida, self._ancho_fuente = transcodificar(jpg, self.ancho, self.calidad, self._ancho_fuente, rostros)
+        VIDEO_TRANSCODIFICACIONES.etiquetar(self.nombre).inc()
+        return salida
+
+    async def obtener(self, secuencia, jpg):
+        """El frame `secuencia` en esta variante; se calcula una sola vez (en un hilo) aunque lo pidan muchos."""
+        if self._ultimo[0] == secuencia:
+            return self._ultimo[1]
+        if self._en_curso is not None and self._en_curso[0] == secuencia:
+            return await asyncio.shield(self._en_curso[1])
+
+        rostros = self.anotador() if self.anotador is not None else ()
+        if not rostros and self.ancho is None and self.calidad is None:
+            return jpg  # Solo overlay y nada vigente: el frame original, sin recodificar
+
+        futuro = asyncio.get_running_loop().run_in_executor(None, self._transcodificar, jpg, rostros)
+        self._en_curso = (secuencia, futuro)
+        try:
+            # shield: si este visor se desconecta, los demás siguen esperando el mismo resultado
+            salida = await asyncio.shield(futuro)
+        finally:
+            if self._en_curso is not None and self._en_curso[1] is futuro:
+                self._en_curso = None
+        if secuencia > self._ultimo[0]:
+            self._ultimo = (secuencia, salida)
+        return salida
+
+
+class VariantesVideo:
+    """Variantes en uso de un dispositivo; una variante existe mientras tenga visores."""
+
+    def __init__(self, maximo=VARIANTES_MAXIMAS):
+        self.maximo = maximo
+        self._variantes = {}
+
+    def __len__(self):
+        return len(self._variantes)
+
+    @staticmethod
+    def normalizar(ancho, calidad, anotar=False):
+        """
+        Clave de la variante: ancho múltiplo de 16 y calidad múltiplo de 5 (menos variantes
+        distintas). Reescalar sin calidad pedida usa CALIDAD_DEFECTO; solo overlay, la original.
+        """
+        if ancho is not None:
+            ancho = min(ANCHO_MAXIMO, max(ANCHO_MINIMO, int(round(ancho / 16)) * 16))
+        if calidad is not None:
+            calidad = min(95, max(10, int(round(calidad / 5)) * 5))
+        elif ancho is not None:
+            calidad = CALIDAD_DEFECTO
+        return ancho, calidad, anotar
+
+    def tomar(self, ancho, calidad, anotador=None):
+        clave = self.normalizar(ancho, calidad, anotador is not None)
+        variante = self._variantes.get(clave)
+        if variante is None:
+            candidatas = [v for v in self._variantes.values() if v.clave[2] == clave[2]]
+            if len(self._variantes) >= self.maximo and candidatas:
+                # Sin lugar para otra: la más parecida de las existentes (con o sin overlay, como se pidió)
+                variante = min(candidatas, key=lambda v: (abs((v.ancho or ANCHO_MAXIMO) - (clave[0] or ANCHO_MAXIMO)),
+                                                          abs((v.calidad or 100) - (clave[1] or 100))))
+            else:
+                variante = self._variantes[clave] = VarianteVideo(clave[0], clave[1], anotador)
+                VIDEO_VARIANTES.inc()
+        variante.visores += 1
+        return variante
+
+    def soltar(self, variante):
+        variante.visores -= 1
+        if variante.visores <= 0 and self._variantes.get(variante.clave) is variante:
+            del self._variantes[variante.clave]
+            VIDEO_VARIANTES.dec()
+
+
+class NivelAutomatico:
+    """
+    Nivel de un visor elegido por contrapresión: qué fracción del tiempo entre frames
+    queda bloqueado el envío (el socket no drena). Baja rápido y sube con cautela.
+    """
+
+    def __init__(self, niveles=NIVELES):
+        self.niveles = niveles
+        self.indice = 0
+        self.ocupacion = 0.0
+        self._enviando = 0.0   # Segundos enviando y segundos totales, con decaimiento exponencial
+        self._total = 0.0
+        self._desde = time.monotonic()
+        self._espera_subir = ESPERA_SUBIR
+        self._ultima_subida = None
+
+    @property
+    def nivel(self):
+        return self.niveles[self.indice]
+
+    def registrar(self, envio, intervalo):
+        """`envio`: segundos enviando el frame; `intervalo`: segundos desde el anterior."""
+        # Ponderada por tiempo: el socket suele aceptar varios frames al instante y después
+        # bloquear segundos en uno solo; un promedio por frame diluiría ese bloqueo
+        peso = math.exp(-intervalo / VENTANA)
+        self._enviando = self._enviando * peso + envio
+        self._total = self._total * peso + intervalo
+        self.ocupacion = self._enviando / self._total if self._total > 0 else 0.0
+        ahora = time.monotonic()
+        en_nivel = ahora - self._desde
+
+        if self.ocupacion > OCUPACION_BAJAR and self.indice < len(self.niveles) - 1 and en_nivel > ESPERA_BAJAR:
+            if self._ultima_subida is not None and ahora - self._ultima_subida < 2 * self._espera_subir:
+                self._espera_subir = min(60.0, self._espera_subir * 2)  # Subir no funcionó: esperar más
+            self._cambiar(self.indice + 1, "bajar", ahora)
+        elif self.ocupacion < OCUPACION_SUBIR and self.indice > 0 and en_nivel > self._espera_subir:
+            self._ultima_subida = ahora
+            self._cambiar(self.indice - 1, "subir", ahora)
+
+    def _cambiar(self, indice, direccion, ahora):
+        self.indice = indice
+        self.ocupacion = self._enviando = self._total = 0.0
+        self._desde = ahora
+        VIDEO_CAMBIOS_NIVEL.etiquetar(direccion).inc()
+
+
+async def frames(ranura, variantes, ancho=None, fps=None, calidad=None, automatico=False, anotador=None):
+    """
+    JPEGs para un visor: de la ranura de la ingesta, a sus fps (salteando frames)
+    y en su variante. Con `automatico` los tres parámetros los decide NivelAutomatico.
+    `anotador` (overlay) devuelve los rostros a dibujar en cada frame.
+    """
+    auto = NivelAutomatico() if automatico else None
+    variante = None
+    pedida = None   # Clave pedida (la variante puede ser otra parecida si se llegó al máximo)
+    secuencia = 0
+    proximo = 0.0
+    anterior = time.monotonic()
+    try:
+        while True:
+            if auto is not None:
+                ancho, fps, calidad = auto.nivel
+            recodificar = ancho is not None or calidad is not None or anotador is not None
+            clave = VariantesVideo.normalizar(ancho, calidad, anotador is not None) if recodificar else None
+            if clave != pedida:
+                if variante is not None:
+                    variantes.soltar(variante)
+                variante = variantes.tomar(ancho, calidad, anotador) if recodificar else None
+                pedida = clave
+
+            secuencia, jpg = await ranura.esperar(secuencia)
+            if fps:
+                espera = proximo - time.monotonic()
+                if espera > 0:
+                    await asyncio.sleep(espera)
+                    secuencia, jpg = ranura.leer()  # El más nuevo: los intermedios se descartan
+                proximo = max(proximo + 1.0 / fps, time.monotonic())
+            if variante is not None:
+                jpg = await variante.obtener(secuencia, jpg)
+
+            inicio = time.monotonic()
+            yield jpg
+            # El generador se reanuda cuando el servidor terminó de escribir el frame
+            ahora = time.monotonic()
+            if auto is not None:
+                auto.registrar(ahora - inicio, ahora - anterior)
+            anterior = ahora
+    finally:
+        if variante is not None:
+            variantes.soltar(variante)